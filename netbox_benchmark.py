@@ -0,0 +1,522 @@
+# Benchmark für netbox_pyats_discovery.py
+# Startet eine Netbox REST Attrappe im Speicher und simulierte Switche, die aufgezeichnete CLI Ausgaben wiedergeben
+# Dadurch kann jede Performance Änderung ohne echte Geräte und ohne echte Netbox gegen eine Baseline gemessen werden
+# Gemessen werden Geräte pro Minute, Netbox API Calls pro Gerät und der Speicherverbrauch
+# Json wird für die REST Attrappe und die Ergebnisse benötigt
+# Http.server und Threading sind für die REST Attrappe zuständig
+# Tracemalloc und Resource messen den Speicher
+import json, os, re, time, argparse, threading, tracemalloc, resource, importlib, logging
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl, urlencode
+from collections import Counter
+
+# ---- Netbox REST Attrappe ----
+# Kann nur das, was das Discovery Skript braucht: Filter, Seiten, Bulk POST/PATCH/DELETE und ein paar Validierungen
+# Verschachtelte Objekte werden wie bei Netbox als {"id": ..., "url": ...} zurückgegeben, Auswahlfelder als {"value": ..., "label": ...}
+FOREIGN_KEYS = {
+        "device": "dcim/devices", "site": "dcim/sites", "role": "dcim/device-roles",
+        "device_type": "dcim/device-types", "platform": "dcim/platforms", "manufacturer": "dcim/manufacturers",
+        "module_type": "dcim/module-types", "module_bay": "dcim/module-bays", "primary_ip4": "ipam/ip-addresses",
+        "primary_ip6": "ipam/ip-addresses", "group": "ipam/vlan-groups", "tenant": "tenancy/tenants",
+}
+CHOICES = ("type", "status")
+# Felder die Netbox immer zurückgibt, auch wenn sie beim Erstellen nicht gesetzt wurden
+DEFAULTS = {
+        "ipam/ip-addresses": ("assigned_object_id", "assigned_object_type", "assigned_object"),
+        "dcim/devices": ("primary_ip4", "primary_ip6", "serial", "platform"),
+        "dcim/interfaces": ("label", "description", "cable"),
+        "dcim/modules": ("serial",),
+        "dcim/inventory-items": ("serial", "part_id"),
+}
+UNIQUE = {
+        "dcim/devices": ("name",), "dcim/platforms": ("slug",), "dcim/device-types": ("slug",),
+        "dcim/device-roles": ("slug",), "dcim/sites": ("slug",), "dcim/interfaces": ("device", "name"),
+        "dcim/module-bays": ("device", "name"), "dcim/module-types": ("model",), "dcim/modules": ("module_bay",),
+}
+
+class FakeNetbox:
+        def __init__(self):
+                self.lock = threading.RLock()
+                self.base = ""
+                self.reset()
+
+        # Alles leeren und die Objekte anlegen, die in jeder Netbox schon da sind
+        def reset(self):
+                with self.lock:
+                        self.tables = {}
+                        self.unique = {}
+                        self.next_id = Counter()
+                        self.calls = Counter()
+                        self.add("dcim/manufacturers", {"name": "Cisco", "slug": "cisco"})
+                        self.add("dcim/device-roles", {"name": "Switch", "slug": "switch", "color": "2196f3"})
+                        for site in range(1, 6):
+                                self.add("dcim/sites", {"name": f"site{site}" if site != 5 else "unknown", "slug": f"site{site}"})
+
+        def table(self, path):
+                return self.tables.setdefault(path, {})
+
+        def add(self, path, obj):
+                with self.lock:
+                        self.next_id[path] += 1
+                        obj = dict(obj, id=self.next_id[path])
+                        self.put(path, obj)
+                        return obj
+
+        # Eindeutige Felder werden indexiert, sonst wird die Attrappe bei großen Stacks selbst zum Flaschenhals
+        def uniqueKey(self, path, obj):
+                fields = UNIQUE.get(path)
+                if fields and all(field in obj for field in fields):
+                        return (path,) + tuple(str(obj[field]) for field in fields)
+                return None
+
+        def put(self, path, obj):
+                self.drop(path, obj["id"])
+                self.table(path)[obj["id"]] = obj
+                key = self.uniqueKey(path, obj)
+                if key:
+                        self.unique[key] = obj["id"]
+
+        def drop(self, path, oid):
+                obj = self.table(path).pop(oid, None)
+                if obj is not None and self.unique.get(self.uniqueKey(path, obj)) == oid:
+                        del self.unique[self.uniqueKey(path, obj)]
+
+        def nested(self, path, oid):
+                obj = self.table(path).get(oid, {})
+                out = {"id": oid, "url": f"{self.base}/api/{path}/{oid}/", "display": str(obj.get("name", obj.get("address", oid)))}
+                for key in ("name", "slug", "address", "model", "prefix", "vid"):
+                        if key in obj:
+                                out[key] = obj[key]
+                if path == "dcim/interfaces":
+                        out["device"] = self.nested("dcim/devices", obj.get("device"))
+                return out
+
+        def render(self, path, obj):
+                out = {"url": f"{self.base}/api/{path}/{obj['id']}/", "display": str(obj.get("name", obj["id"]))}
+                for key, value in obj.items():
+                        if key in FOREIGN_KEYS and isinstance(value, int):
+                                out[key] = self.nested(FOREIGN_KEYS[key], value)
+                        elif key in CHOICES and isinstance(value, str):
+                                out[key] = {"value": value, "label": value}
+                        elif key in ("a_terminations", "b_terminations"):
+                                out[key] = [dict(t, object=self.nested("dcim/interfaces", t["object_id"])) for t in value]
+                        elif key == "assigned_object_id" and value:
+                                out[key] = value
+                                out["assigned_object"] = self.nested("dcim/interfaces", value)
+                        else:
+                                out[key] = value
+                out.setdefault("custom_fields", {})
+                for key in DEFAULTS.get(path, ()):
+                        out.setdefault(key, None)
+                return out
+
+        def cableInterfaces(self, obj):
+                return [t["object_id"] for t in obj.get("a_terminations", []) + obj.get("b_terminations", [])]
+
+        # values sind die Werte als Text, ids dieselben Werte als Zahlen
+        def matches(self, path, obj, key, values, ids):
+                if key == "id":
+                        return obj["id"] in ids
+                if path == "dcim/cables":
+                        if key in ("termination_a_id", "termination_b_id"):
+                                side = "a_terminations" if key == "termination_a_id" else "b_terminations"
+                                return any(t["object_id"] in ids for t in obj.get(side, []))
+                        if key == "interface_id":
+                                return any(i in ids for i in self.cableInterfaces(obj))
+                        if key == "device_id":
+                                return any(self.table("dcim/interfaces").get(i, {}).get("device") in ids for i in self.cableInterfaces(obj))
+                if key.endswith("_id") and key[:-3] in FOREIGN_KEYS:
+                        return obj.get(key[:-3]) in ids
+                if key in FOREIGN_KEYS:
+                        target = self.table(FOREIGN_KEYS[key]).get(obj.get(key), {})
+                        return target.get("name") in values or target.get("slug") in values
+                value = obj.get(key)
+                if isinstance(value, bool):
+                        value = "true" if value else "false"
+                return str(value) in values
+
+        def query(self, path, params):
+                filters = {}
+                for key, value in params:
+                        if key not in ("limit", "offset", "brief", "ordering", "exclude"):
+                                filters.setdefault(key, []).append(value)
+                with self.lock:
+                        rows = list(self.table(path).values())
+                for key, values in filters.items():
+                        ids = {int(value) for value in values if value.isdigit()}
+                        rows = [row for row in rows if self.matches(path, row, key, values, ids)]
+                return rows
+
+        def validate(self, path, obj, oid=None):
+                if path == "dcim/cables":
+                        for t in obj.get("a_terminations", []) + obj.get("b_terminations", []):
+                                interface = self.table("dcim/interfaces").get(t["object_id"])
+                                if interface is None:
+                                        return {"terminations": ["Interface not found"]}
+                                if interface.get("type") == "virtual":
+                                        return {"terminations": ["Cables cannot be attached to virtual interfaces"]}
+                                for other in self.table(path).values():
+                                        if other["id"] != oid and t["object_id"] in self.cableInterfaces(other):
+                                                return {"terminations": [f"Interface {t['object_id']} already has a cable"]}
+                key = self.uniqueKey(path, obj)
+                if key and self.unique.get(key, oid) != oid:
+                        return {field: ["must be unique"] for field in UNIQUE[path]}
+                return None
+
+def normalize(data):
+        out = {}
+        for key, value in data.items():
+                if isinstance(value, dict) and "id" in value and key in FOREIGN_KEYS:
+                        value = value["id"]
+                if key in FOREIGN_KEYS and isinstance(value, str) and value.isdigit():
+                        value = int(value)
+                out[key] = value
+        return out
+
+def makeHandler(netbox, page_size=50):
+        class Handler(BaseHTTPRequestHandler):
+                def log_message(self, *args):
+                        pass
+
+                def reply(self, code, body=None):
+                        data = b"" if body is None else json.dumps(body).encode()
+                        self.send_response(code)
+                        self.send_header("Content-Type", "application/json")
+                        self.send_header("API-Version", "4.1")
+                        self.send_header("Content-Length", str(len(data)))
+                        self.end_headers()
+                        self.wfile.write(data)
+
+                def route(self, method):
+                        url = urlparse(self.path)
+                        parts = [part for part in url.path.split("/") if part][1:]
+                        oid = int(parts[2]) if len(parts) == 3 and parts[2].isdigit() else None
+                        path = "/".join(parts[:2])
+                        netbox.calls[(method, path)] += 1
+                        return path, oid, parse_qsl(url.query)
+
+                def body(self):
+                        length = int(self.headers.get("Content-Length", 0) or 0)
+                        return json.loads(self.rfile.read(length)) if length else None
+
+                def do_GET(self):
+                        path, oid, params = self.route("GET")
+                        if "/" not in path:
+                                return self.reply(200, {})
+                        if oid is not None:
+                                obj = netbox.table(path).get(oid)
+                                return self.reply(200, netbox.render(path, obj)) if obj else self.reply(404, {"detail": "Not found."})
+                        rows = netbox.query(path, params)
+                        limit = int(dict(params).get("limit", page_size) or len(rows) or 1)
+                        offset = int(dict(params).get("offset", 0))
+                        following = None
+                        if offset + limit < len(rows):
+                                query = [(k, v) for k, v in params if k not in ("limit", "offset")] + [("limit", limit), ("offset", offset + limit)]
+                                following = f"{netbox.base}/api/{path}/?{urlencode(query)}"
+                        self.reply(200, {"count": len(rows), "next": following, "previous": None, "results": [netbox.render(path, row) for row in rows[offset:offset + limit]]})
+
+                def do_POST(self):
+                        path, oid, params = self.route("POST")
+                        data = self.body()
+                        created = []
+                        with netbox.lock:
+                                for item in data if isinstance(data, list) else [data]:
+                                        item = normalize(item)
+                                        error = netbox.validate(path, item)
+                                        if error:
+                                                # Bulk Requests sind in Netbox atomar
+                                                for obj in created:
+                                                        netbox.drop(path, obj["id"])
+                                                return self.reply(400, [error] if isinstance(data, list) else error)
+                                        created.append(netbox.add(path, item))
+                        out = [netbox.render(path, obj) for obj in created]
+                        self.reply(201, out if isinstance(data, list) else out[0])
+
+                def do_PATCH(self):
+                        path, oid, params = self.route("PATCH")
+                        data = self.body()
+                        updated = []
+                        with netbox.lock:
+                                for item in data if isinstance(data, list) else [dict(data, id=oid)]:
+                                        obj = netbox.table(path).get(int(item["id"]))
+                                        if obj is None:
+                                                return self.reply(404, {"detail": "Not found."})
+                                        merged = dict(obj, **normalize(item))
+                                        if "custom_fields" in item:
+                                                merged["custom_fields"] = dict(obj.get("custom_fields", {}), **item["custom_fields"])
+                                        error = netbox.validate(path, merged, obj["id"])
+                                        if error:
+                                                return self.reply(400, error)
+                                        updated.append(merged)
+                                for merged in updated:
+                                        netbox.put(path, merged)
+                        out = [netbox.render(path, obj) for obj in updated]
+                        self.reply(200, out if isinstance(data, list) else out[0])
+
+                def do_DELETE(self):
+                        path, oid, params = self.route("DELETE")
+                        data = self.body()
+                        with netbox.lock:
+                                for i in [oid] if oid is not None else [int(item["id"]) for item in data]:
+                                        netbox.drop(path, i)
+                        self.reply(204)
+        return Handler
+
+# ---- Funktion um die REST Attrappe in einem Thread zu starten ----
+def startNetbox(netbox):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), makeHandler(netbox))
+        netbox.base = f"http://127.0.0.1:{server.server_address[1]}"
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+# ---- Simulierter Switch ----
+# Gibt pro Befehl die aufgezeichnete Rohausgabe zurück, parse liefert das dazu aufgezeichnete Genie Ergebnis
+# latency simuliert die Zeit, die ein echter Switch pro Befehl braucht
+class FakeSwitch:
+        def __init__(self, name, dev_os, ip, recording, latency=0):
+                self.name = name
+                self.os = dev_os
+                self.connections = {"cli": type("Connection", (), {"ip": ip})()}
+                self.recording = recording
+                self.latency = latency
+
+        def connect(self, **kwargs):
+                time.sleep(self.latency)
+
+        # Wie Unicon: eine Liste von Befehlen gibt {Befehl: Ausgabe} zurück
+        def execute(self, command, timeout=None, **kwargs):
+                if isinstance(command, list):
+                        return {c: self.execute(c, timeout) for c in command}
+                time.sleep(self.latency)
+                if command == "terminal length 0":
+                        return ""
+                if command not in self.recording:
+                        raise Exception(f"% Invalid input detected at '^' marker. ({command})")
+                return self.recording[command]["raw"]
+
+        def parse(self, command, output=None):
+                return json.loads(json.dumps(self.recording[command]["parsed"]))
+
+        def disconnect(self):
+                pass
+
+class FakeTestbed:
+        def __init__(self, switches):
+                self.devices = {switch.name: switch for switch in switches}
+
+# ---- Funktionen um Ausgaben aufzuzeichnen ----
+# Rohausgabe und Genie Ergebnis passen zueinander, die Rohausgabe sieht aus wie von einem echten Switch
+def recordVersion(hostname, dev_os, chassis, serial):
+        os_name = "IOS-XE" if dev_os == "iosxe" else "IOS"
+        raw = (f"Cisco IOS {'XE ' if dev_os == 'iosxe' else ''}Software, Catalyst L3 Switch Software, Version 16.12.4\n"
+               f"{hostname} uptime is 1 year, 2 weeks, {int(time.time()) % 60} minutes\n"
+               f"Model Number                       : {chassis}\n"
+               f"System Serial Number               : {serial}\n")
+        return {"raw": raw, "parsed": {"version": {"hostname": hostname, "os": os_name, "version": "16.12.4", "chassis_sn": serial, "platform": "Catalyst L3 Switch", "chassis": chassis}}}
+
+def recordVlans(count):
+        vlans = {str(vid): {"vlan_id": str(vid), "name": f"VLAN{vid:04d}"} for vid in [1] + list(range(10, 10 + count))}
+        raw = "VLAN Name                             Status    Ports\n" + "".join(f"{v['vlan_id']:<4} {v['name']:<32} active\n" for v in vlans.values())
+        return {"raw": raw, "parsed": {"vlans": vlans}}
+
+# GigabitEthernet1/0/1 -> Gi1/0/1, so wie in 'show interfaces status'
+def shortName(name):
+        return re.sub(r"^(..)[a-zA-Z]*", r"\1", name)
+
+def recordInterfaces(members, ports, uplinks):
+        interfaces = {}
+        for member in range(1, members + 1):
+                for port in range(1, ports + 1):
+                        interfaces[f"GigabitEthernet{member}/0/{port}"] = {"status": "connected" if port % 3 else "notconnect", "vlan": "10", "duplex_code": "a-full", "port_speed": "a-1000", "type": "10/100/1000BaseTX", "name": f"access {port}"}
+                for uplink in range(1, uplinks + 1):
+                        interfaces[f"TenGigabitEthernet{member}/1/{uplink}"] = {"status": "connected", "vlan": "trunk", "duplex_code": "full", "port_speed": "10G", "type": "SFP-10GBase-SR"}
+        raw = "Port         Name               Status       Vlan       Duplex  Speed Type\n" + "".join(
+                f"{shortName(name):<12} {data.get('name', ''):<18} {data['status']:<12} {data['vlan']:<10} {data['duplex_code']:>6} {data['port_speed']:>6} {data['type']}\n" for name, data in interfaces.items())
+        return {"raw": raw, "parsed": {"interfaces": interfaces}}
+
+def recordNeighbors(neighbors):
+        raw = "".join(f"-------------------------\nDevice ID: {n['device_id']}\nEntry address(es):\n  IP address: {next(iter(n['management_addresses']))}\nPlatform: {n['platform']},  Capabilities: {n['capabilities']}\n"
+                      f"Interface: {n['local_interface']},  Port ID (outgoing port): {n['port_id']}\nHoldtime : 150 sec\n\nVersion :\n{n['software_version']}\n\nNative VLAN: {n['native_vlan']}\n" for n in neighbors)
+        return {"raw": raw, "parsed": {"index": {str(i + 1): n for i, n in enumerate(neighbors)}}}
+
+def neighbor(device_id, local, port, ip, platform="cisco C9300-48P", caps="Router Switch IGMP", software="Cisco IOS Software [Gibraltar], Catalyst L3 Switch Software (CAT9K_IOSXE), IOS-XE", native="1"):
+        return {"device_id": device_id, "capabilities": caps, "platform": platform, "local_interface": local, "port_id": port,
+                "management_addresses": {ip: {}}, "native_vlan": native, "software_version": software}
+
+def recordInventory(hostname, dev_os, members, chassis, uplinks):
+        raw = ""
+        if dev_os == "ios":
+                slots = {}
+                for member in range(1, members + 1):
+                        sfp = {"name": f"TenGigabitEthernet{member}/1/1", "descr": "SFP-10GBase-SR", "pid": "SFP-10G-SR", "sn": f"SFP{hostname}{member}"}
+                        slots[str(member)] = {"rp": {chassis: {"name": str(member), "descr": chassis, "pid": chassis, "sn": f"FOC{hostname}{member}", "subslot": {"1": {"SFP-10G-SR": sfp}}}}}
+                        raw += f'NAME: "{member}", DESCR: "{chassis}"\nPID: {chassis}  , VID: V02  , SN: FOC{hostname}{member}\n\n'
+                        raw += f'NAME: "{sfp["name"]}", DESCR: "{sfp["descr"]}"\nPID: {sfp["pid"]}  , VID: V01  , SN: {sfp["sn"]}\n\n'
+                return {"raw": raw, "parsed": {"slot": slots}}
+        names = {}
+        for member in range(1, members + 1):
+                names[f"Switch {member}"] = {"description": f"{chassis}", "pid": chassis, "sn": f"FOC{hostname}{member}"}
+                for uplink in range(1, uplinks + 1):
+                        names[f"TenGigabitEthernet{member}/1/{uplink}"] = {"description": "SFP-10GBase-SR", "pid": "SFP-10G-SR", "sn": f"SFP{hostname}{member}{uplink}"}
+        for name, data in names.items():
+                raw += f'NAME: "{name}", DESCR: "{data["description"]}"\nPID: {data["pid"]}  , VID: V01  , SN: {data["sn"]}\n\n'
+        return {"raw": raw, "parsed": {"name": names}}
+
+def recordStack(members):
+        stack = {str(member): {"role": "active" if member == 1 else "member", "mac_address": f"00aa.bbcc.{member:04d}", "priority": "1", "hw_ver": "V02", "state": "ready"} for member in range(1, members + 1)}
+        raw = "Switch#   Role    Mac Address     Priority H/W Version  Current State\n" + "".join(f" {m}       {s['role']:<7} {s['mac_address']}  {s['priority']}        {s['hw_ver']}          {s['state']}\n" for m, s in stack.items())
+        return {"raw": raw, "parsed": {"switch": {"stack": stack}}}
+
+# ---- Geräte Profile ----
+# Access Switch mit 24 Ports (IOS), mit 48 Ports (IOS-XE), ein Stack mit 8 Mitgliedern und ein Verteiler mit 50 CDP Nachbarn
+PROFILES = {
+        "24p": {"os": "ios", "members": 1, "ports": 24, "uplinks": 2, "neighbors": 2, "chassis": "WS-C3750X-24P"},
+        "48p": {"os": "iosxe", "members": 1, "ports": 48, "uplinks": 4, "neighbors": 2, "chassis": "C9300-48P"},
+        "stack8": {"os": "iosxe", "members": 8, "ports": 48, "uplinks": 4, "neighbors": 8, "chassis": "C9300-48P"},
+        "cdp50": {"os": "iosxe", "members": 1, "ports": 48, "uplinks": 4, "neighbors": 50, "chassis": "C9300-48P"},
+}
+
+# ---- Funktion um die Switche eines Profils zu bauen ----
+# Jeder Switch hängt mit dem ersten Uplink am Core, die restlichen Nachbarn sind Telefone und Access Points an den Access Ports
+def buildSwitches(profile_name, count, latency=0, profile_index=0):
+        profile = PROFILES[profile_name]
+        switches = []
+        for number in range(count):
+                hostname = f"{profile_name}-{number:03d}"
+                ip = f"10.{profile_index + 1}.{number // 200}.{number % 200 + 10}"
+                neighbors = [neighbor("core01", "TenGigabitEthernet1/1/1", f"TenGigabitEthernet1/0/{number + 1}", "10.0.0.1")]
+                for i in range(1, profile["neighbors"]):
+                        port = f"GigabitEthernet{(i - 1) // profile['ports'] + 1}/0/{(i - 1) % profile['ports'] + 1}"
+                        if i % 5:
+                                neighbors.append(neighbor(f"SEP{profile_index:02d}{number:03d}{i:04d}", port, "Port 1", f"10.200.{number % 250}.{i}", platform="Cisco IP Phone 8841", caps="Host Phone Two-port Mac Relay", software="SIP88xx.14-1-1", native=""))
+                        else:
+                                neighbors.append(neighbor(f"AP{profile_index:02d}{number:03d}{i:04d}", port, "GigabitEthernet0", f"10.201.{number % 250}.{i}", platform="cisco AIR-AP2802I-E-K9", caps="Router Trans-Bridge", software="Cisco AP Software, ap3g3-k9w8 Version: 8.10.151.0", native="20"))
+                recording = {
+                        "show version": recordVersion(hostname, profile["os"], profile["chassis"], f"FOC{profile_index:02d}{number:06d}"),
+                        "show vlan": recordVlans(20),
+                        "show interfaces status": recordInterfaces(profile["members"], profile["ports"], profile["uplinks"]),
+                        "show cdp neighbors detail": recordNeighbors(neighbors),
+                        "show inventory OID" if profile["os"] == "iosxe" else "show inventory": recordInventory(hostname, profile["os"], profile["members"], profile["chassis"], profile["uplinks"]),
+                        "show switch": recordStack(profile["members"]),
+                }
+                switches.append(FakeSwitch(hostname, profile["os"], ip, recording, latency))
+        return switches
+
+# ---- Funktion um ein Profil zu messen ----
+# Erster Lauf gegen eine leere Netbox, jeder weitere Lauf gegen die Netbox vom Lauf davor
+def benchmarkProfile(discovery, netbox, profile_name, profile_index, args):
+        netbox.reset()
+        tb = FakeTestbed(buildSwitches(profile_name, args.devices, args.latency / 1000, profile_index))
+        store = discovery.FingerprintStore(":memory:") if args.fingerprints else None
+        capabilities = discovery.CapabilityStore(":memory:")
+        results = []
+        for run in range(1, args.runs + 1):
+                netbox.calls.clear()
+                tracemalloc.reset_peak()
+                started = time.monotonic()
+                summary = discovery.runDiscovery(discovery.nb, tb.devices.values(), workers=args.workers, pool="thread", timeout=args.timeout, store=store, capabilities=capabilities)
+                duration = time.monotonic() - started
+                calls = sum(netbox.calls.values())
+                results.append({
+                        "profile": profile_name,
+                        "run": run,
+                        "devices": args.devices,
+                        "failed": len(summary["failed"]),
+                        "seconds": round(duration, 3),
+                        "devices_per_minute": round(args.devices / duration * 60, 1),
+                        "api_calls": calls,
+                        "api_calls_per_device": round(calls / args.devices, 1),
+                        "api_calls_by_endpoint": {f"{method} {path}": count for (method, path), count in sorted(netbox.calls.items())},
+                        "peak_python_mb": round(tracemalloc.get_traced_memory()[1] / 2**20, 1),
+                        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                })
+        return results
+
+# ---- Micro Benchmark für die Interface Typen ----
+# Misst einmal ohne und einmal mit dem Cache, wie bei einem Lauf mit vielen gleichen Switchen
+# Die Interfaces kommen von den simulierten Switchen aller Profile, dazu die Ports der CDP Nachbarn ohne Medientyp
+# Ob die Typen stimmen, prüfen die Tests in tests/test_interface_types.py
+def benchmarkInterfaces(discovery, rounds):
+        interfaces = []
+        for profile in PROFILES.values():
+                recording = recordInterfaces(profile["members"], profile["ports"], profile["uplinks"])
+                interfaces += [(name, data["type"]) for name, data in recording["parsed"]["interfaces"].items()]
+        interfaces += [(port, None) for port in ("TenGigabitEthernet1/0/1", "Port 1", "GigabitEthernet0")]
+        workload = interfaces * rounds
+        started = time.perf_counter()
+        for name, media in workload:
+                discovery.INTERFACE_TYPES.classify(name, media)
+        uncached = time.perf_counter() - started
+        discovery.interfaceType.cache_clear()
+        started = time.perf_counter()
+        for name, media in workload:
+                discovery.interfaceType(name, media)
+        cached = time.perf_counter() - started
+        return {
+                "interfaces": len(workload),
+                "uncached_ns": round(uncached / len(workload) * 1e9),
+                "cached_ns": round(cached / len(workload) * 1e9),
+                "cache": discovery.interfaceType.cache_info()._asdict(),
+        }
+
+# ---- Funktion um die Ergebnisse mit einer Baseline zu vergleichen ----
+# Positive Prozent sind beim Durchsatz gut und bei API Calls und Speicher schlecht
+def compareBaseline(results, baseline):
+        old = {(row["profile"], row["run"]): row for row in baseline}
+        lines = []
+        for row in results:
+                before = old.get((row["profile"], row["run"]))
+                if not before:
+                        continue
+                changes = []
+                for key in ("devices_per_minute", "api_calls_per_device", "peak_python_mb"):
+                        if before[key]:
+                                changes.append(f"{key} {(row[key] - before[key]) / before[key] * 100:+.1f}%")
+                lines.append(f"{row['profile']:<8} run {row['run']}: " + ", ".join(changes))
+        return lines
+
+def parseArgs():
+        parser = argparse.ArgumentParser(description="Benchmark netbox_pyats_discovery.py against a simulated Netbox and simulated switches")
+        parser.add_argument("--profiles", default=",".join(PROFILES), help=f"comma separated profiles ({', '.join(PROFILES)})")
+        parser.add_argument("--devices", type=int, default=10, help="switches per profile")
+        parser.add_argument("--runs", type=int, default=2, help="runs per profile, the first one starts with an empty Netbox")
+        parser.add_argument("--workers", type=int, default=4, help="switches collected at the same time")
+        parser.add_argument("--timeout", type=int, default=300, help="seconds per switch before it counts as failed")
+        parser.add_argument("--latency", type=float, default=0, help="simulated milliseconds per command on the switches")
+        parser.add_argument("--fingerprints", action="store_true", help="skip unchanged sections like a normal run, otherwise every run processes everything")
+        parser.add_argument("--output", help="write the results as JSON, e.g. to use them as baseline later")
+        parser.add_argument("--baseline", help="JSON file of an earlier benchmark to compare against")
+        parser.add_argument("--interfaces", type=int, metavar="ROUNDS", help="only run the interface type micro benchmark with this many rounds over the interfaces of the profiles")
+        parser.add_argument("--log-level", default="CRITICAL", help="log level of the discovery script")
+        return parser.parse_args()
+
+if __name__ == "__main__":
+        args = parseArgs()
+        netbox = FakeNetbox()
+        startNetbox(netbox)
+
+        # Umgebung setzen bevor das Skript geladen wird, es verbindet sich beim Import mit Netbox
+        os.environ.update(NETBOX_URL=netbox.base, NETBOX_TOKEN="0" * 40, LOG_LEVEL=args.log_level, SWITCH_USER="benchmark", SWITCH_PASS="benchmark")
+        discovery = importlib.import_module("netbox_pyats_discovery")
+        logging.getLogger().setLevel(args.log_level.upper())
+
+        if args.interfaces:
+                result = benchmarkInterfaces(discovery, args.interfaces)
+                print(f"{result['interfaces']} lookups: {result['uncached_ns']} ns uncached, {result['cached_ns']} ns cached ({result['cache']['hits']} hits, {result['cache']['misses']} misses)")
+                exit(0)
+
+        tracemalloc.start()
+        results = []
+        for index, profile_name in enumerate(args.profiles.split(",")):
+                results += benchmarkProfile(discovery, netbox, profile_name, index, args)
+
+        print(f"{'profile':<8} {'run':>3} {'devices':>7} {'failed':>6} {'seconds':>8} {'dev/min':>8} {'api/dev':>8} {'peak MB':>8}")
+        for row in results:
+                print(f"{row['profile']:<8} {row['run']:>3} {row['devices']:>7} {row['failed']:>6} {row['seconds']:>8} {row['devices_per_minute']:>8} {row['api_calls_per_device']:>8} {row['peak_python_mb']:>8}")
+        if args.baseline:
+                with open(args.baseline, encoding="utf-8") as f:
+                        for line in compareBaseline(results, json.load(f)):
+                                print(line)
+        if args.output:
+                with open(args.output, "w", encoding="utf-8") as f:
+                        json.dump(results, f, indent=2)
@@ -1,9 +1,10 @@
-from extras.scripts import Script, StringVar, ChoiceVar
+from extras.scripts import Script, StringVar, ChoiceVar, ObjectVar
 from dcim.models import Device, DeviceRole, DeviceType, Site, Interface
-from ipam.models import IPAddress
+from ipam.models import IPAddress, Prefix
 
 # Dieses Skript nimmt zwei Variablen entgegen, den Gerätenamen und die IP-Adresse.
 # Es erstellt dann das Gerät in Netbox mit der Interface Vlan1, der die IP-Adresse zugewiesen wird, und setzt sie schließlich als primäre IP-Adresse.
+# Maske und Site kommen wie im Discovery Skript aus dem kleinsten Prefix, in dem die IP liegt, ohne Prefix /24 und die Site "unknown".
 class NetboxTestbedMaker(Script):
     class Meta:
         name = "Netbox Device Maker"
@@ -13,12 +14,24 @@ class NetboxTestbedMaker(Script):
     dev_name = StringVar(label="Device Hostname", description="Enter the hostname precisely!", required=True)
     dev_ip = StringVar(label="Device IP", description="Enter the IP address of the device.", required=True)
     os = ChoiceVar(label="Device OS", choices=[('ios', 'IOS'), ('nxos', 'NX-OS'), ('iosxe', 'IOS-XE')], required=True, default='ios')
+    site = ObjectVar(model=Site, label="Site", description="Leave empty to use the site of the prefix of the IP address.", required=False)
 
     def run(self, data, commit):
         dev_role = DeviceRole.objects.get(name="Switch")
         dev_type = DeviceType.objects.get(model="Unknown")
-        site_name = Site.objects.get(name="unknown")
-        dev_ip_cidr = data['dev_ip'] + "/24"
+
+        # Longest Prefix Match macht hier die Datenbank, es gibt nur wenige Prefixe die die IP enthalten
+        prefix = max(Prefix.objects.filter(prefix__net_contains_or_equals=data['dev_ip']), key=lambda p: p.prefix.prefixlen, default=None)
+        if prefix:
+            self.log_info("Prefix found: " + str(prefix.prefix))
+            dev_ip_cidr = data['dev_ip'] + "/" + str(prefix.prefix.prefixlen)
+            # Bis Netbox 4.1 hat ein Prefix eine Site, ab 4.2 einen Scope, dessen Site in _site steht
+            prefix_site = getattr(prefix, "site", None) or getattr(prefix, "_site", None)
+        else:
+            self.log_info("No prefix found for " + data['dev_ip'] + ", using /24")
+            dev_ip_cidr = data['dev_ip'] + "/24"
+            prefix_site = None
+        site_name = data['site'] or prefix_site or Site.objects.get(name="unknown")
 
         if Device.objects.filter(name=data['dev_name']):
             self.log_info("Device already exists: " + data['dev_name'])
@@ -28,9 +41,14 @@ class NetboxTestbedMaker(Script):
             device = Device(name=data['dev_name'], role=dev_role, device_type=dev_type, site=site_name, status='active')
             device.save()
 
-        if IPAddress.objects.filter(address=dev_ip_cidr):
-            self.log_info("IP already exists: " + dev_ip_cidr)
-            ip = IPAddress.objects.get(address=dev_ip_cidr)
+        # Ohne Maske suchen, eine IP mit veralteter Maske (z.B. das frühere /24) bekommt die Maske vom Prefix
+        ip = IPAddress.objects.filter(address__net_host=data['dev_ip']).first()
+        if ip:
+            self.log_info("IP already exists: " + str(ip.address))
+            if str(ip.address) != dev_ip_cidr:
+                self.log_info("Mask is outdated, updating to " + dev_ip_cidr)
+                ip.address = dev_ip_cidr
+                ip.save()
         else:
             self.log_info("IP created: " + dev_ip_cidr)
             ip = IPAddress(address=dev_ip_cidr, status='online')
@@ -4,9 +4,29 @@
 # Re wird benötigt, um die CDP Daten zu parsen
 # ipaddress wird benötigt, um die IP Adressen zu parsen
 # Random wird benötigt, um zufällige Farben für die Geräte Rollen zu wählen
+# Concurrent.futures wird benötigt, um mehrere Geräte gleichzeitig zu sammeln
+# Json und Gzip werden für die Snapshots der gesammelten Daten benötigt
+# Hashlib und Sqlite3 werden für die Fingerabdrücke der Geräte Ausgaben benötigt
+# Asyncio wird benötigt, um unabhängige Netbox Abfragen (z.B. CDP Nachbarn) gleichzeitig zu machen
+# HTTPAdapter und Retry kommen von requests bzw. urllib3 und sind für den Verbindungspool und die Wiederholungen zuständig
+# Contextlib und urllib.parse werden für die Zeitmessung und das Zählen der Netbox Requests benötigt
+# Functools wird für das Merken der Interface Typen benötigt
+# Socket wird nur für den Hostnamen der Worker im Work Store benötigt
+# Itertools wird für das Gruppieren der Änderungen beim Anwenden eines Plans benötigt
+# Resource und Sys werden für den höchsten Speicherverbrauch (Peak RSS) in der Zusammenfassung benötigt
 from genie.testbed import load
-import pynetbox, urllib3, re, random, os, logging
-from ipaddress import ip_network
+from genie.conf.base import Device
+import pynetbox, urllib3, re, random, os, logging, argparse, time, multiprocessing, json, gzip, threading, hashlib, sqlite3, asyncio, socket, resource, sys
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import Counter, deque, OrderedDict
+from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from ipaddress import ip_address, ip_network
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import groupby
+from urllib.parse import urlparse
 from dotenv import load_dotenv
 
 # Umgebung Variablen irgendwie laden
@@ -25,21 +45,387 @@ NETBOX_URL = os.getenv("NETBOX_URL")
 NETBOX_TOKEN = os.getenv("NETBOX_TOKEN")
 SWITCH_USER = os.getenv("SWITCH_USER")
 SWITCH_PASS = os.getenv("SWITCH_PASS")
+# Wie viele Requests gleichzeitig an Netbox gehen dürfen und wie oft bei 429/5xx wiederholt wird
+NETBOX_CONCURRENCY = int(os.getenv("NETBOX_CONCURRENCY", "8"))
+NETBOX_RETRIES = int(os.getenv("NETBOX_RETRIES", "5"))
+# "false" (Standard, wie bisher), "true" oder der Pfad zu einem CA Bundle
+NETBOX_VERIFY = os.getenv("NETBOX_VERIFY", "false")
+# Höchstens so viele Requests pro Sekunde an Netbox (0 heißt keine feste Grenze), Burst ist die Größe des Token Buckets
+NETBOX_RATE = float(os.getenv("NETBOX_RATE", "0"))
+NETBOX_BURST = int(os.getenv("NETBOX_BURST", "20"))
+# Bei 429/503 oder Antworten langsamer als NETBOX_SLOW Sekunden werden Rate und gleichzeitige Requests gesenkt
+NETBOX_ADAPTIVE = os.getenv("NETBOX_ADAPTIVE", "true").lower() in ("true", "1", "yes")
+NETBOX_SLOW = float(os.getenv("NETBOX_SLOW", "5"))
 logging.debug("Environment variables loaded:")
 logging.debug(f"NETBOX_URL: {NETBOX_URL}")
 logging.debug(f"NETBOX_TOKEN: {NETBOX_TOKEN}")
 logging.debug(f"SWITCH_USER: {SWITCH_USER}")
 logging.debug(f"SWITCH_PASS: {SWITCH_PASS}")
 
-logging.info("Connecting to Netbox")
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning) # HTTP Warnung ausmachen
-nb = pynetbox.api(url=NETBOX_URL, token=NETBOX_TOKEN) # Netbox API Verbindung
-nb.http_session.verify = False # Keine Zertifikate checken
+# Grenzen der Histogramme in Sekunden, wie bei Prometheus üblich
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# ---- Histogramm für Zeiten ----
+# Zählt pro Grenze wie viele Werte darunter lagen, dazu Summe und Anzahl
+class Histogram:
+        def __init__(self):
+                self.buckets = [0] * len(LATENCY_BUCKETS)
+                self.sum = 0.0
+                self.count = 0
+
+        def observe(self, seconds):
+                for i, bound in enumerate(LATENCY_BUCKETS):
+                        if seconds <= bound:
+                                self.buckets[i] += 1
+                self.sum += seconds
+                self.count += 1
+
+        def toDict(self):
+                return {"buckets": dict(zip(map(str, LATENCY_BUCKETS), self.buckets)), "sum": round(self.sum, 6), "count": self.count}
+
+# ---- Messwerte eines Laufs ----
+# Zeiten pro Phase (connect, execute, parse und die Abschnitte beim Eintragen) für den ganzen Lauf und pro Gerät
+# Netbox Requests pro Endpoint, Methode und Status mit Latenz, gezählt über einen Response Hook der requests Session
+# Beim Eintragen ist 'device' gesetzt, damit die Requests dem Gerät zugeordnet werden können
+class Metrics:
+        def __init__(self):
+                self.lock = threading.Lock()
+                self.device = None
+                self.phases = {}
+                self.devices = {}
+                self.requests = Counter()
+                self.latency = {}
+                self.limiter = None
+
+        def observe(self, phase, seconds, device=None):
+                with self.lock:
+                        self.phases.setdefault(phase, Histogram()).observe(seconds)
+                        if device:
+                                times = self.devices.setdefault(device, {"phases": Counter(), "requests": 0})["phases"]
+                                times[phase] += seconds
+
+        @contextmanager
+        def timer(self, phase):
+                started = time.monotonic()
+                try:
+                        yield
+                finally:
+                        self.observe(phase, time.monotonic() - started, self.device)
+
+        # Die Zeiten vom Sammeln kommen im Ergebnis mit, weil im Process Pool die Messwerte sonst im Kindprozess bleiben
+        def observeResult(self, result):
+                for phase, seconds in result.pop("timings", {}).items():
+                        self.observe(phase, seconds, result["device"])
+
+        def responseHook(self, response, *args, **kwargs):
+                # /api/dcim/interfaces/12/ -> dcim/interfaces
+                endpoint = "/".join(part for part in urlparse(response.url).path.split("/")[2:] if part and not part.isdigit())
+                method = response.request.method
+                with self.lock:
+                        self.requests[(method, endpoint, response.status_code)] += 1
+                        self.latency.setdefault((method, endpoint), Histogram()).observe(response.elapsed.total_seconds())
+                        if self.device:
+                                self.devices.setdefault(self.device, {"phases": Counter(), "requests": 0})["requests"] += 1
+
+        def toDict(self):
+                with self.lock:
+                        return {
+                                "phases": {phase: histogram.toDict() for phase, histogram in sorted(self.phases.items())},
+                                "requests": [{"method": method, "endpoint": endpoint, "status": status, "count": count} for (method, endpoint, status), count in sorted(self.requests.items())],
+                                "latency": {f"{method} {endpoint}": histogram.toDict() for (method, endpoint), histogram in sorted(self.latency.items())},
+                                "devices": {device: {"phases": {phase: round(seconds, 6) for phase, seconds in data["phases"].items()}, "requests": data["requests"]} for device, data in sorted(self.devices.items())},
+                        }
+
+        # Textfile für den node_exporter textfile collector
+        def prometheus(self, summary):
+                lines = []
+
+                def histogram(name, help_text, series):
+                        lines.append(f"# HELP {name} {help_text}")
+                        lines.append(f"# TYPE {name} histogram")
+                        for labels, data in series:
+                                for bound, count in zip(LATENCY_BUCKETS, data.buckets):
+                                        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+                                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {data.count}')
+                                lines.append(f"{name}_sum{{{labels}}} {round(data.sum, 6)}")
+                                lines.append(f"{name}_count{{{labels}}} {data.count}")
+
+                with self.lock:
+                        histogram("netbox_discovery_phase_seconds", "Time spent per phase", [(f'phase="{phase}"', data) for phase, data in sorted(self.phases.items())])
+                        histogram("netbox_discovery_api_latency_seconds", "Latency of the Netbox API requests", [(f'method="{method}",endpoint="{endpoint}"', data) for (method, endpoint), data in sorted(self.latency.items())])
+                        lines.append("# HELP netbox_discovery_api_requests_total Netbox API requests")
+                        lines.append("# TYPE netbox_discovery_api_requests_total counter")
+                        for (method, endpoint, status), count in sorted(self.requests.items()):
+                                lines.append(f'netbox_discovery_api_requests_total{{method="{method}",endpoint="{endpoint}",status="{status}"}} {count}')
+                        lines.append("# HELP netbox_discovery_device_phase_seconds Time spent per device and phase in the last run")
+                        lines.append("# TYPE netbox_discovery_device_phase_seconds gauge")
+                        for device, data in sorted(self.devices.items()):
+                                for phase, seconds in sorted(data["phases"].items()):
+                                        lines.append(f'netbox_discovery_device_phase_seconds{{device="{device}",phase="{phase}"}} {round(seconds, 6)}')
+                        lines.append("# HELP netbox_discovery_device_api_requests Netbox API requests per device in the last run")
+                        lines.append("# TYPE netbox_discovery_device_api_requests gauge")
+                        for device, data in sorted(self.devices.items()):
+                                lines.append(f'netbox_discovery_device_api_requests{{device="{device}"}} {data["requests"]}')
+                lines.append("# HELP netbox_discovery_devices Devices of the last run by result")
+                lines.append("# TYPE netbox_discovery_devices gauge")
+                lines.append(f'netbox_discovery_devices{{result="succeeded"}} {len(summary["succeeded"])}')
+                lines.append(f'netbox_discovery_devices{{result="failed"}} {len(summary["failed"])}')
+                lines.append("# HELP netbox_discovery_peak_rss_bytes Peak resident memory of the last run, workers is the biggest process of the process pool")
+                lines.append("# TYPE netbox_discovery_peak_rss_bytes gauge")
+                for process, megabytes in summary.get("memory", {}).items():
+                        lines.append(f'netbox_discovery_peak_rss_bytes{{process="{process[:-3]}"}} {int(megabytes * 2**20)}')
+                if summary.get("limiter"):
+                        lines.append("# HELP netbox_discovery_limiter Rate limiter towards Netbox at the end of the last run, rate 0 means no limit")
+                        lines.append("# TYPE netbox_discovery_limiter gauge")
+                        for key, value in summary["limiter"].items():
+                                lines.append(f'netbox_discovery_limiter{{value="{key}"}} {value}')
+                lines.append("# HELP netbox_discovery_run_duration_seconds Duration of the last run")
+                lines.append("# TYPE netbox_discovery_run_duration_seconds gauge")
+                lines.append(f"netbox_discovery_run_duration_seconds {summary['duration']}")
+                lines.append("# HELP netbox_discovery_last_run_timestamp_seconds End of the last run")
+                lines.append("# TYPE netbox_discovery_last_run_timestamp_seconds gauge")
+                lines.append(f"netbox_discovery_last_run_timestamp_seconds {int(time.time())}")
+                return "\n".join(lines) + "\n"
+
+        # Gesamtzeit pro Bereich, damit man sieht ob SSH, Genie oder Netbox langsam war
+        def breakdown(self):
+                with self.lock:
+                        totals = Counter()
+                        for phase, histogram in self.phases.items():
+                                area = phase.split(".")[0]
+                                # "reconcile" misst das ganze Gerät, die Abschnitte sind darin enthalten
+                                if area != "reconcile" or phase == "reconcile":
+                                        totals[area] += histogram.sum
+                        return {area: round(seconds, 2) for area, seconds in totals.items()}, sum(self.requests.values())
+
+        # metrics.json und netbox_discovery.prom in den Ordner schreiben, beides atomar
+        def write(self, metrics_dir, summary):
+                os.makedirs(metrics_dir, exist_ok=True)
+                run = {key: value for key, value in summary.items() if key != "started"}
+                run["metrics"] = self.toDict()
+                files = {"metrics.json": json.dumps(run, indent=2, default=str), "netbox_discovery.prom": self.prometheus(summary)}
+                for name, content in files.items():
+                        path = os.path.join(metrics_dir, name)
+                        with open(path + ".tmp", "w", encoding="utf-8") as f:
+                                f.write(content)
+                        os.replace(path + ".tmp", path)
+                logging.info(f"Metrics written to {metrics_dir}")
+
+METRICS = Metrics()
+
+# ---- Rate Limiter für die Requests an Netbox ----
+# Token Bucket für die Rate, dazu eine Grenze wie viele Requests gleichzeitig unterwegs sind
+# Adaptiv wie bei TCP: bei 429/503, Timeouts oder langsamen Antworten wird beides halbiert, höchstens einmal pro Sekunde,
+# danach geht es pro ruhiger Sekunde um einen Request gleichzeitig und 10% Rate wieder hoch bis zu den eingestellten Werten
+# Ohne feste Rate wird beim ersten Senken die Rate der letzten 100 Requests als Ausgangswert genommen
+class RateLimiter:
+        COOLDOWN = 1.0
+
+        def __init__(self, rate=0, burst=20, concurrency=8, adaptive=True, slow=5.0):
+                self.condition = threading.Condition()
+                self.maxRate = rate or None
+                self.rate = self.maxRate
+                self.ceiling = None
+                self.burst = max(1, burst)
+                self.tokens = self.burst
+                self.maxConcurrency = concurrency
+                self.concurrency = concurrency
+                self.adaptive = adaptive
+                self.slow = slow
+                self.inflight = 0
+                self.updated = time.monotonic()
+                self.changed = self.updated
+                self.recent = deque(maxlen=100)
+                self.counts = Counter()
+                self.waited = 0.0
+
+        def refill(self, now):
+                if self.rate:
+                        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+        def acquire(self):
+                started = time.monotonic()
+                with self.condition:
+                        while True:
+                                now = time.monotonic()
+                                self.refill(now)
+                                if self.inflight >= self.concurrency:
+                                        # Warten bis ein Request fertig ist, release() weckt auf
+                                        self.condition.wait()
+                                elif self.rate and self.tokens < 1:
+                                        self.condition.wait((1 - self.tokens) / self.rate)
+                                else:
+                                        break
+                        if self.rate:
+                                self.tokens -= 1
+                        self.inflight += 1
+                        self.recent.append(now)
+                        self.counts["requests"] += 1
+                        self.waited += now - started
+
+        # statuses sind alle Antworten inklusive der Wiederholungen von urllib3, None wenn der Request gar keine Antwort bekam
+        def release(self, statuses, seconds):
+                with self.condition:
+                        self.inflight -= 1
+                        struggling = False
+                        if statuses is None or any(status in (429, 503) for status in statuses):
+                                self.counts["throttled"] += 1
+                                struggling = True
+                        elif seconds > self.slow:
+                                self.counts["slow"] += 1
+                                struggling = True
+                        if self.adaptive:
+                                if struggling:
+                                        self.decrease(time.monotonic())
+                                else:
+                                        self.increase(time.monotonic())
+                        self.condition.notify_all()
+
+        def decrease(self, now):
+                if now - self.changed < self.COOLDOWN:
+                        return
+                if self.rate is None:
+                        self.ceiling = len(self.recent) / max(now - self.recent[0], 1.0) if self.recent else 1.0
+                        self.rate = self.ceiling
+                self.rate = max(1.0, self.rate / 2)
+                self.tokens = min(self.tokens, 1)
+                self.concurrency = max(1, self.concurrency // 2)
+                self.changed = now
+                self.counts["lowered"] += 1
+                logging.warning(f"Netbox is struggling, lowering to {self.rate:.1f} requests/s and {self.concurrency} requests at the same time")
+
+        def increase(self, now):
+                if now - self.changed < self.COOLDOWN or (self.rate == self.maxRate and self.concurrency == self.maxConcurrency):
+                        return
+                self.concurrency = min(self.maxConcurrency, self.concurrency + 1)
+                if self.rate is not None:
+                        self.rate = max(self.rate * 1.1, self.rate + 1)
+                        if self.maxRate:
+                                self.rate = min(self.rate, self.maxRate)
+                        elif self.rate >= self.ceiling:
+                                # Wieder so schnell wie vor dem Senken, dann gibt es auch keine Grenze mehr
+                                self.rate = None
+                self.changed = now
+                self.counts["raised"] += 1
+                if self.rate == self.maxRate and self.concurrency == self.maxConcurrency:
+                        logging.info("Netbox recovered, back to the configured request rate and concurrency")
+
+        def stats(self):
+                with self.condition:
+                        return {
+                                "rate": round(self.rate or 0, 2),
+                                "max_rate": self.maxRate or 0,
+                                "concurrency": self.concurrency,
+                                "max_concurrency": self.maxConcurrency,
+                                "requests": self.counts["requests"],
+                                "throttled": self.counts["throttled"],
+                                "slow": self.counts["slow"],
+                                "lowered": self.counts["lowered"],
+                                "raised": self.counts["raised"],
+                                "waited_seconds": round(self.waited, 2),
+                        }
+
+# ---- HTTPAdapter der jeden Request durch den RateLimiter schickt ----
+# Die Wiederholungen macht urllib3 innerhalb von send(), deren Status steht in der Retry History der Antwort
+class LimitedAdapter(HTTPAdapter):
+        def __init__(self, limiter, **kwargs):
+                self.limiter = limiter
+                super().__init__(**kwargs)
+
+        def send(self, request, **kwargs):
+                self.limiter.acquire()
+                started = time.monotonic()
+                statuses = None
+                try:
+                        response = super().send(request, **kwargs)
+                        retries = getattr(response.raw, "retries", None)
+                        statuses = [entry.status for entry in retries.history] if retries else []
+                        statuses.append(response.status_code)
+                        return response
+                finally:
+                        self.limiter.release(statuses, time.monotonic() - started)
+
+# ---- Funktion um die Verbindung zu Netbox aufzubauen ----
+# Eine Session mit einem Pool von Keep-Alive Verbindungen, so groß wie die erlaubten gleichzeitigen Requests
+# 429 und 5xx werden mit Backoff wiederholt (Retry-After wird beachtet), POST nicht, sonst gibt es doppelte Objekte
+# Alle Requests gehen durch den RateLimiter, sein Zustand landet in den Metriken
+def connectNetbox(url, token, concurrency=NETBOX_CONCURRENCY, retries=NETBOX_RETRIES, verify=NETBOX_VERIFY, rate=NETBOX_RATE, burst=NETBOX_BURST, adaptive=NETBOX_ADAPTIVE):
+        api = pynetbox.api(url=url, token=token) # Netbox API Verbindung
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["HEAD", "GET", "PUT", "PATCH", "DELETE", "OPTIONS"], respect_retry_after_header=True, raise_on_status=False)
+        limiter = RateLimiter(rate, burst, concurrency, adaptive, NETBOX_SLOW)
+        adapter = LimitedAdapter(limiter, pool_connections=concurrency, pool_maxsize=concurrency, max_retries=retry)
+        METRICS.limiter = limiter
+        api.http_session.mount("http://", adapter)
+        api.http_session.mount("https://", adapter)
+        api.http_session.hooks["response"].append(METRICS.responseHook)
+        if verify.lower() in ("false", "0", "no"):
+                urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning) # HTTP Warnung ausmachen
+                api.http_session.verify = False # Keine Zertifikate checken
+        elif verify.lower() not in ("true", "1", "yes"):
+                api.http_session.verify = verify # Eigenes CA Bundle
+        return api
 
-# ---- Funktion um Testbed zu erstellen ----
-def MakeTestbed():
+logging.info("Connecting to Netbox")
+nb = connectNetbox(NETBOX_URL, NETBOX_TOKEN)
+
+# ---- Funktion um die Switche aus Netbox seitenweise zu holen ----
+# Gibt (Name, OS, IP) zurück sobald eine Seite da ist, ohne len() und ohne alles vorher zu laden
+# Site und Tag filtert Netbox, den Prefix prüfen wir selbst an der Primary IP, weil Netbox Geräte nicht danach filtern kann
+# Mit shards > 1 kommen nur die Switche von diesem Shard zurück, siehe shardOf()
+def switchSpecs(sites=None, tags=None, prefixes=None, shard=None, shards=1, shard_by="hash"):
+        filters = {"role": "switch"}
+        if sites:
+                filters["site"] = sites
+        if tags:
+                filters["tag"] = tags
+        networks = [ip_network(prefix) for prefix in prefixes or []]
+        logging.info(f"Getting devices with role 'switch' from Netbox" + (f" ({', '.join(f'{key}={value}' for key, value in filters.items() if key != 'role')})" if len(filters) > 1 else ""))
+        for switch in nb.dcim.devices.filter(**filters, limit=NetboxCache.PAGE_SIZE):
+                if shards > 1 and shardOf(switch.site.slug if shard_by == "site" else switch.name, shards) != shard:
+                        continue
+                primary_ip = switch.primary_ip4.address.split('/')[0] if switch.primary_ip4 else '0.0.0.0'
+                if networks and not any(ip_network(primary_ip).subnet_of(network) for network in networks):
+                        continue
+                os = (switch.custom_fields.get('OS') or "").lower()
+                os = os.replace("-", "")
+                # Nur Cisco Geräte verarbeiten
+                if 'ios' not in os:
+                        logging.debug(f"Skipping {switch.name}, OS '{os}' is not IOS or IOS-XE")
+                        continue
+                yield (switch.name, os, primary_ip)
+
+# ---- Funktion um den Shard eines Gerätes zu bestimmen ----
+# sha1 statt hash(), weil hash() pro Prozess anders ist und alle Worker Hosts auf das gleiche Ergebnis kommen müssen
+def shardOf(key, shards):
+        return int(hashlib.sha1(key.encode()).hexdigest(), 16) % shards
+
+# ---- Funktion um Genie Geräte in Blöcken zu erstellen ----
+# Genie load() wird pro Block von shard_size Geräten aufgerufen, erst wenn der Block gebraucht wird
+# Dadurch geht es sofort los und es sind nie mehr als ein paar Blöcke Genie Geräte im Speicher
+def streamTestbed(specs, shard_size=100):
+        shard = []
+        for spec in specs:
+                shard.append(spec)
+                if len(shard) >= shard_size:
+                        yield from loadShard(shard)
+                        shard = []
+        if shard:
+                yield from loadShard(shard)
+
+def loadShard(shard):
+        tb = testbedTemplate()
+        for device_name, dev_os, ip in shard:
+                tb["devices"][device_name] = testbedDevice(dev_os, ip)
+        logging.debug(f"Loading {len(shard)} devices into Genie")
+        tb = load(tb)
+        for device_name, dev_os, ip in shard:
+                yield tb.devices[device_name]
+
+# ---- Funktion um ein leeres Testbed zu erstellen ----
+def testbedTemplate():
         # Unser Default testbed mit Zugangsdaten
-        tb = {
+        return {
                 "testbed": {
                         "name": "NetboxTestbed",
                         "credentials": {
@@ -52,86 +438,122 @@ def MakeTestbed():
                 "devices": {}
         }
 
-        logging.info("Getting devices with role 'switch' from Netbox")
-        switch_role_id = nb.dcim.device_roles.get(slug='switch').id
-        nb_switches = nb.dcim.devices.filter(role_id=switch_role_id)
-        logging.info(f"Found {len(nb_switches)} devices with role 'switch'. Adding them to the testbed")
-        for switch in nb_switches:
-                # Switche unter devices in das Testbed einfügen
-                primary_ip = switch.primary_ip4.address.split('/')[0] if switch.primary_ip4 else '0.0.0.0'
-                os = switch.custom_fields['OS'].lower()
-                os = os.replace("-", "")
-                tb["devices"][switch.name] = {
-                        "type": "switch",
-                        "os": os,
-                        "connections": {
-                                "cli": {
-                                        "protocol": "ssh",
-                                        "ip": primary_ip
-                                }
+# ---- Funktion um einen Switch Eintrag für das Testbed zu erstellen ----
+def testbedDevice(dev_os, ip):
+        return {
+                "type": "switch",
+                "os": dev_os,
+                "connections": {
+                        "cli": {
+                                "protocol": "ssh",
+                                "ip": ip
                         }
                 }
+        }
 
-        logging.debug(f"TESTBED:\n {tb}")
-        return tb
-
-# ---- Funktion um Site ID zu setzen ----
-def setSite(prefix_nb, prefix_str):
-        # Wenn Prefix existiert, dann Site ID setzen, ansonsten Default Site ID setzen
-        if prefix_nb != None:
-                if prefix_nb.site != None:
-                        logging.info(f"Site found for Prefix {prefix_str} with ID {prefix_nb.site.id} and Name {prefix_nb.site.name}, setting Site ID.")
-                        st = prefix_nb.site.id
-                        return st
+# ---- Funktion um ein einzelnes Genie Gerät zu erstellen ----
+# Für Geräte die erst beim Crawlen gefunden werden, läuft auch im Process Pool, weil Genie Geräte sich nicht pickeln lassen
+def makeDevice(device_name, dev_os, ip):
+        tb = testbedTemplate()
+        tb["devices"][device_name] = testbedDevice(dev_os, ip)
+        return load(tb).devices[device_name]
+
+# Site für Geräte, deren IP in keinem Prefix mit Site liegt
+DEFAULT_SITE = int(os.getenv("DEFAULT_SITE", 5))
+
+# ---- Funktion um die Site eines Prefixes zu holen ----
+# Bis Netbox 4.1 hat ein Prefix ein Feld "site", ab 4.2 einen Scope, der auch eine Site sein kann
+def prefixSite(prefix):
+        values = prefix.__dict__
+        if values.get("scope_type") == "dcim.site":
+                return values.get("scope_id")
+        return fieldId(values.get("site"))
+
+# ---- Index aller Prefixe für Longest Prefix Match ----
+# Alle Prefixe werden einmal pro Lauf aus dem Cache geladen, danach braucht eine Suche keinen Request mehr
+# Pro Maskenlänge ein Dictionary (Netzadresse -> Prefix), gesucht wird von der längsten Maske abwärts, also höchstens 32 (bzw. 128) Zugriffe
+# Damit bekommt jede IP ihren echten Prefix samt Maske statt dem festen /24
+class PrefixIndex:
+        def __init__(self, cache):
+                self.cache = cache
+                self.lock = threading.Lock()
+                self.tables = None
+
+        def load(self):
+                tables = {4: {}, 6: {}}
+                for prefix in self.cache.all("ipam.prefixes"):
+                        network = ip_network(str(prefix.__dict__.get("prefix")), strict=False)
+                        tables[network.version].setdefault(network.prefixlen, {}).setdefault(int(network.network_address), (network, prefixSite(prefix)))
+                self.tables = {version: sorted(table.items(), reverse=True) for version, table in tables.items()}
+                logging.debug(f"Loaded {sum(len(table) for _, table in self.tables[4] + self.tables[6])} prefixes into the prefix index")
+
+        # Gibt (Prefix, Site ID) des kleinsten Prefixes zurück, in dem die IP liegt, oder (None, None)
+        def lookup(self, ip):
+                with self.lock:
+                        if self.tables is None:
+                                self.load()
+                address = ip_address(ip)
+                for length, table in self.tables[address.version]:
+                        host_bits = address.max_prefixlen - length
+                        match = table.get(int(address) >> host_bits << host_bits)
+                        if match:
+                                return match
+                return None, None
+
+        # IP Adresse mit der Maske ihres Prefixes, ohne Prefix wie bisher /24
+        def address(self, ip):
+                network, site_id = self.lookup(ip)
+                return f"{ip}/{network.prefixlen if network else 24}"
+
+        # Site ID des Prefixes, ansonsten die Default Site
+        def site(self, ip):
+                network, site_id = self.lookup(ip)
+                if network is None:
+                        logging.info(f"No Prefix found for {ip}, setting default Site ID {DEFAULT_SITE}")
+                elif site_id is None:
+                        logging.info(f"Site not found for Prefix {network}, setting default Site ID {DEFAULT_SITE}")
                 else:
-                        logging.info(f"Site not found for Prefix {prefix_str}, setting default Site ID 5 with Name 'Unknown'")
-                        st = 5
-                        return st
-        else:
-                logging.info(f"Prefix {prefix_str} not found, setting default Site ID 5 with Name 'Unknown'")
-                st = 5
-                return st
-
-# ---- Funktion um Interface Typen zu sortieren ----
-def sortInterface(interface,mode):
-        # Muss zwei modes erstellen, da bei CDP Nachbarn nur die Interface Namen genutzt werden kann um den Spec zu bestimmen
-        if mode == "device":
-                match interface:
-                        case "10/100/1000BaseTX":
-                                return "1000base-tx"
-                        case "1000BaseSX SFP":
-                                return "1000base-x-sfp"
-                        case "10/100BaseTX":
-                                return "100base-tx"
-                        case "SFP-10GBase-LR":
-                                return "10gbase-x-sfpp"
-                        case "SFP-10GBase-SR":
-                                return "10gbase-x-sfpp"
-                        case "SFP-10GBase-LRM":
-                                return "10gbase-x-sfpp"
-                        case "SFP-10GBase-CX1":
-                                return "10gbase-x-sfpp"
-                        case "100/1000/2.5G/5G/10GBaseTX":
-                                return "10gbase-t"
-                        case "unknown":
-                                return "other"
-                        case "Not Present":
-                                return "other"
-                        case _:
-                                return "virtual"
-        elif mode == "cdp":
-                if "TenGigabitEthernet" in interface:
-                        return "10gbase-t"
-                elif "FastEthernet" in interface:
-                        return "100base-tx"
-                elif "GigabitEthernet" in interface:
-                        return "1000base-tx"
-                elif "mgmt" in interface:
-                        return "other"
-                else:
-                        return "virtual"
-        else:
-                return "other"
+                        logging.info(f"Site found for Prefix {network} with ID {site_id}, setting Site ID.")
+                return site_id or DEFAULT_SITE
+
+# ---- Tabelle für die Netbox Interface Typen ----
+# Kommt aus interface_types.json (oder INTERFACE_TYPES), neue Typen also dort eintragen und nicht hier
+# "media" sind genaue Treffer auf den Typ aus "show interfaces status", "media_rules" Regex darauf der Reihe nach
+# "names" sind Anfänge von Interface Namen (lang und kurz, IOS und NX-OS), danach muss eine Zahl kommen, z.B. "Gi1/0/1" aber nicht "Port-channel" für "Po"
+# Der längste passende Anfang gewinnt, alles in einem vorher kompilierten Regex
+class InterfaceTypes:
+        def __init__(self, path):
+                with open(path) as file:
+                        table = json.load(file)
+                self.media = table["media"]
+                self.mediaRules = [(re.compile(pattern, re.IGNORECASE), netbox_type) for pattern, netbox_type in table["media_rules"]]
+                self.names = {prefix.lower(): netbox_type for prefix, netbox_type in table["names"].items()}
+                prefixes = sorted(self.names, key=len, reverse=True)
+                self.namePattern = re.compile(r"^(" + "|".join(re.escape(prefix) for prefix in prefixes) + r")\s*\d", re.IGNORECASE)
+
+        # Zuerst der Medientyp vom Gerät, wenn der fehlt oder unbekannt ist der Name
+        # Nur was gar nicht passt wird wie früher "virtual"
+        def classify(self, name=None, media=None):
+                if media:
+                        if media in self.media:
+                                return self.media[media]
+                        for pattern, netbox_type in self.mediaRules:
+                                if pattern.search(media):
+                                        return netbox_type
+                if name:
+                        match = self.namePattern.match(name)
+                        if match:
+                                return self.names[match.group(1).lower()]
+                return "virtual"
+
+INTERFACE_TYPES = InterfaceTypes(os.getenv("INTERFACE_TYPES", os.path.join(os.path.dirname(os.path.abspath(__file__)), "interface_types.json")))
+
+# ---- Funktion um den Netbox Typ eines Interfaces zu bestimmen ----
+# Pro Lauf kommen immer wieder die gleichen Namen und Typen vor, deshalb wird jede Kombination nur einmal ausgewertet
+# Bei CDP Nachbarn gibt es nur den Namen
+@lru_cache(maxsize=65536)
+def interfaceType(name=None, media=None):
+        return INTERFACE_TYPES.classify(name, media)
 
 # ---- Funktion um Farben für Geräte Rollen zu wählen ----
 def pickColor():
@@ -162,197 +584,1243 @@ def pickColor():
         used_colors.append(color)
         return color
 
-# ---- Funktion um halbverbundene Kabel zu entfernen ----
-def removeLooseCables():
-        logging.info(f"Removing all loose cables...")
-        # Schauen ob es Kabel mit unvollständigen Terminierungen gibt und diese löschen
-        cables = nb.dcim.cables.all()
-        for cable in cables:
-                if not cable.a_terminations or not cable.b_terminations:
-                        logging.info(f"Removing cable with ID {cable.id} because it has loose terminations")
-                        cable.delete()
+# ---- Funktion um die ID aus einem Feld zu holen ----
+# Pynetbox liefert verschachtelte Objekte, nach einem save() steht im Feld aber oft nur noch die ID
+def fieldId(value):
+        return getattr(value, "id", value)
+
+# Wie viele Geräte ihre Interfaces, Module und Inventory Items gleichzeitig im Cache haben
+# Mehr Geräte sparen Requests bei Nachbarn die später dran sind, kosten aber Speicher (bei 8er Stacks ein paar hundert Objekte pro Gerät)
+DEVICE_CACHE_SIZE = int(os.getenv("DEVICE_CACHE_SIZE", "50"))
+
+# ---- Zwischenspeicher für Netbox Objekte ----
+# Jeder Endpoint wird einmal pro Lauf (bzw. einmal pro Gerät) seitenweise geladen, danach kommen alle Abfragen aus dem Speicher
+# Alles was das Skript erstellt oder löscht geht auch über den Cache, damit er mit Netbox übereinstimmt
+class NetboxCache:
+        PAGE_SIZE = 1000
+        # Endpoints die für den ganzen Lauf geladen werden, mit den Feldern nach denen gesucht wird
+        # "host" bei IP Adressen ist die Adresse ohne Maske, damit eine IP auch mit einer anderen Maske gefunden wird
+        RUN_ENDPOINTS = {
+                "dcim.platforms": ["slug"],
+                "dcim.device_types": ["slug"],
+                "dcim.device_roles": ["slug"],
+                "dcim.devices": ["name"],
+                "dcim.module_types": ["model"],
+                "ipam.vlans": ["vid"],
+                "ipam.ip_addresses": ["address", "host"],
+                "ipam.prefixes": ["prefix"],
+        }
+        # Endpoints die pro Gerät geladen werden, gesucht wird immer mit (device_id, Feld)
+        DEVICE_ENDPOINTS = {
+                "dcim.interfaces": ["name"],
+                "dcim.module_bays": ["name"],
+                "dcim.modules": ["module_bay"],
+                "dcim.inventory_items": ["serial"],
+        }
 
-# ---- Funktion um Inventory zu erstellen ----
-def createInventory(invpar,hostname,host,stacked):
-        logging.info(f"Adding inventory of {hostname}...")
-        # Liste für Seriennummern der Sachen in Netbox machen
-        netbox_sns = []
-        switch_sns = []
-
-        # Seriennummern der Inventory Items in Netbox holen
-        inventory_items = nb.dcim.inventory_items.filter(device_id=host.id)
-        for item in inventory_items:
-            if item.serial:
-                netbox_sns.append(item.serial)
-
-        # Seriennummern der Module im Switch holen
-        if tb.devices[hostname].os == 'ios':
-                for slot, slot_data in invpar['slot'].items():
-                        for rp, rp_data in slot_data['rp'].items():
-                                inv_serial = rp_data['sn']
-                                switch_sns.append(inv_serial)
-        elif tb.devices[hostname].os == 'iosxe':
-                for name, data in invpar['name'].items():
-                        inv_serial = data['sn']
-                        switch_sns.append(inv_serial)
-
-        # Seriennummern die in Netbox sind, aber nicht im Switch sind löschen
-        serials_to_delete = set(netbox_sns) - set(switch_sns)
-        for serial in serials_to_delete:
-                inventory_item = nb.dcim.inventory_items.get(serial=serial)
-                if inventory_item:
-                        logging.info(f"Deleting inventory item with Serial {serial} as it is not in switch_sns")
-                        inventory_item.delete()
-        # Für jedes Inventory Item
-        # Unterschiedliche Methoden für IOS und IOSXE, da die Daten anders strukturiert sind
-        if tb.devices[hostname].os == 'ios':
+        def __init__(self, nb):
+                self.nb = nb
+                self.lock = threading.RLock()
+                self.indexes = {}
+                self.records = {}
+                self.loaded = set()
+                # Geräte mit Objekten im Cache, das zuletzt benutzte am Ende
+                self.devices = OrderedDict()
+                self.hits = Counter()
+                self.misses = Counter()
+                self.keyLocks = {}
+                self.loadLocks = {}
+                self.writer = BulkWriter(self)
+                self.vlans = VlanReconciler(self)
+                self.neighbors = NeighborRegistry()
+                self.prefixes = PrefixIndex(self)
+
+        def endpoint(self, name):
+                app, endpoint = name.split(".")
+                return getattr(getattr(self.nb, app), endpoint)
+
+        # Endpoints ohne Index (z.B. Kabel) werden nur über den BulkWriter geschrieben
+        def fields(self, name):
+                return self.RUN_ENDPOINTS.get(name) or self.DEVICE_ENDPOINTS.get(name, [])
+
+        def scope(self, name, device_id=None):
+                return name if device_id is None else (name, device_id)
+
+        def key(self, name, record, field):
+                if field == "host":
+                        value = str(record.address).split("/")[0]
+                else:
+                        value = str(fieldId(getattr(record, field, None)))
+                if name in self.DEVICE_ENDPOINTS:
+                        return (fieldId(record.device), value)
+                return value
+
+        def add(self, name, record):
+                device_id = fieldId(record.device) if name in self.DEVICE_ENDPOINTS else None
+                with self.lock:
+                        self.touch(device_id)
+                        self.records.setdefault(self.scope(name, device_id), {})[record.id] = record
+                        for field in self.fields(name):
+                                self.indexes.setdefault((name, field), {}).setdefault(self.key(name, record, field), record)
+                return record
+
+        def remove(self, name, record):
+                device_id = fieldId(record.device) if name in self.DEVICE_ENDPOINTS else None
+                with self.lock:
+                        self.records.get(self.scope(name, device_id), {}).pop(record.id, None)
+                        for field in self.fields(name):
+                                index = self.indexes.get((name, field), {})
+                                key = self.key(name, record, field)
+                                if fieldId(index.get(key)) == record.id:
+                                        del index[key]
+
+        # Gerät als zuletzt benutzt markieren, das am längsten nicht benutzte Gerät fliegt raus wenn es zu viele sind
+        # Im Plan Modus gibt es neue Objekte nur im Cache, dann wird nichts freigegeben
+        def touch(self, device_id):
+                if device_id is None:
+                        return
+                self.devices[device_id] = True
+                self.devices.move_to_end(device_id)
+                while len(self.devices) > DEVICE_CACHE_SIZE and PLAN is None:
+                        self.release(self.devices.popitem(last=False)[0])
+
+        # Alle Objekte eines Gerätes aus dem Cache nehmen, beim nächsten Zugriff werden sie wieder aus Netbox geladen
+        def release(self, device_id):
+                with self.lock:
+                        for name in self.DEVICE_ENDPOINTS:
+                                scope = self.scope(name, device_id)
+                                for record in list(self.records.get(scope, {}).values()):
+                                        self.remove(name, record)
+                                self.records.pop(scope, None)
+                                self.loaded.discard(scope)
+                                self.loadLocks.pop(scope, None)
+                        self.devices.pop(device_id, None)
+
+        # Endpoint (bzw. alle Objekte eines Gerätes) einmal seitenweise aus Netbox laden
+        # Pro Scope ein eigenes Lock, geholt wird ohne das globale Lock, damit z.B. die Nachbarn ihre Interfaces gleichzeitig laden können
+        # Das globale Lock braucht es nur zum Einsortieren, Objekte die inzwischen geschrieben wurden gewinnen dabei
+        def load(self, name, device_id=None):
+                scope = self.scope(name, device_id)
+                with self.lock:
+                        self.touch(device_id)
+                        if scope in self.loaded:
+                                return
+                        lock = self.loadLocks.setdefault(scope, threading.Lock())
+                with lock:
+                        with self.lock:
+                                if scope in self.loaded:
+                                        return
+                        if device_id is None:
+                                records = list(self.endpoint(name).all(limit=self.PAGE_SIZE))
+                        # Geräte die erst im Plan erstellt werden, haben in Netbox noch nichts
+                        elif device_id < 0:
+                                records = []
+                        else:
+                                records = list(self.endpoint(name).filter(device_id=device_id, limit=self.PAGE_SIZE))
+                        with self.lock:
+                                known = self.records.setdefault(scope, {})
+                                for record in records:
+                                        if record.id not in known:
+                                                self.add(name, record)
+                                for field in self.fields(name):
+                                        self.indexes.setdefault((name, field), {})
+                                self.loaded.add(scope)
+                                self.misses[name] += 1
+                logging.debug(f"Loaded {len(records)} objects from {name}" + (f" for device {device_id}" if device_id else ""))
+
+        # Ein Objekt über genau ein Feld suchen, z.B. get("dcim.platforms", slug="c9300") oder get("dcim.interfaces", device_id=1, name="Vlan1")
+        # Hat ein anderer Thread das Gerät zwischen Laden und Suchen aus dem Cache genommen, wird es noch einmal geladen
+        def get(self, name, /, device_id=None, **lookup):
+                (field, value), = lookup.items()
+                key = str(value) if device_id is None else (device_id, str(value))
+                while True:
+                        self.load(name, device_id)
+                        with self.lock:
+                                if self.scope(name, device_id) in self.loaded:
+                                        self.hits[name] += 1
+                                        return self.indexes[(name, field)].get(key)
+
+        # Alle Objekte eines Endpoints bzw. eines Gerätes
+        def all(self, name, device_id=None):
+                while True:
+                        self.load(name, device_id)
+                        with self.lock:
+                                if self.scope(name, device_id) in self.loaded:
+                                        self.hits[name] += 1
+                                        return list(self.records[self.scope(name, device_id)].values())
+
+        # Schlägt das Erstellen fehl, weil ein anderer Worker das Objekt schon erstellt hat, wird dessen Objekt genommen
+        def create(self, name, /, **data):
+                try:
+                        record = PLAN.create(name, [data])[0] if PLAN is not None else self.endpoint(name).create(**data)
+                except pynetbox.core.query.RequestError:
+                        record = self.refetch(name, data)
+                        if record is None:
+                                raise
+                        return record
+                self.writer.counts[(name, "created")] += 1
+                self.writer.requests += 1
+                return self.add(name, record)
+
+        # Suchen und wenn nicht vorhanden erstellen, gibt (Objekt, erstellt) zurück
+        # Pro Schlüssel ein Lock, damit parallele Abfragen dasselbe Objekt nicht doppelt erstellen
+        def getOrCreate(self, name, lookup, /, device_id=None, **data):
+                (field, value), = lookup.items()
+                with self.lock:
+                        lock = self.keyLocks.setdefault((name, device_id, field, str(value)), threading.Lock())
+                with lock:
+                        record = self.get(name, device_id=device_id, **lookup)
+                        if record:
+                                return record, False
+                        return self.create(name, **data), True
+
+        # Jeder Worker eines verteilten Laufs hat seinen eigenen Cache und sieht nicht, was die anderen inzwischen erstellt haben
+        # Ohne das würde der Cache bis zum Ende des Laufs sagen dass z.B. eine Platform fehlt, und jedes weitere Erstellen scheitert an ihrem Slug
+        # Deshalb wird ein Objekt eines Lauf Endpoints nach einem Fehler beim Erstellen über seine Suchfelder aus Netbox geholt
+        def refetch(self, name, data):
+                if name not in self.RUN_ENDPOINTS or PLAN is not None:
+                        return None
+                for field in self.RUN_ENDPOINTS[name]:
+                        if data.get(field) is None:
+                                continue
+                        record = next(iter(self.endpoint(name).filter(**{field: data[field]})), None)
+                        if record is not None:
+                                logging.info(f"{describeItem(data)} was created in {name} in the meantime, using it")
+                                self.misses[name] += 1
+                                return self.add(name, record)
+                return None
+
+        # Einen Lauf Endpoint neu aus Netbox laden, z.B. weil andere Worker inzwischen etwas erstellt haben
+        # Im Plan Modus gibt es neue Objekte nur im Cache, dann bleibt er wie er ist
+        def refresh(self, name):
+                if PLAN is not None:
+                        return
+                with self.lock:
+                        if name not in self.loaded:
+                                return
+                        for record in list(self.records.get(name, {}).values()):
+                                self.remove(name, record)
+                        self.records.pop(name, None)
+                        self.loaded.discard(name)
+                self.load(name)
+
+        def delete(self, name, record):
+                if PLAN is not None:
+                        PLAN.delete(name, [record])
+                else:
+                        record.delete()
+                self.writer.counts[(name, "deleted")] += 1
+                self.writer.requests += 1
+                self.remove(name, record)
+
+        # Wie viele Abfragen aus dem Speicher beantwortet wurden und wie oft Netbox gefragt werden musste
+        def stats(self):
+                return {name: {"hits": self.hits[name], "misses": self.misses[name]} for name in sorted(set(self.hits) | set(self.misses))}
+
+# Textfelder die Netbox leer als "" zurückgibt, auch wenn None geschickt wurde
+EMPTY_STRING_FIELDS = ("label", "description", "serial", "part_id", "comments")
+
+# ---- Funktion um einen Wert aus Netbox vergleichbar zu machen ----
+# Auswahlfelder (type, status) haben einen value, verschachtelte Objekte eine ID
+# Nicht mit getattr nachschauen, sonst lädt pynetbox bei fehlenden Attributen das ganze Objekt nach
+def plainValue(value):
+        if isinstance(value, pynetbox.core.response.Record):
+                return value.__dict__.get("value", value.__dict__.get("id"))
+        return value
+
+# ---- Funktion um einen Wert für den Vergleich zu normalisieren ----
+def normalizeField(field, value):
+        value = plainValue(value)
+        if value is None and field in EMPTY_STRING_FIELDS:
+                return ""
+        # Zahlen aus den Geräte Ausgaben kommen als Text, z.B. VLAN IDs
+        if isinstance(value, str) and value.isdigit():
+                return int(value)
+        return value
+
+# ---- Funktion um die geänderten Felder eines Objektes zu finden ----
+# Custom Fields werden von Netbox beim PATCH zusammengeführt, deshalb werden nur die geänderten Keys geschickt
+def changedFields(record, desired):
+        changes = {}
+        for field, value in desired.items():
+                current = getattr(record, field, None)
+                if field == "custom_fields":
+                        current = current or {}
+                        custom = {key: val for key, val in value.items() if normalizeField(key, current.get(key)) != normalizeField(key, val)}
+                        if custom:
+                                changes[field] = custom
+                elif normalizeField(field, current) != normalizeField(field, value):
+                        changes[field] = value
+        return changes
+
+# ---- Sammelt Schreibzugriffe und schickt sie gebündelt an Netbox ----
+# Netbox nimmt bei POST/PATCH/DELETE auch Listen an, dadurch werden aus hunderten Requests ein paar wenige
+# Gezählt wird pro Endpoint wie viele Objekte erstellt, geändert, gelöscht oder unverändert übersprungen wurden
+class BulkWriter:
+        CHUNK_SIZE = 100
+
+        def __init__(self, cache):
+                self.cache = cache
+                self.creates = {}
+                self.updates = {}
+                self.deletes = {}
+                self.failed = []
+                self.counts = Counter()
+                self.requests = 0
+
+        def create(self, name, /, **data):
+                self.creates.setdefault(name, []).append(data)
+
+        # Gibt zurück ob sich etwas geändert hat, unveränderte Objekte werden gar nicht erst geschickt
+        def update(self, name, record, /, **desired):
+                changes = changedFields(record, desired)
+                if not changes:
+                        self.counts[(name, "unchanged")] += 1
+                        return False
+                self.updates.setdefault(name, []).append((record, changes))
+                return True
+
+        # Wie update, aber sofort schicken. Gibt das aktuelle Objekt zurück, weil es danach oft noch gebraucht wird
+        def save(self, name, record, /, **desired):
+                changes = changedFields(record, desired)
+                if not changes:
+                        self.counts[(name, "unchanged")] += 1
+                        return record
+                updated = self.send(name, "update", [(record, changes)])
+                return updated[0] if updated else record
+
+        def delete(self, name, record, /):
+                self.deletes.setdefault(name, []).append(record)
+
+        # Alles Gesammelte in Blöcken schicken, zuerst löschen damit neue Objekte mit gleichem Namen nicht kollidieren
+        def flush(self):
+                queues = [("delete", self.deletes), ("create", self.creates), ("update", self.updates)]
+                self.creates, self.updates, self.deletes = {}, {}, {}
+                for action, queue in queues:
+                        for name, items in queue.items():
+                                for start in range(0, len(items), self.CHUNK_SIZE):
+                                        self.send(name, action, items[start:start + self.CHUNK_SIZE])
+
+        def send(self, name, action, chunk):
+                endpoint = self.cache.endpoint(name)
+                records = []
+                try:
+                        self.requests += 1
+                        if action == "create":
+                                for record in PLAN.create(name, chunk) if PLAN is not None else endpoint.create(chunk):
+                                        records.append(self.cache.add(name, record))
+                        elif action == "update":
+                                records = PLAN.update(name, chunk) if PLAN is not None else endpoint.update([dict(changes, id=record.id) for record, changes in chunk])
+                                for (old, changes), record in zip(chunk, records):
+                                        self.cache.remove(name, old)
+                                        self.cache.add(name, record)
+                        else:
+                                if PLAN is not None:
+                                        PLAN.delete(name, chunk)
+                                else:
+                                        endpoint.delete([record.id for record in chunk])
+                                for record in chunk:
+                                        self.cache.remove(name, record)
+                except pynetbox.core.query.RequestError as e:
+                        # Bulk Requests sind in Netbox atomar, deshalb einzeln wiederholen um die fehlerhaften Objekte zu finden
+                        if len(chunk) > 1:
+                                logging.info(f"Bulk {action} on {name} failed, retrying {len(chunk)} objects one by one")
+                                # Fehlgeschlagene Objekte als None, damit die Liste weiter zum Chunk passt (braucht applyPlan)
+                                for item in chunk:
+                                        records += self.send(name, action, [item]) or [None]
+                                return records
+                        if action == "create":
+                                record = self.cache.refetch(name, chunk[0])
+                                if record is not None:
+                                        return [record]
+                        item = describeItem(chunk[0])
+                        logging.error(f"Error on {action} of {item} in {name}")
+                        logging.error(f"Exception: {e.error}")
+                        self.counts[(name, "failed")] += 1
+                        self.failed.append({"endpoint": name, "action": action, "object": item, "error": str(e.error)})
+                        return records
+                self.counts[(name, action + "d")] += len(chunk)
+                return records
+
+        # Summen über alle Endpoints und pro Endpoint
+        def stats(self):
+                totals = Counter()
+                endpoints = {}
+                for (name, action), count in self.counts.items():
+                        totals[action] += count
+                        endpoints.setdefault(name, {})[action] = count
+                return dict(totals, requests=self.requests, endpoints=endpoints)
+
+# ---- Objekt das im Plan Modus erstellt wurde ----
+# Hat statt einer ID aus Netbox eine negative Platzhalter ID, auf die spätere Änderungen im Plan verweisen
+# Felder die nicht geschickt wurden sind None, wie bei einem neuen Objekt in Netbox
+class PlannedRecord:
+        def __init__(self, values):
+                self.__dict__.update(values)
+
+        def __getattr__(self, name):
+                if name.startswith("__"):
+                        raise AttributeError(name)
+                return None
+
+        def __str__(self):
+                return str(self.name or self.address or self.model or self.id)
+
+# Version des Formats der Plan Dateien, ältere Pläne werden nicht angewendet
+PLAN_FORMAT = 1
+
+# ---- Geplante Änderungen für --plan und --apply ----
+# Im Plan Modus schickt der BulkWriter nichts an Netbox, sondern trägt jede Änderung hier ein und bekommt ein passendes Objekt zurück
+# Neue Objekte bekommen negative Platzhalter IDs, Verweise darauf (z.B. device=-3 bei einem neuen Interface) löst applyPlan wieder auf
+# Die Reihenfolge bleibt wie beim echten Lauf, damit Abhängigkeiten (erst Gerät, dann Interfaces, dann Kabel) stimmen
+class Changeset:
+        def __init__(self, changes=None, devices=None, fingerprints=None):
+                self.changes = changes or []
+                self.devices = devices or []
+                self.fingerprints = fingerprints or {}
+                self.lock = threading.Lock()
+                self.nextRef = -1 - len(self.changes)
+                # Stand der geplanten Objekte pro Endpoint (ID -> Objekt, None wenn gelöscht) für overlay()
+                self.objects = {}
+
+        def create(self, name, items):
+                records = []
+                with self.lock:
+                        for data in items:
+                                ref = self.nextRef
+                                self.nextRef -= 1
+                                record = PlannedRecord(dict(data, id=ref))
+                                self.changes.append({"action": "create", "endpoint": name, "ref": ref, "object": describeItem(data), "data": data})
+                                self.objects.setdefault(name, {})[ref] = record
+                                records.append(record)
+                return records
+
+        # Gibt Kopien der Objekte mit den Änderungen zurück, wie Netbox bei einem PATCH
+        def update(self, name, chunk):
+                records = []
+                with self.lock:
+                        for record, changes in chunk:
+                                self.changes.append({"action": "update", "endpoint": name, "id": record.id, "object": str(record), "data": changes})
+                                updated = object.__new__(type(record))
+                                updated.__dict__.update(record.__dict__)
+                                for field, value in changes.items():
+                                        if field == "custom_fields":
+                                                value = dict(record.custom_fields or {}, **value)
+                                        setattr(updated, field, value)
+                                self.objects.setdefault(name, {})[record.id] = updated
+                                records.append(updated)
+                return records
+
+        def delete(self, name, records):
+                with self.lock:
+                        for record in records:
+                                self.changes.append({"action": "delete", "endpoint": name, "id": record.id, "object": str(record)})
+                                self.objects.setdefault(name, {})[record.id] = None
+
+        # Objekte die direkt aus Netbox gelesen werden (nicht über den Cache, z.B. Kabel), mit den schon geplanten Änderungen
+        # Sonst würde z.B. ein Kabel, das schon vom anderen Ende aus geplant ist, noch einmal geplant
+        # Neue oder umgehängte Objekte die nicht in records waren kommen nur dazu, wenn keep(objekt) stimmt
+        def overlay(self, name, records, keep):
+                with self.lock:
+                        planned = dict(self.objects.get(name, {}))
+                merged = {record.id: record for record in records}
+                fetched = set(merged)
+                merged.update(planned)
+                return [record for record_id, record in merged.items() if record is not None and (record_id in fetched or keep(record))]
+
+        # Anzahl der Änderungen pro Endpoint und Aktion, für das Log
+        def stats(self):
+                return Counter((change["endpoint"], change["action"]) for change in self.changes)
+
+        def save(self, path):
+                plan = {"format": PLAN_FORMAT, "created": datetime.now(timezone.utc).isoformat(), "netbox": NETBOX_URL, "devices": self.devices, "fingerprints": self.fingerprints, "changes": self.changes}
+                # Erst in temporäre Datei schreiben, damit ein abgebrochener Lauf keinen halben Plan hinterlässt
+                with open(path + ".tmp", "w", encoding="utf-8") as f:
+                        json.dump(plan, f, indent=1, default=lambda value: getattr(value, "id", str(value)))
+                os.replace(path + ".tmp", path)
+                logging.info(f"Plan with {len(self.changes)} changes for {len(self.devices)} devices written to {path}")
+
+        @staticmethod
+        def load(path):
+                with open(path, encoding="utf-8") as f:
+                        plan = json.load(f)
+                if plan.get("format") != PLAN_FORMAT:
+                        raise ValueError(f"Plan {path} has format {plan.get('format')}, expected {PLAN_FORMAT}")
+                if plan.get("netbox") != NETBOX_URL:
+                        logging.warning(f"Plan {path} was made for {plan.get('netbox')}, applying it to {NETBOX_URL}")
+                return Changeset(plan["changes"], plan["devices"], plan["fingerprints"])
+
+# Geplante Änderungen im Plan Modus, wird in main gesetzt. Ohne Plan wird direkt in Netbox geschrieben
+PLAN = None
+
+# ---- Funktion um Platzhalter IDs in einer geplanten Änderung durch die echten IDs zu ersetzen ----
+# Wirft KeyError, wenn das Objekt hinter dem Platzhalter nicht erstellt werden konnte
+def resolveRefs(value, refs):
+        if isinstance(value, dict):
+                return {key: resolveRefs(val, refs) for key, val in value.items()}
+        if isinstance(value, list):
+                return [resolveRefs(val, refs) for val in value]
+        if isinstance(value, int) and not isinstance(value, bool) and value < 0:
+                return refs[value]
+        return value
+
+# Wo die VLANs der Switche in Netbox hingehören: "global" (wie bisher), "site" oder "group" (die VLAN Gruppe der Site)
+VLAN_SCOPE = os.getenv("VLAN_SCOPE", "global")
+
+# ---- VLANs für den ganzen Lauf ----
+# Die VLAN Tabellen aller Switche werden im Speicher zusammengeführt und erst am Ende des Laufs einmal abgeglichen
+# Schlüssel ist (VLAN Gruppe, Site, VID), damit gleiche VIDs an verschiedenen Sites verschiedene VLANs bleiben
+# Jedes VLAN bekommt so höchstens einen Request pro Lauf, egal auf wie vielen Switchen es ist
+# Pro Gerät wird gemerkt welche VLANs es braucht, damit apply() sagen kann bei welchen Geräten alles geschrieben wurde
+class VlanReconciler:
+        def __init__(self, cache):
+                self.cache = cache
+                self.scope = VLAN_SCOPE
+                self.wanted = {}
+                self.groups = None
+                self.devices = {}
+                # Fingerabdruck der VLAN Ausgabe pro Gerät, wird erst nach apply() gespeichert
+                self.fingerprints = {}
+
+        # (Gruppe, Site) unter der die VLANs eines Switches eingetragen werden
+        # Hat die Site bei "group" keine VLAN Gruppe, kommen die VLANs direkt an die Site
+        def scopeOf(self, host):
+                if self.scope == "global":
+                        return (None, None)
+                site_id = fieldId(host.site)
+                if self.scope == "group":
+                        if self.groups is None:
+                                self.groups = {group.__dict__.get("scope_id"): group.id for group in self.cache.all("ipam.vlan_groups") if group.__dict__.get("scope_type") == "dcim.site"}
+                        if site_id in self.groups:
+                                return (self.groups[site_id], None)
+                return (None, site_id)
+
+        # Nur merken, geschrieben wird erst mit apply()
+        def add(self, host, vlanpar, device_name=None):
+                group_id, site_id = self.scopeOf(host)
+                keys = self.devices.setdefault(device_name or host.name, set())
+                for vlan in vlanpar['vlans'].values():
+                        key = (group_id, site_id, int(vlan['vlan_id']))
+                        self.wanted.setdefault(key, Counter())[vlan['name']] += 1
+                        keys.add(key)
+
+        # Das VLAN das in Netbox zu einem Schlüssel passt
+        # Wie bisher: global passt jedes VLAN mit der VID, wenn es kein globales gibt
+        def existing(self, index, by_vid, key):
+                existing_vlan = index.get(key)
+                if existing_vlan is None and self.scope == "global":
+                        existing_vlan = by_vid.get(key[2])
+                return existing_vlan
+
+        def indexes(self):
+                index = {}
+                by_vid = {}
+                for vlan in self.cache.all("ipam.vlans"):
+                        group_id = fieldId(vlan.__dict__.get("group"))
+                        site_id = None if group_id else fieldId(vlan.__dict__.get("site"))
+                        index.setdefault((group_id, site_id, vlan.vid), vlan)
+                        by_vid.setdefault(vlan.vid, vlan)
+                return index, by_vid
+
+        # Vorhandene VLANs einmal laden und nur die Unterschiede mit Bulk Requests schicken
+        # Haben Switche verschiedene Namen für ein VLAN, gewinnt der häufigste
+        # Gibt (Geräte deren VLANs alle in Netbox sind, Geräte bei denen etwas fehlgeschlagen ist) zurück
+        # Fehler schluckt der BulkWriter, deshalb wird danach am Cache geprüft ob jedes VLAN mit dem richtigen Namen da ist
+        def apply(self):
+                wanted, self.wanted = self.wanted, {}
+                devices, self.devices = self.devices, {}
+                if not wanted:
+                        return list(devices), []
+                logging.info(f"Reconciling {len(wanted)} VLANs of this run")
+                # VLANs haben in Netbox kein eindeutiges Feld, ein Fehler beim Erstellen würde also nicht auffallen
+                # Deshalb direkt vorher neu laden, damit die VLANs die andere Worker inzwischen erstellt haben nicht doppelt angelegt werden
+                self.cache.refresh("ipam.vlans")
+                index, by_vid = self.indexes()
+                chosen = {}
+                for (group_id, site_id, vid), names in sorted(wanted.items(), key=lambda item: (str(item[0][0]), str(item[0][1]), item[0][2])):
+                        vlan_name = names.most_common(1)[0][0]
+                        chosen[(group_id, site_id, vid)] = vlan_name
+                        if len(names) > 1:
+                                logging.info(f"VLAN {vid} has different names on the switches ({', '.join(sorted(names))}), using {vlan_name}")
+                        existing_vlan = self.existing(index, by_vid, (group_id, site_id, vid))
+                        if existing_vlan:
+                                if self.cache.writer.update("ipam.vlans", existing_vlan, name=vlan_name):
+                                        logging.info(f"Name of VLAN {vid} is outdated, updating to {vlan_name}")
+                        else:
+                                logging.info(f"Creating VLAN {vlan_name} with ID {vid}")
+                                scope = {"group": group_id} if group_id else {"site": site_id} if site_id else {}
+                                self.cache.writer.create("ipam.vlans", name=vlan_name, vid=vid, **scope)
+                self.cache.writer.flush()
+
+                index, by_vid = self.indexes()
+                missing = {key for key, vlan_name in chosen.items() if getattr(self.existing(index, by_vid, key), "name", None) != vlan_name}
+                if missing:
+                        logging.error(f"{len(missing)} VLANs could not be written to Netbox: {', '.join(str(key[2]) for key in sorted(missing, key=lambda key: key[2]))}")
+                done = [device_name for device_name, keys in devices.items() if not keys & missing]
+                failed = [device_name for device_name, keys in devices.items() if keys & missing]
+                return done, failed
+
+# ---- Register der CDP Nachbarn für den ganzen Lauf ----
+# Ein Core Switch ist Nachbar von hunderten Access Switchen, wird aber nur einmal pro Lauf aufgelöst und geschrieben
+# NX-OS meldet "Name(Seriennummer)" als Device ID, dann ist die Seriennummer der Schlüssel, sonst die Device ID
+class NeighborRegistry:
+        def __init__(self):
+                self.devices = {}
+                self.specs = {}
+                self.hosts = set()
+
+        def key(self, device_id):
+                match = re.search(r"\(([^()]+)\)$", device_id)
+                return match.group(1) if match else device_id
+
+        # Wird nach dem Abgleich jedes entdeckten Gerätes aufgerufen, ab dann gilt der Eintrag vom Gerät selbst
+        def discovered(self, hostname):
+                self.hosts.add(hostname)
+                self.devices.pop(hostname, None)
+
+        # Entdeckte Geräte haben die Software Version im Custom Field, das setzt nur reconcileDevice()
+        def isDiscovered(self, device):
+                return device.name in self.hosts or bool((device.custom_fields or {}).get("Version"))
+
+# ---- Asynchroner Zugriff auf Netbox über den Cache ----
+# Pynetbox ist synchron, deshalb läuft jeder Aufruf in einem Thread und asyncio wartet nur darauf
+# Die Semaphore begrenzt die gleichzeitigen Requests, damit die Netbox Worker nicht überlastet werden
+# Wird pro asyncio.run neu erstellt, weil eine Semaphore an ihre Event Loop gebunden ist
+class AsyncNetbox:
+        def __init__(self, cache, concurrency=NETBOX_CONCURRENCY):
+                self.cache = cache
+                self.semaphore = asyncio.Semaphore(concurrency)
+
+        async def call(self, func, *args, **kwargs):
+                async with self.semaphore:
+                        return await asyncio.to_thread(func, *args, **kwargs)
+
+        async def get(self, name, /, device_id=None, **lookup):
+                return await self.call(self.cache.get, name, device_id=device_id, **lookup)
+
+        async def getOrCreate(self, name, lookup, /, device_id=None, **data):
+                return await self.call(self.cache.getOrCreate, name, lookup, device_id=device_id, **data)
+
+        async def create(self, name, /, **data):
+                return await self.call(self.cache.create, name, **data)
+
+        async def save(self, name, record, /, **desired):
+                return await self.call(self.cache.writer.save, name, record, **desired)
+
+# ---- Funktion um ein Objekt für Fehlermeldungen zu beschreiben ----
+def describeItem(item):
+        if isinstance(item, tuple):
+                item = item[0]
+        if isinstance(item, dict):
+                return str(item.get("name") or item.get("serial") or item.get("vid") or item)
+        return str(item)
+
+# ---- Funktion um Inventory Items und SFP Module aus der Ausgabe von "show inventory" zu holen ----
+# Unterschiedliche Methoden für IOS und IOSXE, da die Daten anders strukturiert sind
+# Gibt Items als (Name, Seriennummer, Modell), Module als (Bay, Modell, Seriennummer) und alle Seriennummern im Switch zurück
+def inventoryEntries(invpar, hostname, stacked, dev_os):
+        items = []
+        modules = []
+        serials = set()
+        if dev_os == 'ios':
                 for slot, slot_data in invpar['slot'].items():
                         for rp, rp_data in slot_data['rp'].items():
-                                inv_name = f"{hostname}-{rp_data['name']}"
-                                inv_serial = rp_data['sn']
-                                inv_model = rp_data['pid'] if 'pid' in rp_data else rp_data['description']
-
-                                # SFP Module mit Bays erstellen
-                                if 'subslot' in rp_data:
-                                        for subslot_name, subslot_data in rp_data['subslot'].items():
-                                                for sfp_name, sfp_data in subslot_data.items():
-                                                        # Erstelle 'name' als Modulebay und 'pid' als SFP Module
-                                                        if not nb.dcim.module_bays.filter(name=subslot_name, device_id=host.id):
-                                                                logging.info(f"Module Bay {subslot_name} not in Netbox, creating it now")
-                                                                m_bay = nb.dcim.module_bays.create(name=subslot_name, device=host.id)
-                                                        else:
-                                                                logging.info(f"Module Bay {subslot_name} already in Netbox")
-                                                                m_bay = nb.dcim.module_bays.get(name=subslot_name, device_id=host.id)
-
-                                                        # Erstelle Module Type wenn nicht vorhanden
-                                                        if not nb.dcim.module_types.filter(model=sfp_data['pid']):
-                                                                logging.info(f"SFP Module Type {sfp_data['pid']} not in Netbox, creating it now")
-                                                                m_type = nb.dcim.module_types.create(model=sfp_data['pid'], manufacturer=2)
-                                                        else:
-                                                                logging.info(f"SFP Module Type {sfp_data['pid']} already in Netbox")
-                                                                m_type = nb.dcim.module_types.get(model=sfp_data['pid'])
-
-                                                        # Erstelle SFP Module wenn nicht vorhanden
-                                                        if not nb.dcim.modules.filter(module_bay_id=m_bay.id, device_id=host.id):
-                                                                logging.info(f"SFP Module {sfp_data['pid']} with serial {sfp_data['sn']} not in Netbox, creating it now")
-                                                                nb.dcim.modules.create(serial=sfp_data['sn'], module_type=m_type.id, device=host.id, module_bay=m_bay.id)
-
-                                                        # Wenn SFP Module in Netbox existiert, dann Daten updaten
-                                                        elif nb.dcim.modules.filter(module_bay_id=m_bay.id, device_id=host.id):
-                                                                logging.info(f"SFP Module {sfp_data['pid']} already in Netbox - updating information")
-                                                                rset = nb.dcim.modules.get(module_bay_id=m_bay.id, device_id=host.id)
-                                                                rset.serial = sfp_data['sn']
-                                                                rset.module_type = m_type.id
-                                                                rset.save()
-                                # Erstelle inventory item nicht wenn das Gerät nicht gestackt ist
-                                if not stacked and inv_name == f"{hostname}-1":
-                                        continue
-                                # Wenn Inventory Item in Netbox nicht existiert, dann erstellen
-                                elif not nb.dcim.inventory_items.filter(serial=inv_serial):
-                                        logging.info(f"Inventory Item {inv_name} with Serial {inv_serial} not in Netbox, creating it now")
-                                        nb.dcim.inventory_items.create(device=host.id, name=inv_name, manufacturer=1, serial=inv_serial, part_id=inv_model)
-                                else:
-                                        logging.info(f"Inventory Item {inv_name} with Serial {inv_serial} already in Netbox")
-
-        elif tb.devices[hostname].os == 'iosxe':
+                                serials.add(rp_data['sn'])
+                                # SFP Module mit Bays, 'name' als Modulebay und 'pid' als SFP Module
+                                for subslot_name, subslot_data in rp_data.get('subslot', {}).items():
+                                        for sfp_name, sfp_data in subslot_data.items():
+                                                modules.append((subslot_name, sfp_data['pid'], sfp_data['sn']))
+                                                serials.add(sfp_data['sn'])
+                                items.append((f"{hostname}-{rp_data['name']}", rp_data['sn'], rp_data['pid'] if 'pid' in rp_data else rp_data['description']))
+        elif dev_os == 'iosxe':
                 for name, data in invpar['name'].items():
-                        inv_name = f"{hostname}-{name}"
-                        inv_serial = data['sn']
                         inv_model = data['pid'] if 'pid' in data else data['description']
+                        serials.add(data['sn'])
                         # Schauen ob SFP im Inventory
-                        if not "SFP" in inv_model:
-                                        # Non-Stacked Geräte nicht im Inventory erstellen
-                                        if not stacked and inv_name == f"{hostname}-1":
-                                                        continue
-                                        # Erstellen wenn nicht vorhanden
-                                        elif not nb.dcim.inventory_items.filter(serial=inv_serial):
-                                                        logging.info(f"Inventory Item {inv_name} with Serial {inv_serial} not in Netbox, creating it now")
-                                                        nb.dcim.inventory_items.create(device=host.id, name=inv_name, manufacturer=1, serial=inv_serial, part_id=inv_model)
-                                        else:
-                                                        logging.info(f"Inventory Item {inv_name} with Serial {inv_serial} already in Netbox")
+                        if "SFP" in inv_model:
+                                modules.append((name, inv_model, data['sn']))
                         else:
-                                        # Erstelle 'name' als Modulebay und 'pid' als SFP Module
-                                        if not nb.dcim.module_bays.filter(name=name, device_id=host.id):
-                                                        logging.info(f"Module Bay {name} not in Netbox, creating it now")
-                                                        m_bay = nb.dcim.module_bays.create(name=name, device=host.id)
-                                        else:
-                                                        logging.info(f"Module Bay {name} already in Netbox")
-                                                        m_bay = nb.dcim.module_bays.get(name=name, device_id=host.id)
-
-                                        # Erstelle Module Type wenn nicht vorhanden
-                                        if not nb.dcim.module_types.filter(model=inv_model):
-                                                        logging.info(f"SFP Module Type {inv_model} not in Netbox, creating it now")
-                                                        m_type = nb.dcim.module_types.create(model=inv_model, manufacturer=2)
-                                        else:
-                                                        logging.info(f"SFP Module Type {inv_model} already in Netbox")
-                                                        m_type = nb.dcim.module_types.get(model=inv_model)
-
-                                        # Erstelle SFP Module wenn nicht vorhanden
-                                        if not nb.dcim.modules.filter(module_bay_id=m_bay.id, device_id=host.id):
-                                                        logging.info(f"SFP Module {inv_model} with serial {inv_serial} not in Netbox, creating it now")
-                                                        nb.dcim.modules.create(serial=inv_serial, module_type=m_type.id, device=host.id, module_bay=m_bay.id)
-
-                                        # Wenn SFP Module in Netbox existiert, dann Daten updaten
-                                        elif nb.dcim.modules.filter(module_bay_id=m_bay.id, device_id=host.id):
-                                                        logging.info(f"SFP Module {inv_model} with serial {inv_serial} already in Netbox - updating information")
-                                                        rset = nb.dcim.modules.get(module_bay_id=m_bay.id, device_id=host.id)
-                                                        rset.serial = inv_serial
-                                                        rset.module_type = m_type.id
-                                                        rset.save()
-
-
-# ---- Cisco Geräte entdeckung ----
-def discoverCiscoDevice(nb,tb,device_name):
-
-        # ---- Verbindung zum Gerät aufbauen und Daten sammeln ----
-        logging.info(f"Connecting to {device_name}...")
-        dev = tb.devices[device_name]
+                                items.append((f"{hostname}-{name}", data['sn'], inv_model))
+        # Non-Stacked Geräte nicht im Inventory erstellen
+        if not stacked:
+                items = [item for item in items if item[0] != f"{hostname}-1"]
+        return items, modules, serials
+
+# ---- Inventory Items und SFP Module in Netbox abgleichen ----
+# Inventory Items, Module Bays und Module des Gerätes kommen je mit einer Abfrage in den Cache, die Module Typen einmal pro Lauf
+# Danach werden nur noch die Unterschiede gesammelt geschickt: zuerst fehlende Module Typen, dann fehlende Bays, dann der Rest
+# Items und Module deren Seriennummer nicht mehr im Switch ist werden gelöscht, Module ohne Seriennummer bleiben
+def reconcileInventory(cache, host, invpar, stacked, dev_os):
+        writer = cache.writer
+        hostname = host.name
+        logging.info(f"Adding inventory of {hostname}...")
+        items, modules, serials = inventoryEntries(invpar, hostname, stacked, dev_os)
+
+        # Fehlende Module Typen, jedes Modell nur einmal
+        for model in sorted({model for bay_name, model, serial in modules}):
+                if not cache.get("dcim.module_types", model=model):
+                        logging.info(f"SFP Module Type {model} not in Netbox, creating it now")
+                        writer.create("dcim.module_types", model=model, manufacturer=2)
+        writer.flush()
+
+        # Fehlende Module Bays
+        for bay_name in sorted({bay_name for bay_name, model, serial in modules}):
+                if not cache.get("dcim.module_bays", device_id=host.id, name=bay_name):
+                        logging.info(f"Module Bay {bay_name} not in Netbox, creating it now")
+                        writer.create("dcim.module_bays", name=bay_name, device=host.id)
+        writer.flush()
+
+        # Module in den Bays erstellen oder ändern, pro Bay gibt es nur ein Modul (das letzte gewinnt)
+        used = set()
+        for bay_name, (model, serial) in {bay_name: (model, serial) for bay_name, model, serial in modules}.items():
+                m_bay = cache.get("dcim.module_bays", device_id=host.id, name=bay_name)
+                m_type = cache.get("dcim.module_types", model=model)
+                if not m_bay or not m_type:
+                        logging.error(f"Can't add SFP Module {model} to {bay_name} on {hostname}, the module bay or module type could not be created")
+                        continue
+                module = cache.get("dcim.modules", device_id=host.id, module_bay=m_bay.id)
+                if not module:
+                        logging.info(f"SFP Module {model} with serial {serial} not in Netbox, creating it now")
+                        writer.create("dcim.modules", serial=serial, module_type=m_type.id, device=host.id, module_bay=m_bay.id)
+                else:
+                        used.add(module.id)
+                        if writer.update("dcim.modules", module, serial=serial, module_type=m_type.id):
+                                logging.info(f"SFP Module {model} in {bay_name} changed - updating information")
+        for module in cache.all("dcim.modules", device_id=host.id):
+                if module.id not in used and module.serial and module.serial not in serials:
+                        logging.info(f"Deleting module with Serial {module.serial} as it is not in the switch anymore")
+                        writer.delete("dcim.modules", module)
+
+        # Inventory Items über die Seriennummer abgleichen, Items die nicht mehr im Switch sind löschen
+        for inv_name, inv_serial, inv_model in items:
+                inventory_item = cache.get("dcim.inventory_items", device_id=host.id, serial=inv_serial)
+                if not inventory_item:
+                        logging.info(f"Inventory Item {inv_name} with Serial {inv_serial} not in Netbox, creating it now")
+                        writer.create("dcim.inventory_items", device=host.id, name=inv_name, manufacturer=1, serial=inv_serial, part_id=inv_model)
+                elif writer.update("dcim.inventory_items", inventory_item, name=inv_name, part_id=inv_model):
+                        logging.info(f"Inventory Item {inv_name} with Serial {inv_serial} changed - updating information")
+                else:
+                        logging.debug(f"Inventory Item {inv_name} with Serial {inv_serial} already in Netbox")
+        for inventory_item in cache.all("dcim.inventory_items", device_id=host.id):
+                if inventory_item.serial and inventory_item.serial not in serials:
+                        logging.info(f"Deleting inventory item with Serial {inventory_item.serial} as it is not in the switch anymore")
+                        writer.delete("dcim.inventory_items", inventory_item)
+
+        # Alles Übrige gesammelt schicken
+        writer.flush()
+
+# ---- Befehle die auf den Geräten ausgeführt werden ----
+# Pro Abschnitt ein Befehl, damit Sammeln und Verarbeiten getrennt voneinander laufen können
+COMMANDS = {
+        "version": "show version",
+        "vlan": "show vlan",
+        "interfaces": "show interfaces status",
+        "cdp": "show cdp neighbors detail",
+        "inventory": "show inventory",
+        "switch": "show switch",
+}
+
+# Version des Snapshot Formats, wird hochgezählt wenn sich der Aufbau ändert
+SNAPSHOT_FORMAT = 1
+
+# Abschnitte die nicht jedes Gerät kann, ein Fehler dabei lässt nicht das ganze Gerät fehlschlagen
+OPTIONAL_SECTIONS = ("switch",)
+
+# Antwort des Gerätes auf einen Befehl den es nicht kennt, nur dann kann die Plattform den Befehl wirklich nicht
+# Timeouts und abgebrochene Verbindungen sind vorübergehend und werden beim nächsten Mal wieder probiert
+UNSUPPORTED_COMMAND = re.compile(r"%\s*(Invalid (input|command)|Incomplete command|Unknown command)", re.IGNORECASE)
+
+# ---- Funktion um die Befehle für ein OS zu holen ----
+# skip sind Abschnitte von denen schon bekannt ist, dass das Gerät sie nicht kann (siehe CapabilityStore)
+def deviceCommands(dev_os, skip=()):
+        commands = dict(COMMANDS)
+        # OID ist näher an das IOS 'show inventory' dran als IOSXE 'show inventory'
+        if dev_os == 'iosxe':
+                commands["inventory"] = "show inventory OID"
+        for section in skip:
+                commands.pop(section, None)
+        return commands
+
+# ---- Funktion um Daten von einem Gerät zu sammeln ----
+# Hier wird nur mit dem Gerät geredet und Netbox nicht angefasst, deshalb kann das für viele Geräte gleichzeitig laufen
+# Mit parse=False kommen nur die Rohausgaben zurück, geparst wird dann über den ParseCache
+# Die Pflicht Befehle gehen mit "terminal length 0" zusammen in einem execute() raus, nur optionale Befehle kommen einzeln danach
+# Optionale Befehle die das Gerät nicht kennt landen in "unsupported", damit der CapabilityStore sie sich merken kann
+def collectCiscoDevice(dev, timeout=300, parse=True, skip=()):
+        logging.info(f"Connecting to {dev.name}...")
+        timings = {}
+        started = time.monotonic()
         try:
             dev.connect(goto_enable=False,
                         log_stdout=False,
                         init_exec_commands=[],
-                        init_config_commands=[])
+                        init_config_commands=[],
+                        connection_timeout=timeout)
         except Exception as e:
-                logging.error(f"Error connecting to {device_name}. Can the host reach it? Are the credentials correct?")
+                logging.error(f"Error connecting to {dev.name}. Can the host reach it? Are the credentials correct?")
                 logging.error(f"Exception: {e}")
-                return
+                raise
+        timings["connect"] = time.monotonic() - started
+
+        # ---- Befehle auf dem Gerät ausführen ----
+        logging.info(f"Executing commands on {dev.name}...")
+        commands = deviceCommands(dev.os, skip)
+        required = [section for section in commands if section not in OPTIONAL_SECTIONS]
+        raw = {}
+        unsupported = []
+        try:
+                started = time.monotonic()
+                outputs = dev.execute(["terminal length 0"] + [commands[section] for section in required], timeout=timeout)
+                for section in required:
+                        raw[section] = outputs[commands[section]]
+                timings["execute.batch"] = time.monotonic() - started
+                for section in commands:
+                        if section in required:
+                                continue
+                        started = time.monotonic()
+                        try:
+                                raw[section] = dev.execute(commands[section], timeout=timeout)
+                                timings[f"execute.{section}"] = time.monotonic() - started
+                        except Exception as e:
+                                # Nicht jeder switch hat 'show switch', deshalb wird nur dieser Befehl übersprungen
+                                logging.error(f"Error executing '{commands[section]}' on {dev.name}, skipping it" + (" and the stack creation" if section == "switch" else ""))
+                                logging.error(f"Exception: {e}")
+                                if UNSUPPORTED_COMMAND.search(str(e)):
+                                        unsupported.append(section)
+        finally:
+                logging.info(f"Disconnecting from {dev.name}...")
+                dev.disconnect()
+
+        # ---- Daten parsen ----
+        parsed = {}
+        for section, output in raw.items() if parse else ():
+                started = time.monotonic()
+                parsed[section] = dev.parse(commands[section], output=output)
+                timings[f"parse.{section}"] = time.monotonic() - started
+
+        return {
+                "device": dev.name,
+                "os": dev.os,
+                "ip": str(dev.connections['cli'].ip),
+                "raw": raw,
+                "parsed": parsed,
+                "timings": timings,
+                "unsupported": unsupported,
+        }
 
-        # ---- Befehle auf dem Gerät ausführen und Daten parsen ----
-        logging.info(f"Executing commands and parsing data...")
-        verraw = dev.execute('show version')
-        vlanraw = dev.execute('show vlan')
-        intraw = dev.execute('show interfaces status')
-        cdpraw = dev.execute('show cdp neighbors detail')
-        # OID ist näher an das IOS 'show inventory' dran als IOSXE 'show inventory'
-        if tb.devices[device_name].os == 'ios':
-                logging.info(f"Device {device_name} is running IOS, using 'show inventory'")
-                invraw = dev.execute('show inventory')
-        elif tb.devices[device_name].os == 'iosxe':
-                logging.info(f"Device {device_name} is running IOSXE, using 'show inventory OID'")
-                invraw = dev.execute('show inventory OID')
-        # Nicht jeder switch hat dieses Command, deshalb try/except
+# Genie Geräte ohne Verbindung, nur zum Parsen, eins pro OS
+PARSE_DEVICES = {}
+
+# ---- Funktion um eine Ausgabe ohne Verbindung zum Gerät zu parsen ----
+# Läuft auch in den Prozessen vom Parse Pool, deshalb nur einfache Argumente
+def parseOutput(dev_os, command, output):
+        dev = PARSE_DEVICES.get(dev_os)
+        if dev is None:
+                dev = Device(f"offline-{dev_os}", os=dev_os)
+                dev.custom.setdefault("abstraction", {})["order"] = ["os"]
+                PARSE_DEVICES[dev_os] = dev
+        return dev.parse(command, output=output)
+
+# ---- Zwischenspeicher für geparste Ausgaben ----
+# Gleiche Rohausgabe (z.B. die gleiche VLAN Tabelle auf vielen Access Switchen) wird nur einmal geparst, auch über Läufe hinweg
+# Schlüssel ist (OS, Befehl, sha256 der Rohausgabe), gespeichert wird das Ergebnis als JSON in SQLite
+# Mit workers > 0 wird in einem eigenen Process Pool geparst, sonst direkt im Hauptprozess
+# Der Pool wird gleich beim Erstellen gestartet, solange noch keine Threads beim Sammeln laufen
+# Ein fork mitten im Lauf könnte Locks (SSH, Logging) mitnehmen, die gerade ein anderer Thread hält, dann hängt der Prozess
+# Im Speicher wird nichts behalten, SQLite findet einen Eintrag über den Primary Key schnell genug
+# Einträge die MAX_AGE_DAYS lang kein Gerät mehr gebraucht hat werden beim Öffnen gelöscht, damit die Datei nicht ständig wächst
+class ParseCache:
+        MAX_AGE_DAYS = 30
+        # Ausgaben mit Uptime bzw. Holdtime sind bei jedem Aufruf anders und würden nie wieder getroffen, sie werden nicht gespeichert
+        VOLATILE_SECTIONS = ("version", "cdp")
+
+        def __init__(self, path, workers=0):
+                self.db = sqlite3.connect(path)
+                self.db.execute("CREATE TABLE IF NOT EXISTS parsed (os TEXT, command TEXT, hash TEXT, parsed TEXT, updated TEXT, PRIMARY KEY (os, command, hash))")
+                cutoff = (datetime.now(timezone.utc) - timedelta(days=self.MAX_AGE_DAYS)).isoformat()
+                volatile = [COMMANDS[section] for section in self.VOLATILE_SECTIONS]
+                pruned = self.db.execute(f"DELETE FROM parsed WHERE updated < ? OR command IN ({', '.join('?' for _ in volatile)})", [cutoff] + volatile).rowcount
+                self.db.commit()
+                if pruned:
+                        logging.info(f"Removed {pruned} outdated entries from the parse cache")
+                self.workers = workers
+                self.executor = None
+                if workers:
+                        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+                        # Beim fork Kontext startet der Pool alle Prozesse mit dem ersten Auftrag
+                        self.executor.submit(os.getpid).result()
+                self.hits = 0
+                self.misses = 0
+
+        def key(self, dev_os, command, output):
+                return (dev_os, command, hashlib.sha256(output.encode()).hexdigest())
+
+        # JSON wird bei jedem Treffer neu geladen, damit sich Geräte mit gleicher Ausgabe nicht dasselbe dict teilen
+        def get(self, key):
+                row = self.db.execute("SELECT parsed FROM parsed WHERE os = ? AND command = ? AND hash = ?", key).fetchone()
+                return json.loads(row[0]) if row else None
+
+        def put(self, key, parsed):
+                self.db.execute("INSERT OR REPLACE INTO parsed VALUES (?, ?, ?, ?, ?)", key + (json.dumps(parsed, separators=(",", ":"), default=str), datetime.now(timezone.utc).isoformat()))
+
+        # Getroffene Einträge als benutzt markieren, damit sie nicht als veraltet gelöscht werden
+        def touch(self, keys):
+                now = datetime.now(timezone.utc).isoformat()
+                self.db.executemany("UPDATE parsed SET updated = ? WHERE os = ? AND command = ? AND hash = ?", [(now,) + key for key in keys])
+
+        # Alle Rohausgaben eines gesammelten Gerätes parsen, was schon im Cache ist wird übersprungen
+        def parse(self, result):
+                commands = deviceCommands(result["os"])
+                parsed = {}
+                pending = {}
+                used = []
+                for section, output in result["raw"].items():
+                        key = self.key(result["os"], commands[section], output)
+                        cached = self.get(key) if section not in self.VOLATILE_SECTIONS else None
+                        if cached is not None:
+                                self.hits += 1
+                                parsed[section] = cached
+                                used.append(key)
+                        else:
+                                pending.setdefault(key, []).append(section)
+
+                futures = {}
+                timings = dict(result.get("timings", {}))
+                for key, sections in pending.items():
+                        if self.executor:
+                                futures[key] = self.executor.submit(parseOutput, key[0], key[1], result["raw"][sections[0]])
+                # Mit Pool ist das die Zeit bis das Ergebnis da ist, nicht die reine Parse Zeit
+                started = time.monotonic()
+                for key, sections in pending.items():
+                        value = futures[key].result() if key in futures else parseOutput(key[0], key[1], result["raw"][sections[0]])
+                        timings[f"parse.{sections[0]}"] = time.monotonic() - started
+                        started = time.monotonic()
+                        self.misses += 1
+                        if sections[0] in self.VOLATILE_SECTIONS:
+                                parsed[sections[0]] = value
+                                continue
+                        self.put(key, value)
+                        for section in sections:
+                                parsed[section] = self.get(key)
+                self.touch(used)
+                self.db.commit()
+                return dict(result, parsed=parsed, timings=timings)
+
+        def stats(self):
+                return {"hits": self.hits, "misses": self.misses}
+
+        # Den Parse Pool beenden und auf die Prozesse warten, erst danach zählen sie beim Peak RSS der Worker mit
+        # Danach wird im Hauptprozess geparst, ein neuer Pool würde mitten im Lauf geforkt
+        def shutdown(self):
+                if self.executor:
+                        self.executor.shutdown(cancel_futures=True)
+                        self.executor = None
+
+        def close(self):
+                self.shutdown()
+                self.db.close()
+
+# ---- Funktion um Rohausgaben aus Textdateien zu laden ----
+# Ein Ordner pro Gerät mit device.json ({"os": "iosxe", "ip": "10.0.0.1"}) und einer <Abschnitt>.txt pro Befehl, z.B. vlan.txt
+# 'switch.txt' ist wie beim Sammeln optional
+def loadRawDevice(path):
+        with open(os.path.join(path, "device.json"), encoding="utf-8") as f:
+                meta = json.load(f)
+        raw = {}
+        for section in COMMANDS:
+                file = os.path.join(path, f"{section}.txt")
+                if os.path.exists(file):
+                        with open(file, encoding="utf-8") as f:
+                                raw[section] = f.read()
+                elif section != "switch":
+                        raise FileNotFoundError(f"{file} is missing")
+        return {"device": meta.get("device", os.path.basename(path)), "os": meta["os"], "ip": meta["ip"], "raw": raw, "parsed": {}}
+
+# ---- Funktion um alle Geräte Ordner mit Rohausgaben zu finden ----
+def listRawDevices(raw_dir):
+        return sorted(os.path.join(raw_dir, name) for name in os.listdir(raw_dir) if os.path.exists(os.path.join(raw_dir, name, "device.json")))
+
+# ---- Funktion um gesammelte Daten als Snapshot zu speichern ----
+# Ein gzip JSON pro Gerät mit Raw und Parsed Ausgaben, damit das Eintragen in Netbox ohne die Switche wiederholt werden kann
+def saveSnapshot(result, snapshot_dir):
+        os.makedirs(snapshot_dir, exist_ok=True)
+        snapshot = dict(result, format=SNAPSHOT_FORMAT, collected=datetime.now(timezone.utc).isoformat())
+        path = os.path.join(snapshot_dir, f"{result['device']}.json.gz")
+        # Erst in temporäre Datei schreiben, damit ein abgebrochener Lauf keinen halben Snapshot hinterlässt
+        with gzip.open(path + ".tmp", "wt", encoding="utf-8") as f:
+                json.dump(snapshot, f, separators=(",", ":"), default=str)
+        os.replace(path + ".tmp", path)
+        logging.debug(f"Snapshot of {result['device']} written to {path}")
+        return path
+
+# ---- Funktion um einen Snapshot zu laden ----
+def loadSnapshot(path):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+                snapshot = json.load(f)
+        if snapshot.get("format") != SNAPSHOT_FORMAT:
+                raise ValueError(f"Snapshot {path} has format {snapshot.get('format')}, expected {SNAPSHOT_FORMAT}")
+        return snapshot
+
+# ---- Funktion um alle Snapshots in einem Ordner zu finden ----
+def listSnapshots(snapshot_dir):
+        return sorted(os.path.join(snapshot_dir, name) for name in os.listdir(snapshot_dir) if name.endswith(".json.gz"))
+
+# ---- Welche Befehle zu welchem Abschnitt beim Eintragen in Netbox gehören ----
+# Ein Abschnitt wird nur übersprungen, wenn sich keiner seiner Befehle seit dem letzten erfolgreichen Lauf geändert hat
+SECTION_COMMANDS = {
+        "vlan": ["vlan"],
+        "device": ["version", "switch"],
+        "interfaces": ["interfaces"],
+        "cdp": ["cdp"],
+        "inventory": ["inventory", "switch"],
+}
+
+# Zeilen die sich bei jedem Aufruf ändern und deshalb nicht in den Fingerabdruck kommen
+VOLATILE_LINES = re.compile(r"^.*(uptime is|Uptime for this control processor|System restarted at|Holdtime\s*:).*$", re.MULTILINE | re.IGNORECASE)
+
+# ---- Funktion um die Fingerabdrücke der Ausgaben eines Gerätes zu berechnen ----
+def fingerprints(result):
+        return {section: hashlib.sha256(VOLATILE_LINES.sub("", result["raw"].get(section, "")).encode()).hexdigest() for section in COMMANDS}
+
+# ---- Speicher für die Fingerabdrücke vom letzten erfolgreichen Lauf ----
+# SQLite, damit nichts extra installiert werden muss
+class FingerprintStore:
+        def __init__(self, path):
+                self.db = sqlite3.connect(path)
+                self.db.execute("CREATE TABLE IF NOT EXISTS fingerprints (device TEXT, command TEXT, hash TEXT, updated TEXT, PRIMARY KEY (device, command))")
+                self.db.commit()
+
+        # Abschnitte deren Befehle alle unverändert sind
+        def unchangedSections(self, device_name, hashes):
+                stored = dict(self.db.execute("SELECT command, hash FROM fingerprints WHERE device = ?", (device_name,)))
+                return {section for section, commands in SECTION_COMMANDS.items() if all(stored.get(command) == hashes[command] for command in commands)}
+
+        # Erst nach erfolgreichem Eintragen speichern, sonst würde ein fehlgeschlagener Abschnitt beim nächsten Mal übersprungen
+        def store(self, device_name, hashes):
+                now = datetime.now(timezone.utc).isoformat()
+                self.db.executemany("INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?)", [(device_name, command, digest, now) for command, digest in hashes.items()])
+                self.db.commit()
+
+        # Fingerabdrücke löschen, damit die Befehle beim nächsten Lauf auf jeden Fall eingetragen werden
+        def forget(self, device_name, commands):
+                self.db.executemany("DELETE FROM fingerprints WHERE device = ? AND command = ?", [(device_name, command) for command in commands])
+                self.db.commit()
+
+# Modell aus "show version", z.B. "cisco C9300-48P (X86) processor" oder "Model Number : WS-C3750X-48P"
+PLATFORM_PATTERN = re.compile(r"^cisco (\S+) \(.*\) processor|^Model [Nn]umber\s*:\s*(\S+)", re.MULTILINE)
+
+# ---- Speicher welche optionalen Befehle ein Gerät kann ----
+# Gemerkt wird pro (OS, Plattform), z.B. dass ein C9500 kein "show switch" hat, und welches Gerät welche Plattform ist
+# Dadurch wird ein Befehl, den die Plattform nicht kann, beim nächsten Mal gar nicht erst geschickt, auch auf neuen Geräten der Plattform
+# Wird nur im Hauptthread benutzt, die Worker bekommen die Abschnitte zum Überspringen mitgegeben
+# Nach max_age Tagen wird ein nicht unterstützter Befehl wieder probiert, z.B. nach einem Software Update
+class CapabilityStore:
+        def __init__(self, path, max_age=7):
+                self.max_age = max_age
+                self.db = sqlite3.connect(path)
+                self.db.execute("CREATE TABLE IF NOT EXISTS platforms (device TEXT PRIMARY KEY, platform TEXT, updated TEXT)")
+                self.db.execute("CREATE TABLE IF NOT EXISTS capabilities (platform TEXT, section TEXT, supported INTEGER, updated TEXT, PRIMARY KEY (platform, section))")
+                self.db.commit()
+
+        # Unbekannte Geräte werden unter ihrem Namen gemerkt, bis die Plattform bekannt ist
+        def platform(self, device_name):
+                row = self.db.execute("SELECT platform FROM platforms WHERE device = ?", (device_name,)).fetchone()
+                return row[0] if row else f"device:{device_name}"
+
+        # Abschnitte die das Gerät laut seiner Plattform nicht kann
+        def skipped(self, device_name):
+                cutoff = (datetime.now(timezone.utc) - timedelta(days=self.max_age)).isoformat()
+                return {section for section, in self.db.execute("SELECT section FROM capabilities WHERE platform = ? AND supported = 0 AND updated >= ?", (self.platform(device_name), cutoff))}
+
+        # Nach dem Sammeln: Plattform aus "show version" und ob die optionalen Befehle geklappt haben
+        def learn(self, result):
+                match = PLATFORM_PATTERN.search(result["raw"].get("version", ""))
+                platform = f"{result['os']}:{match.group(1) or match.group(2)}" if match else f"device:{result['device']}"
+                now = datetime.now(timezone.utc).isoformat()
+                self.db.execute("INSERT OR REPLACE INTO platforms VALUES (?, ?, ?)", (result["device"], platform, now))
+                for section in OPTIONAL_SECTIONS:
+                        if section in result["raw"] or section in result.get("unsupported", ()):
+                                self.db.execute("INSERT OR REPLACE INTO capabilities VALUES (?, ?, ?, ?)", (platform, section, int(section in result["raw"]), now))
+                self.db.commit()
+
+# ---- Journal und gemeinsamer Speicher für verteilte Läufe ----
+# Jeder Lauf (bzw. jeder Worker) trägt seinen Shard, das Ergebnis jedes Gerätes und jeden fertigen Abschnitt ein
+# Damit kann ein abgebrochener Lauf mit --resume weitermachen und der Coordinator liest am Ende alle Shards aus
+# SQLite auf einer gemeinsamen Platte reicht dafür, ein Broker wird nicht gebraucht
+# WAL und ein langer Timeout, weil mehrere Prozesse gleichzeitig schreiben
+# Läufe deren letzter Shard vor mehr als MAX_AGE_DAYS gestartet wurde werden beim Öffnen gelöscht, sonst wächst die Datei mit jedem Lauf
+class WorkStore:
+        MAX_AGE_DAYS = 30
+
+        def __init__(self, path, run_id=None):
+                self.db = sqlite3.connect(path, timeout=60)
+                self.db.execute("PRAGMA journal_mode=WAL")
+                self.db.execute("CREATE TABLE IF NOT EXISTS shards (run TEXT, shard INTEGER, shards INTEGER, worker TEXT, status TEXT, started TEXT, finished TEXT, summary TEXT, PRIMARY KEY (run, shard))")
+                self.db.execute("CREATE TABLE IF NOT EXISTS devices (run TEXT, device TEXT, shard INTEGER, status TEXT, error TEXT, updated TEXT, PRIMARY KEY (run, device))")
+                self.db.execute("CREATE TABLE IF NOT EXISTS sections (run TEXT, device TEXT, shard INTEGER, section TEXT, updated TEXT, PRIMARY KEY (run, device, section))")
+                self.db.execute("CREATE TABLE IF NOT EXISTS crawled (run TEXT, device TEXT, shard INTEGER, os TEXT, ip TEXT, depth INTEGER, updated TEXT, PRIMARY KEY (run, device))")
+                cutoff = (datetime.now(timezone.utc) - timedelta(days=self.MAX_AGE_DAYS)).isoformat()
+                old = [run for run, in self.db.execute("SELECT run FROM shards GROUP BY run HAVING MAX(started) < ?", (cutoff,))]
+                for table in ("devices", "sections", "crawled", "shards"):
+                        self.db.executemany(f"DELETE FROM {table} WHERE run = ?", [(run,) for run in old])
+                self.db.commit()
+                if old:
+                        logging.info(f"Removed {len(old)} runs older than {self.MAX_AGE_DAYS} days from the journal")
+                self.run_id = run_id
+                self.shard = None
+                self.completed = set()
+                self.resume = False
+
+        # Der zuletzt gestartete Lauf von diesem Shard, für --resume ohne --run-id
+        def lastRun(self, shard=0):
+                row = self.db.execute("SELECT run FROM shards WHERE shard = ? ORDER BY started DESC LIMIT 1", (shard,)).fetchone()
+                return row[0] if row else None
+
+        # Ohne resume fängt der Shard von vorne an, mit resume werden die fertigen Geräte gemerkt und übersprungen
+        def startShard(self, shard, shards, resume=False):
+                self.shard = shard
+                self.resume = resume
+                if resume:
+                        self.completed = {device_name for device_name, in self.db.execute("SELECT device FROM devices WHERE run = ? AND shard = ? AND status = 'done'", (self.run_id, shard))}
+                else:
+                        self.completed = set()
+                        self.db.execute("DELETE FROM devices WHERE run = ? AND shard = ?", (self.run_id, shard))
+                        self.db.execute("DELETE FROM sections WHERE run = ? AND shard = ?", (self.run_id, shard))
+                        self.db.execute("DELETE FROM crawled WHERE run = ? AND shard = ?", (self.run_id, shard))
+                now = datetime.now(timezone.utc).isoformat()
+                self.db.execute("INSERT OR REPLACE INTO shards VALUES (?, ?, ?, ?, 'running', ?, NULL, NULL)", (self.run_id, shard, shards, f"{socket.gethostname()}:{os.getpid()}", now))
+                self.db.commit()
+
+        def isDone(self, device_name):
+                return self.resume and device_name in self.completed
+
+        # Wird nach jedem Abschnitt aufgerufen, damit auch nach einem Absturz mitten im Gerät nichts doppelt gemacht wird
+        def section(self, device_name, section):
+                now = datetime.now(timezone.utc).isoformat()
+                self.db.execute("INSERT OR REPLACE INTO sections VALUES (?, ?, ?, ?, ?)", (self.run_id, device_name, self.shard, section, now))
+                self.db.commit()
+
+        # Abschnitte die in diesem Lauf schon eingetragen wurden, nur bei resume
+        def sectionsDone(self, device_name):
+                if not self.resume:
+                        return set()
+                return {section for section, in self.db.execute("SELECT section FROM sections WHERE run = ? AND device = ?", (self.run_id, device_name))}
+
+        # Gecrawlte Geräte mit (Name, OS, IP) und Tiefe, damit --resume sie wieder in den Crawl geben kann
+        # Die Nachbarn von fertigen Geräten würden sonst fehlen, weil fertige Geräte gar nicht mehr gesammelt werden
+        def crawled(self, spec, depth):
+                now = datetime.now(timezone.utc).isoformat()
+                self.db.execute("INSERT OR REPLACE INTO crawled VALUES (?, ?, ?, ?, ?, ?, ?)", (self.run_id, spec[0], self.shard, spec[1], spec[2], depth, now))
+                self.db.commit()
+
+        def crawledDevices(self):
+                return [((device_name, dev_os, ip), depth) for device_name, dev_os, ip, depth in self.db.execute("SELECT device, os, ip, depth FROM crawled WHERE run = ? AND shard = ? ORDER BY updated", (self.run_id, self.shard))]
+
+        # Wird nach jedem Gerät aufgerufen, damit auch ein abgebrochener Worker seine fertigen Geräte hinterlässt
+        def device(self, device_name, status, error=None):
+                now = datetime.now(timezone.utc).isoformat()
+                self.db.execute("INSERT OR REPLACE INTO devices VALUES (?, ?, ?, ?, ?, ?)", (self.run_id, device_name, self.shard, status, error, now))
+                self.db.commit()
+
+        def finishShard(self, summary):
+                now = datetime.now(timezone.utc).isoformat()
+                summary = json.dumps({key: value for key, value in summary.items() if key != "started"}, default=str)
+                self.db.execute("UPDATE shards SET status = 'finished', finished = ?, summary = ? WHERE run = ? AND shard = ?", (now, summary, self.run_id, self.shard))
+                self.db.commit()
+
+        # {Shard: (Status, Worker)} für diesen Lauf
+        def shardStatus(self):
+                return {shard: (status, worker) for shard, status, worker in self.db.execute("SELECT shard, status, worker FROM shards WHERE run = ?", (self.run_id,))}
+
+        def devices(self):
+                return list(self.db.execute("SELECT device, shard, status, error FROM devices WHERE run = ? ORDER BY device", (self.run_id,)))
+
+        def close(self):
+                self.db.close()
+
+# ---- Cisco Geräte entdeckung ----
+def discoverCiscoDevice(nb,tb,device_name):
         try:
-                swraw = dev.execute('show switch')
-                sw_errored = False
-        except Exception as e:
-                logging.error(f"Error executing 'show switch' on {device_name}, skipping stack creation")
-                logging.error(f"Exception: {e}")
-                sw_errored = True
-
-        logging.info("Disconnecting from device...")
-        dev.disconnect()
-
-        # ---- Raw und Parsed Variablen für Debug Zwecke ----
-        verpar = dev.parse('show version', output=verraw)
-        vlanpar = dev.parse('show vlan', output=vlanraw)
-        intpar = dev.parse('show interfaces status', output=intraw)
-        cdppar = dev.parse('show cdp neighbors detail', output=cdpraw)
-        if tb.devices[device_name].os == 'ios':
-                invpar = dev.parse('show inventory', output=invraw)
-        elif tb.devices[device_name].os == 'iosxe':
-                invpar = dev.parse('show inventory OID', output=invraw)
-        if not sw_errored:
-                swpar = dev.parse('show switch', output=swraw)
+                result = collectCiscoDevice(tb.devices[device_name])
+        except Exception:
+                return
+        reconcileCiscoDevice(nb, result)
+
+# ---- Gesammelte Daten eines Gerätes in Netbox eintragen ----
+# Jeder Abschnitt ist eine eigene Funktion, Abschnitte in skip werden übersprungen (z.B. weil sich die Ausgabe nicht geändert hat)
+def reconcileCiscoDevice(nb, result, cache=None, skip=()):
+        # Ohne Cache vom Lauf wird einer nur für dieses Gerät gemacht, die VLANs werden dann gleich geschrieben
+        single = cache is None
+        if single:
+                cache = NetboxCache(nb)
+        parsed = result["parsed"]
+        hostname = parsed["version"]['version']['hostname']
+        stacked = isStacked(parsed)
+
+        # Fertige Abschnitte ins Journal, damit --resume sie nach einem Abbruch nicht noch einmal macht
+        # Ist beim Abschnitt ein Objekt nicht nach Netbox gekommen (neuer Eintrag in writer.failed), zählt er als fehlgeschlagen und kommt nicht ins Journal
+        # Die geparste Ausgabe wird danach gleich freigegeben, bei großen Stacks und Chassis ist sie das Meiste am Gerät
+        failed = set()
+
+        def finished(section, failures):
+                parsed.pop("version" if section == "device" else section, None)
+                if len(cache.writer.failed) > failures:
+                        failed.add(section)
+                elif WORK is not None:
+                        WORK.section(result["device"], section)
+
+        # Das Gerät selbst wird trotzdem gebraucht, wenn es nicht in Netbox ist muss der Abschnitt laufen
+        host = cache.get("dcim.devices", name=hostname)
+        if "device" not in skip or not host:
+                failures = len(cache.writer.failed)
+                with METRICS.timer("reconcile.device"):
+                        host = reconcileDevice(cache, result, stacked)
+                finished("device", failures)
+
+        # Die VLANs kommen erst am Ende des Laufs nach Netbox, siehe VlanReconciler und applyVlans()
+        # Deshalb kommt der Abschnitt erst dort ins Journal, wenn sie wirklich geschrieben wurden
+        if "vlan" not in skip:
+                with METRICS.timer("reconcile.vlans"):
+                        cache.vlans.add(host, parsed.pop("vlan"), result["device"])
+                        if single and cache.vlans.apply()[1]:
+                                logging.error(f"Not all VLANs of {hostname} could be written to Netbox")
+
+        if "interfaces" not in skip:
+                failures = len(cache.writer.failed)
+                with METRICS.timer("reconcile.interfaces"):
+                        reconcileInterfaces(cache, host, parsed["interfaces"])
+                finished("interfaces", failures)
+        if "cdp" not in skip:
+                failures = len(cache.writer.failed)
+                reconcileNeighbors(cache, host, parsed["cdp"])
+                finished("cdp", failures)
+        # Inventory und Module in Netbox erstellen und ergänzen
+        if "inventory" not in skip:
+                failures = len(cache.writer.failed)
+                with METRICS.timer("reconcile.inventory"):
+                        reconcileInventory(cache, host, parsed["inventory"], stacked, result["os"])
+                finished("inventory", failures)
+        if skip:
+                logging.info(f"Skipped sections of {hostname}: {', '.join(sorted(skip))}")
+        parsed.clear()
+        if failed:
+                logging.error(f"Not all objects of {hostname} could be written to Netbox, failed sections: {', '.join(sorted(failed))}")
+        else:
+                logging.info(f"Finished processing {hostname}")
+        return failed
+
+# ---- Funktion um zu checken ob es sich um ein Stack handelt (in swpar checken) ----
+def isStacked(parsed):
+        # Nicht jeder switch hat 'show switch', dann ist es auch kein Stack
+        if "switch" not in parsed:
+                return False
+        # Stacked setzen, damit Standalone Switche mit dem 'show switch' Command nicht als gestackt erkannt werden
+        return len(parsed["switch"]["switch"]["stack"]) > 1
+
+# ---- Device in Netbox erstellen und ergänzen ----
+def reconcileDevice(cache, result, stacked):
+        writer = cache.writer
+        verpar = result["parsed"]["version"]
 
         # ---- Daten aus 'show version' extrahieren ----
         hostname = verpar['version']['hostname']
@@ -363,103 +1831,70 @@ def discoverCiscoDevice(nb,tb,device_name):
         platform_slug = platform.replace(" ", "-")
         chassis = verpar['version']['chassis']
 
-        # ---- VLANs in Netbox erstellen und ergänzen ----
-        logging.info(f"Checking VLANs...")
-        for vlan in vlanpar['vlans']:
-                vlan_name = vlanpar['vlans'][vlan]['name']
-                vlan_id = vlanpar['vlans'][vlan]['vlan_id']
-                existing_vlan = nb.ipam.vlans.get(vid=vlan_id)
-                # Wenn VLAN existiert, aber Name nicht übereinstimmt, dann updaten (Daten werden vom Gerät übernommen)
-                if existing_vlan:
-                        if existing_vlan.name != vlan_name:
-                                logging.info(f"Name of VLAN {vlan_id} is outdated, updating to {vlan_name}")
-                                existing_vlan.name = vlan_name
-                                existing_vlan.full_clean()
-                                existing_vlan.save()
-                else:
-                        # Wenn VLAN nicht existiert, dann erstellen
-                        logging.info(f"Creating VLAN {vlan_name} with ID {vlan_id}")
-                        nb.ipam.vlans.create(name=vlan_name, vid=vlan_id)
-
-        # ---- Device in Netbox erstellen und ergänzen ----
         logging.info(f"Checking Device {hostname}...")
         # Schauen ob Device Type und Platform in Netbox existieren
-        device_type_chk = nb.dcim.device_types.get(slug=chassis)
-        platform_chk = nb.dcim.platforms.get(slug=platform_slug)
+        device_type_chk = cache.get("dcim.device_types", slug=chassis)
+        platform_chk = cache.get("dcim.platforms", slug=platform_slug)
 
-        # IP Adresse des Gerätes aus Verbindung holen
-        ip_address_str = str(dev.connections['cli'].ip)+"/24"
+        # IP Adresse des Gerätes aus Verbindung holen, die Maske kommt aus dem Prefix
+        ip_address_str = cache.prefixes.address(result["ip"])
 
         # Schauen ob IP Adresse in Netbox existiert, wenn nicht, dann erstellen
-        if not nb.ipam.ip_addresses.filter(address=ip_address_str):
+        # Gesucht wird ohne Maske, eine IP mit veralteter Maske (z.B. das frühere /24) wird korrigiert statt doppelt angelegt
+        ipint = cache.get("ipam.ip_addresses", host=result["ip"])
+        if not ipint:
                 logging.info(f"IP Address not in Netbox, creating {ip_address_str}")
-                nb.ipam.ip_addresses.create(address=ip_address_str, status='online')
+                cache.create("ipam.ip_addresses", address=ip_address_str, status='online')
+        elif ipint.address != ip_address_str:
+                logging.info(f"Mask of IP Address {ipint.address} is outdated, updating to {ip_address_str}")
+                writer.save("ipam.ip_addresses", ipint, address=ip_address_str)
 
-        # Prefix des Gerätes aus IP Adresse holen und schauen ob Prefix in Netbox existiert
-        prefix_str = str(ip_network(ip_address_str, strict=False).supernet().network_address)+"/24"
-        logging.info(f"Checking Prefix {prefix_str}")
-        prefix_nb = nb.ipam.prefixes.get(prefix=prefix_str)
+        # Objekt für das Gerät aus Netbox holen
+        host = cache.get("dcim.devices", name=hostname)
         # Existierende Site config nicht überschreiben
-        if nb.dcim.devices.filter(name=hostname):
-                st = nb.dcim.devices.get(name=hostname).site.id
+        if host:
+                st = fieldId(host.site)
         else:
-                st = setSite(prefix_nb, prefix_str)
+                # Site aus dem kleinsten Prefix holen, in dem die IP liegt
+                st = cache.prefixes.site(result["ip"])
 
         # Schauen ob Platform in Netbox existiert, wenn nicht, dann erstellen
         if not platform_chk:
                 logging.info(f"Platform not in Netbox, creating {platform}")
-                nb.dcim.platforms.create(name=platform, slug=platform_slug)
-                tmp = nb.dcim.platforms.get(slug=platform_slug)
-                pf = tmp.id
+                pf = cache.create("dcim.platforms", name=platform, slug=platform_slug).id
         else:
                 logging.info(f"Platform {platform} already in Netbox")
-                tmp = nb.dcim.platforms.get(slug=platform_slug)
-                pf = tmp.id
+                pf = platform_chk.id
 
         # Dasselbe für Device Type
         if not device_type_chk:
                 logging.info(f"Device Type not in Netbox, creating {chassis}")
-                nb.dcim.device_types.create(model=chassis, slug=chassis, manufacturer=1)
-                tmp = nb.dcim.device_types.get(slug=chassis)
-                dt = tmp.id
+                dt = cache.create("dcim.device_types", model=chassis, slug=chassis, manufacturer=1).id
         else:
                 logging.info(f"Device Type {chassis} already in Netbox")
-                tmp = nb.dcim.device_types.get(slug=chassis)
-                dt = tmp.id
-
-        # Checken ob es sich um ein Stack handelt (in swpar chechken)
-        if not sw_errored:
-                slot_count = len(swpar["switch"]["stack"])
-        else:
-                slot_count = 1
+                dt = device_type_chk.id
 
-        if slot_count > 1:
+        if stacked:
                 logging.info(f"Stacked Device detected, setting Serial Number to None")
                 serial_num = ''
-                stacked = True
         else:
-                # Stacked setzen, damit Standalone Switche mit dem 'show switch' Command nicht als gestackt erkannt werden
-                stacked = False
                 logging.info(f"Device is not stacked, setting Serial Number to {serial_num}")
 
-        # Objekt für das Gerät aus Netbox holen
-        host = nb.dcim.devices.get(name=hostname)
         # Wenn Gerät in Netbox existiert, dann Daten updaten, ansonsten erstellen
         if host:
-                logging.info(f"Device {hostname} is already in netbox - updating information")
-                host.device_type = dt
-                host.platform = pf
-                host.serial = serial_num
-                host.site = st
-                host.custom_fields={'OS':os, 'Version':os_ver} # Bei verschachtelten Fields muss dass so gemacht werden
-                host.save()
+                logging.info(f"Device {hostname} is already in netbox - checking information")
+                host = writer.save("dcim.devices", host, device_type=dt, platform=pf, serial=serial_num, site=st, custom_fields={'OS':os, 'Version':os_ver})
         else:
                 logging.info(f"Device {hostname} is not in netbox, creating it now")
-                nb.dcim.devices.create(name=hostname, device_type=dt, platform=pf, serial=serial_num, role=1, status='active', site=st, custom_fields={'OS':os,'Version':os_ver}, primary_ip4=None, primary_ip6=None)
-                host = nb.dcim.devices.get(name=hostname) # Host Objekt neu holen, da es in diesem Fall vorher nicht existiert hat
+                host = cache.create("dcim.devices", name=hostname, device_type=dt, platform=pf, serial=serial_num, role=1, status='active', site=st, custom_fields={'OS':os,'Version':os_ver}, primary_ip4=None, primary_ip6=None)
                 logging.info(f"Device {hostname} created with ID {host.id} created")
+        cache.neighbors.discovered(hostname)
+        return host
 
-        # ---- Interfaces in Netbox erstellen und ergänzen ----
+# ---- Interfaces in Netbox erstellen und ergänzen ----
+def reconcileInterfaces(cache, host, intpar):
+        writer = cache.writer
+        hostname = host.name
         logging.info(f"Adding interfaces to {hostname}")
         # Für jede Interface im Interface Dictionary
         for interface_name, interface_data in intpar['interfaces'].items():
@@ -469,7 +1904,7 @@ def discoverCiscoDevice(nb,tb,device_name):
                 else:
                         chk_int_type = interface_data['type']
 
-                netbox_type = sortInterface(chk_int_type,"device")
+                netbox_type = interfaceType(interface_name, chk_int_type)
 
                 # Schauen ob das Interface einen Namen hat, wenn nicht dann 'N/A' setzen
                 if 'name' in interface_data:
@@ -478,219 +1913,929 @@ def discoverCiscoDevice(nb,tb,device_name):
                         desc = 'N/A'
 
                 # Wenn Interface in Netbox existiert, dann Daten updaten, ansonsten erstellen
-                interface = nb.dcim.interfaces.get(name=interface_name, device_id=host.id)
+                interface = cache.get("dcim.interfaces", device_id=host.id, name=interface_name)
                 if interface != None:
-                        logging.info(f"Interface {interface_name} already exists on Device {hostname} - updating information")
-                        interface.label = interface_data['status']
-                        interface.type = netbox_type
-                        interface.description = desc
-                        interface.save()
-                        nb.dcim.interfaces.get(name=interface_name, device_id=host.id)
+                        if writer.update("dcim.interfaces", interface, label=interface_data['status'], type=netbox_type, description=desc):
+                                logging.info(f"Interface {interface_name} changed on Device {hostname} - updating information")
+                        else:
+                                logging.debug(f"Interface {interface_name} on Device {hostname} is up to date")
                 else:
                         logging.info(f"Creating Interface {interface_name}")
-                        nb.dcim.interfaces.create(type=netbox_type, name=interface_name, device=host.id, label=interface_data['status'], description=desc)
-
-        # ---- CDP Nachbarn in Netbox erstellen und ergänzen ----
-        logging.info(f"Checking CDP Neighbors for {hostname}...")
-        removeLooseCables()
-        # Für jeden CDP Nachbarn
+                        writer.create("dcim.interfaces", type=netbox_type, name=interface_name, device=host.id, label=interface_data['status'], description=desc)
+        # Alle Interfaces des Gerätes auf einmal schicken, die CDP Nachbarn brauchen sie danach
+        writer.flush()
+
+# ---- CDP Nachbarn in Netbox erstellen und ergänzen ----
+# Die Nachbarn laufen parallel, Nachbarn mit gleichem Namen (z.B. zwei Uplinks zum selben Core) nacheinander
+# Die Kabel werden danach für alle Nachbarn zusammen abgeglichen
+def reconcileNeighbors(cache, host, cdppar):
+        logging.info(f"Checking CDP Neighbors for {host.name}...")
+        groups = {}
         for index, device_info in cdppar['index'].items():
-                # Daten aus CDP Nachbar extrahieren und korrekt formatieren
-                cdp_device_id = device_info.get('device_id', 'N/A')
-                cdp_device_id = cdp_device_id # .rstrip('.domain.ad') Wenn du eine AD Domäne im Namen von erkannten Geräten hast, dann kannst du das hier benutzen
-                cdp_device_role = device_info.get('capabilities', 'N/A')
-                cdp_device_role_slug = cdp_device_role.replace(' ', '_')
-                cdp_device_type = device_info.get('platform', 'N/A').replace('cisco ', '')
-                cdp_device_type_slug = cdp_device_type.replace(' ', '_')
-                cdp_platform = re.sub('^WS-', '', cdp_device_type).split('-')[0]
-                cdp_local_interface = device_info.get('local_interface', 'N/A')
-                cdp_port_id = device_info.get('port_id', 'N/A')
-                management_addresses = device_info.get('management_addresses', {})
-                cdp_native_vlan = device_info.get('native_vlan', 'N/A')
-                cdp_sw_ver = device_info.get('software_version', 'N/A')
-                if management_addresses:
-                        cdp_mgmt_ip = next(iter(management_addresses))
+                groups.setdefault(device_info.get('device_id', 'N/A'), []).append(device_info)
+        with METRICS.timer("reconcile.cdp"):
+                links, errors = asyncio.run(reconcileNeighborGroups(cache, host, groups))
+        with METRICS.timer("reconcile.cables"):
+                reconcileCables(cache, host, links)
+        if errors:
+                raise RuntimeError(f"{len(errors)} of {len(groups)} CDP neighbors failed: {', '.join(errors)}")
+
+async def reconcileNeighborGroups(cache, host, groups):
+        client = AsyncNetbox(cache)
+
+        async def reconcileGroup(neighbors):
+                links = []
+                for device_info in neighbors:
+                        link = await reconcileNeighbor(client, host, device_info)
+                        if link:
+                                links.append(link)
+                return links
+
+        results = await asyncio.gather(*(reconcileGroup(neighbors) for neighbors in groups.values()), return_exceptions=True)
+        links = []
+        errors = []
+        for cdp_device_id, result in zip(groups, results):
+                if isinstance(result, Exception):
+                        logging.error(f"Error adding CDP neighbor {cdp_device_id} of {host.name} to Netbox")
+                        logging.error(f"Exception: {result}")
+                        errors.append(cdp_device_id)
+                else:
+                        links += result
+        return links, errors
+
+# ---- Einen CDP Nachbarn in Netbox erstellen und ergänzen ----
+# Gibt das lokale Interface und den Port des Nachbarn zurück, damit die Kabel danach gesammelt abgeglichen werden können
+# Das Nachbar Gerät selbst wird nur einmal pro Lauf abgeglichen (siehe NeighborRegistry), pro Verbindung bleiben nur Interfaces und IP
+async def reconcileNeighbor(client, host, device_info):
+        registry = client.cache.neighbors
+        # Daten aus CDP Nachbar extrahieren und korrekt formatieren
+        cdp_device_id = device_info.get('device_id', 'N/A')
+        cdp_device_id = cdp_device_id # .rstrip('.domain.ad') Wenn du eine AD Domäne im Namen von erkannten Geräten hast, dann kannst du das hier benutzen
+        cdp_local_interface = device_info.get('local_interface', 'N/A')
+        cdp_port_id = device_info.get('port_id', 'N/A')
+        management_addresses = device_info.get('management_addresses', {})
+        cdp_native_vlan = device_info.get('native_vlan', 'N/A')
+        # Ohne Management IP kann weder Prefix noch Site bestimmt werden
+        if not management_addresses:
+                logging.warning(f"CDP neighbor {cdp_device_id} has no management address, skipping it")
+                return None
+        cdp_mgmt_ip = next(iter(management_addresses))
+
+        key = registry.key(cdp_device_id)
+        if key in registry.devices:
+                logging.debug(f"CDP neighbor {cdp_device_id} was already checked in this run")
+        else:
+                registry.devices[key] = await resolveNeighbor(client, registry, device_info, cdp_device_id, cdp_mgmt_ip)
+        cdp_device_host, cdp_ipint = registry.devices[key]
+
+        # Verbundenes Interface zum Nachbarn erstellen, wenn nicht vorhanden
+        cdp_local_interface_int, created = await client.getOrCreate("dcim.interfaces", {"name": cdp_local_interface}, device_id=host.id, name=cdp_local_interface, device=host.id, type=interfaceType(cdp_local_interface), enabled=True)
+        logging.info(f"Interface {cdp_local_interface} " + ("not in Netbox, created it" if created else "already in Netbox"))
+
+        # Wenn Interface des Nachbarn in Netbox nicht existiert, dann erstellen
+        netbox_type = interfaceType(cdp_port_id)
+        cdp_port_id_int, created = await client.getOrCreate("dcim.interfaces", {"name": cdp_port_id}, device_id=cdp_device_host.id, name=cdp_port_id, device=cdp_device_host.id, type=netbox_type, enabled=True)
+        if created:
+                logging.info(f"Interface {cdp_port_id} not in Netbox, created it")
+
+                # IP Adresse des Nachbarn zuweisen, wenn nicht vorhanden
+                if cdp_ipint.assigned_object_id:
+                        logging.info(f"IP Address {cdp_ipint.address} already assigned to {cdp_ipint.assigned_object_type} with ID {cdp_ipint.assigned_object_id}")
+                elif not cdp_native_vlan:
+                        logging.info(f"Assigning IP Address {cdp_ipint.address} to Interface {cdp_port_id}")
+                        cdp_ipint = await client.save("ipam.ip_addresses", cdp_ipint, assigned_object_type="dcim.interface", assigned_object_id=cdp_port_id_int.id)
+
+                        logging.info(f"Setting Primary IP Address {cdp_ipint.address} on Device {cdp_device_id}")
+                        cdp_device_host = await client.save("dcim.devices", cdp_device_host, primary_ip4=cdp_ipint.id)
+                # Wenn Native VLAN vorhanden, dann VLAN Interface erstellen und IP Adresse zuweisen
+                else:
+                        logging.info(f"Assigning IP Address {cdp_ipint.address} to Vlan{cdp_native_vlan}")
+                        vname = f"Vlan{cdp_native_vlan}"
+                        cdp_vlan_int, created = await client.getOrCreate("dcim.interfaces", {"name": vname}, device_id=cdp_device_host.id, name=vname, device=cdp_device_host.id, type=netbox_type, enabled=True)
+                        cdp_ipint = await client.save("ipam.ip_addresses", cdp_ipint, assigned_object_type="dcim.interface", assigned_object_id=cdp_vlan_int.id)
+
+                        logging.info(f"Setting Primary IP Address {cdp_ipint.address} on Device {cdp_device_id}")
+                        cdp_device_host = await client.save("dcim.devices", cdp_device_host, primary_ip4=cdp_ipint.id)
+
+                registry.devices[key] = (cdp_device_host, cdp_ipint)
+        else:
+                logging.info(f"Interface {cdp_port_id} already in Netbox")
+
+        return cdp_local_interface_int, cdp_port_id_int
+
+# ---- Ein CDP Nachbar Gerät auflösen, erstellen oder ergänzen ----
+# Platform, Device Type und Rolle werden pro (Modell, Capabilities) nur einmal aufgelöst, die Site kommt aus dem Prefix Index
+# Geräte die das Skript selbst entdeckt, werden mit den CDP Daten nicht überschrieben, sonst ändern Gerät und Nachbar sich jedes Mal gegenseitig
+# Gibt (Gerät, IP Adresse) zurück
+async def resolveNeighbor(client, registry, device_info, cdp_device_id, cdp_mgmt_ip):
+        cdp_device_role = device_info.get('capabilities', 'N/A')
+        cdp_device_role_slug = cdp_device_role.replace(' ', '_')
+        cdp_device_type = device_info.get('platform', 'N/A').replace('cisco ', '')
+        cdp_device_type_slug = cdp_device_type.replace(' ', '_')
+        # Für namen mit Leerzeichen, muss vor dem Suchen passieren, sonst wird die Platform bei jedem Nachbarn neu erstellt
+        cdp_platform = re.sub('^WS-', '', cdp_device_type).split('-')[0].replace(" ", "-")
+        cdp_sw_ver = device_info.get('software_version', 'N/A')
+
+        # OS des Nachbarn aus Software Version holen
+        if "IOS-XE" in cdp_sw_ver:
+                cdp_os = "IOS-XE"
+        elif "NX-OS" in cdp_sw_ver:
+                cdp_os = "NX-OS"
+        elif "IOS" in cdp_sw_ver:
+                cdp_os = "IOS"
+        else:
+                cdp_os = "N/A"
+        logging.info(f"OS of {cdp_device_id} is {cdp_os}" if cdp_os != "N/A" else f"OS of {cdp_device_id} could not be determined. Setting to N/A")
 
+        spec = (cdp_device_type, cdp_device_role)
+        if spec not in registry.specs:
                 # Wenn Platform in Netbox existiert, dann ID holen, ansonsten erstellen
-                if not nb.dcim.platforms.filter(slug=cdp_platform):
-                        logging.info(f"Platform {cdp_platform} not in Netbox, creating it now")
-                        # Für namen mit Leerzeichen
-                        cdp_platform = cdp_platform.replace(" ", "-")
-                        nb.dcim.platforms.create(name=cdp_platform, slug=cdp_platform)
-                        tmp = nb.dcim.platforms.get(slug=cdp_platform)
-                        pf = tmp.id
-                else:
-                        logging.info(f"Platform {cdp_platform} already in Netbox")
-                        tmp = nb.dcim.platforms.get(slug=cdp_platform)
-                        pf = tmp.id
+                tmp, created = await client.getOrCreate("dcim.platforms", {"slug": cdp_platform}, name=cdp_platform, slug=cdp_platform)
+                logging.info(f"Platform {cdp_platform} " + ("not in Netbox, created it" if created else "already in Netbox"))
+                pf = tmp.id
 
                 # Hier dasselbe für Device Type
-                if not nb.dcim.device_types.filter(slug=cdp_device_type_slug):
-                        logging.info(f"Device Type {cdp_device_type} not in Netbox, creating it now")
-                        nb.dcim.device_types.create(model=cdp_device_type, slug=cdp_device_type_slug, manufacturer=1)
-                        tmp = nb.dcim.device_types.get(slug=cdp_device_type_slug)
-                        dt = tmp.id
-                else:
-                        logging.info(f"Device Type {cdp_device_type} already in Netbox")
-                        tmp = nb.dcim.device_types.get(slug=cdp_device_type_slug)
-                        dt = tmp.id
-
-                # Wenn IP Adresse des Nachbarn in Netbox nicht existiert, dann erstellen
-                if not nb.ipam.ip_addresses.filter(address=cdp_mgmt_ip+"/24"):
-                        logging.info(f"IP Address {cdp_mgmt_ip}/24 not in Netbox, creating it now")
-                        nb.ipam.ip_addresses.create(address=cdp_mgmt_ip+"/24", status='online')
-                else:
-                        logging.info(f"IP Address {cdp_mgmt_ip}/24 already in Netbox")
-
-                cdp_ipint = nb.ipam.ip_addresses.get(address=cdp_mgmt_ip+"/24")
+                tmp, created = await client.getOrCreate("dcim.device_types", {"slug": cdp_device_type_slug}, model=cdp_device_type, slug=cdp_device_type_slug, manufacturer=1)
+                logging.info(f"Device Type {cdp_device_type} " + ("not in Netbox, created it" if created else "already in Netbox"))
+                dt = tmp.id
 
                 # 'Capabilities' als Device Role in Netbox erstellen wenn nicht vorhanden
-                if not nb.dcim.device_roles.filter(slug=cdp_device_role_slug.lower()):
-                        logging.info(f"Role {cdp_device_role} not in Netbox, creating it now")
-                        nb.dcim.device_roles.create(name=cdp_device_role, slug=cdp_device_role_slug.lower(), color=pickColor())
-                        tmp = nb.dcim.device_roles.get(slug=cdp_device_role_slug.lower())
-                        rl = tmp.id
+                tmp, created = await client.getOrCreate("dcim.device_roles", {"slug": cdp_device_role_slug.lower()}, name=cdp_device_role, slug=cdp_device_role_slug.lower(), color=pickColor())
+                if created:
+                        logging.info(f"Role {cdp_device_role} not in Netbox, created it")
 
                 # Wenn das Gerät "Switch" im ersten Wort hat, dann wird es die Switch Rolle bekommen
                 if cdp_device_role_slug.lower().split('_')[0] == 'switch':
                         logging.info(f"Device Role {cdp_device_role} is a switch, setting to switch")
-                        rl = nb.dcim.device_roles.get(slug='switch').id
+                        rl = (await client.get("dcim.device_roles", slug='switch')).id
                 else:
                         logging.info(f"Device Role {cdp_device_role} is not a switch, setting to {cdp_device_role_slug}")
-                        tmp = nb.dcim.device_roles.get(slug=cdp_device_role_slug.lower())
                         rl = tmp.id
-
-                # OS des Nachbarn aus Software Version holen
-                if "IOS-XE" in cdp_sw_ver:
-                        cdp_os = "IOS-XE"
-                        logging.info(f"OS of {cdp_device_id} is {cdp_os}")
-                elif "NX-OS" in cdp_sw_ver:
-                        cdp_os = "NX-OS"
-                        logging.info(f"OS of {cdp_device_id} is {cdp_os}")
-                elif "IOS" in cdp_sw_ver:
-                        cdp_os = "IOS"
-                        logging.info(f"OS of {cdp_device_id} is {cdp_os}")
+                registry.specs[spec] = (pf, dt, rl)
+        pf, dt, rl = registry.specs[spec]
+
+        # Wenn IP Adresse des Nachbarn in Netbox nicht existiert, dann erstellen, die Maske kommt aus dem Prefix
+        # Gesucht wird wie beim Gerät ohne Maske, eine veraltete Maske wird korrigiert
+        cdp_address = client.cache.prefixes.address(cdp_mgmt_ip)
+        cdp_ipint, created = await client.getOrCreate("ipam.ip_addresses", {"host": cdp_mgmt_ip}, address=cdp_address, status='online')
+        logging.info(f"IP Address {cdp_address} " + ("not in Netbox, created it" if created else "already in Netbox"))
+        if not created and cdp_ipint.address != cdp_address:
+                logging.info(f"Mask of IP Address {cdp_ipint.address} is outdated, updating to {cdp_address}")
+                cdp_ipint = await client.save("ipam.ip_addresses", cdp_ipint, address=cdp_address)
+
+        cdp_device_host = await client.get("dcim.devices", name=cdp_device_id)
+        # Wenn Device in Netbox nicht existiert, dann erstellen, ansonsten Daten updaten
+        if not cdp_device_host:
+                # Site aus dem kleinsten Prefix holen, in dem die IP des Nachbarn liegt
+                st = client.cache.prefixes.site(cdp_mgmt_ip)
+                logging.info(f"Device {cdp_device_id} not in Netbox, creating it now")
+                cdp_device_host, created = await client.getOrCreate("dcim.devices", {"name": cdp_device_id}, name=cdp_device_id, device_type=dt, platform=pf, role=rl, status='active', site=st, custom_fields={'OS':cdp_os}, primary_ip4=None, primary_ip6=None)
+        elif registry.isDiscovered(cdp_device_host):
+                logging.info(f"Device {cdp_device_id} is discovered by this script itself, not overwriting it with CDP data")
+        else:
+                logging.info(f"Device {cdp_device_id} already in Netbox - checking information")
+                cdp_device_host = await client.save("dcim.devices", cdp_device_host, device_type=dt, platform=pf, role=rl, site=fieldId(cdp_device_host.site), custom_fields={'OS':cdp_os})
+        return cdp_device_host, cdp_ipint
+
+# Was mit halbverbundenen Kabeln passiert: "remove" löscht sie, "report" meldet sie nur
+LOOSE_CABLES = os.getenv("LOOSE_CABLES", "remove")
+
+# ---- Funktion um die Interface IDs an beiden Enden eines Kabels zu holen ----
+# Terminierungen kommen von Netbox als Objekte, beim Planen ohne Netbox auch als dicts
+# Nur Interfaces, Front Ports usw. haben eigene IDs und würden sonst verwechselt
+def cableEnds(cable):
+        ends = []
+        for side in (cable.a_terminations, cable.b_terminations):
+                side = [t if isinstance(t, dict) else t.__dict__ for t in side or []]
+                ends.append(tuple(sorted(t["object_id"] for t in side if t.get("object_type") == "dcim.interface")))
+        return ends
+
+# ---- Funktion um die nötigen Kabel Änderungen zu planen ----
+# Bekommt die vorhandenen Kabel und die gewünschten Verbindungen (Interface ID, Interface ID) und macht selbst keine Requests
+# Ein Kabel das genau eine Verbindung abbildet bleibt, egal in welcher Richtung es in Netbox steht
+# Sonst wird ein Kabel, das an einem der beiden Interfaces hängt, umgehängt und weitere Kabel an den Interfaces gelöscht
+# Halbverbundene Kabel die übrig bleiben werden mit remove_loose gelöscht
+def planCables(cables, links, remove_loose=True):
+        plan = {"create": [], "update": [], "delete": [], "unchanged": 0, "conflicts": [], "loose": []}
+        index = {}
+        for cable in cables:
+                for interface_id in set(sum(cableEnds(cable), ())):
+                        index.setdefault(interface_id, []).append(cable)
+
+        # Doppelte Verbindungen (beide Richtungen) nur einmal, das lokale Interface bleibt die A Seite
+        wanted = {}
+        for link in links:
+                wanted.setdefault(frozenset(link), tuple(link))
+        used = set()
+        busy = set()
+        pending = []
+        for x, y in wanted.values():
+                match = next((cable for cable in index.get(x, []) if cable.id not in used and sorted(cableEnds(cable)) == sorted([(x,), (y,)])), None)
+                if match:
+                        used.add(match.id)
+                        busy |= {x, y}
+                        plan["unchanged"] += 1
                 else:
-                        cdp_os = "N/A"
-                        logging.info(f"OS of {cdp_device_id} could not be determined. Setting to N/A")
-
-                # Prefix des Nachbarn aus IP Adresse holen und schauen ob Prefix in Netbox existiert
-                prefix_str = str(ip_network(cdp_mgmt_ip+"/24", strict=False).supernet().network_address)+"/24"
-                logging.info(f"Checking Prefix {prefix_str}")
-                prefix_nb = nb.ipam.prefixes.get(prefix=prefix_str)
-                if nb.dcim.devices.filter(name=cdp_device_id):
-                        st = nb.dcim.devices.get(name=cdp_device_id).site.id
+                        pending.append((x, y))
+
+        for x, y in pending:
+                # Ein Interface kann nur ein Kabel haben, z.B. zwei CDP Nachbarn hinter einem Hub
+                if x in busy or y in busy:
+                        plan["conflicts"].append((x, y))
+                        continue
+                busy |= {x, y}
+                candidates = list({cable.id: cable for cable in index.get(x, []) + index.get(y, []) if cable.id not in used}.values())
+                used |= {cable.id for cable in candidates}
+                if candidates:
+                        plan["update"].append((candidates[0], x, y))
+                        plan["delete"] += candidates[1:]
                 else:
-                        st = setSite(prefix_nb, prefix_str)
+                        plan["create"].append((x, y))
 
-                # Wenn Device in Netbox nicht existiert, dann erstellen, ansonsten Daten updaten
-                if not nb.dcim.devices.filter(name=cdp_device_id):
-                        logging.info(f"Device {cdp_device_id} not in Netbox, creating it now")
-                        nb.dcim.devices.create(name=cdp_device_id, device_type=dt, platform=pf, role=rl, status='active', site=st, custom_fields={'OS':cdp_os}, primary_ip4=None, primary_ip6=None)
-                else:
-                        logging.info(f"Device {cdp_device_id} already in Netbox - updating information")
-                        cdp_device_host = nb.dcim.devices.get(name=cdp_device_id)
-                        cdp_device_host.device_type = dt
-                        cdp_device_host.platform = pf
-                        cdp_device_host.role = rl
-                        cdp_device_host.site = st
-                        cdp_device_host.custom_fields={'OS':cdp_os}
-                        cdp_device_host.save()
-
-                # Verbundenes Interface zum Nachbarn erstellen, wenn nicht vorhanden
-                if not nb.dcim.interfaces.filter(name=cdp_local_interface, device_id=host.id):
-                        netbox_type = sortInterface(cdp_local_interface,"cdp")
-
-                        logging.info(f"Interface {cdp_local_interface} not in Netbox, creating it now")
-                        nb.dcim.interfaces.create(name=cdp_local_interface, device=host.id, type=netbox_type, enabled=True)
+        for cable in cables:
+                if cable.id not in used and (not cable.a_terminations or not cable.b_terminations):
+                        used.add(cable.id)
+                        plan["delete" if remove_loose else "loose"].append(cable)
+        return plan
+
+# ---- Kabel zwischen den Interfaces des Gerätes und den Ports der Nachbarn abgleichen ----
+# Alle Kabel am Gerät und an den Nachbarn kommen mit einer Abfrage, danach wird nur noch geschickt was sich ändert
+def reconcileCables(cache, host, links):
+        writer = cache.writer
+        names = {}
+        valid = []
+        for local_int, port_int in links:
+                names[local_int.id] = local_int.name
+                names[port_int.id] = port_int.name
+                if "virtual" in (plainValue(local_int.type), plainValue(port_int.type)):
+                        logging.error(f"Can't create cable between {local_int.name} and {port_int.name}. One of the terminations is set to 'Virtual', this is most likely caused by a new interface type not found in interface_types.json. Please add the new type there and try again.")
+                        continue
+                valid.append((local_int.id, port_int.id))
+
+        # Geräte die erst im Plan erstellt werden (negative IDs) haben noch keine Kabel
+        device_ids = sorted(device_id for device_id in {host.id} | {fieldId(port_int.device) for local_int, port_int in links} if device_id > 0)
+        cables = list(cache.endpoint("dcim.cables").filter(device_id=device_ids, limit=NetboxCache.PAGE_SIZE)) if device_ids else []
+        if PLAN is not None:
+                interface_ids = {interface_id for link in valid for interface_id in link}
+                cables = PLAN.overlay("dcim.cables", cables, lambda cable: interface_ids & set(sum(cableEnds(cable), ())))
+        plan = planCables(cables, valid, LOOSE_CABLES != "report")
+        logging.info(f"Cables of {host.name}: {plan['unchanged']} up to date, {len(plan['create'])} to create, {len(plan['update'])} to update, {len(plan['delete'])} to delete")
+
+        for x, y in plan["conflicts"]:
+                logging.warning(f"Not cabling {names[x]} and {names[y]}, one of them is already cabled to another CDP neighbor")
+        for cable in plan["loose"]:
+                logging.info(f"Cable with ID {cable.id} has loose terminations, not removing it because of report mode")
+                writer.counts[("dcim.cables", "loose")] += 1
+        for cable in plan["delete"]:
+                logging.info(f"Removing cable with ID {cable.id}")
+                writer.delete("dcim.cables", cable)
+        for cable, x, y in plan["update"]:
+                logging.info(f"Cable exists on {names[x]} or {names[y]}, updating terminations")
+                writer.update("dcim.cables", cable, a_terminations=[{'object_type':'dcim.interface','object_id':x}], b_terminations=[{'object_type':'dcim.interface','object_id':y}])
+        # Löschen und Umhängen zuerst, damit die Interfaces für neue Kabel frei sind
+        writer.flush()
+        for x, y in plan["create"]:
+                logging.info(f"Creating Cable between {names[x]} and {names[y]}")
+                writer.create("dcim.cables", a_terminations=[{'object_type':'dcim.interface','object_id':x}], b_terminations=[{'object_type':'dcim.interface','object_id':y}], status='connected')
+        writer.flush()
+
+# ---- Funktion um alle halbverbundenen Kabel in Netbox einmal pro Lauf zu finden ----
+# Die Worker prüfen nur die Kabel ihrer Geräte, das findet keine Kabel ohne jede Terminierung und keine an Geräten die kein Shard hatte
+# Läuft deshalb nur im Coordinator, nachdem alle Shards fertig sind
+def sweepLooseCables(cache):
+        writer = cache.writer
+        logging.info("Checking all cables in Netbox for loose terminations")
+        for cable in cache.endpoint("dcim.cables").all(limit=NetboxCache.PAGE_SIZE):
+                if cable.a_terminations and cable.b_terminations:
+                        continue
+                if LOOSE_CABLES == "report":
+                        logging.info(f"Cable with ID {cable.id} has loose terminations, not removing it because of report mode")
+                        writer.counts[("dcim.cables", "loose")] += 1
                 else:
-                        logging.info(f"Interface {cdp_local_interface} already in Netbox")
-
-                # Wenn Interface des Nachbarn in Netbox nicht existiert, dann erstellen
-                if not nb.dcim.interfaces.filter(name=cdp_port_id, device=cdp_device_id):
-                        netbox_type = sortInterface(cdp_port_id, "cdp")
-
-                        logging.info(f"Interface {cdp_port_id} not in Netbox, creating it now")
-                        cdp_device_host = nb.dcim.devices.get(name=cdp_device_id)
-                        nb.dcim.interfaces.create(name=cdp_port_id, device=cdp_device_host.id, type=netbox_type, enabled=True)
-
-                        cdp_port_id_int = nb.dcim.interfaces.get(name=cdp_port_id, device_id=cdp_device_host.id)
-                        cdp_local_interface_int = nb.dcim.interfaces.get(name=cdp_local_interface, device_id=host.id)
-
-                        # IP Adresse des Nachbarn zuweisen, wenn nicht vorhanden
-                        if cdp_ipint.assigned_object_id:
-                                logging.info(f"IP Address {cdp_mgmt_ip}/24 already assigned to {cdp_ipint.assigned_object_type} with ID {cdp_ipint.assigned_object_id}")
-                        elif not cdp_native_vlan:
-                                logging.info(f"Assigning IP Address {cdp_mgmt_ip}/24 to Interface {cdp_port_id}")
-                                cdp_ipint.assigned_object_id = cdp_port_id_int.id
-                                cdp_ipint.assigned_object_type = "dcim.interface"
-                                cdp_ipint.save()
-
-                                logging.info(f"Setting Primary IP Address {cdp_mgmt_ip}/24 on Device {cdp_device_id}")
-                                cdp_ipset = nb.dcim.devices.get(name=cdp_device_id)
-                                cdp_ipset.primary_ip4 = cdp_ipint.id
-                                cdp_ipset.save()
-                        # Wenn Native VLAN vorhanden, dann VLAN Interface erstellen und IP Adresse zuweisen
-                        else:
-                                logging.info(f"Assigning IP Address {cdp_mgmt_ip}/24 to Vlan{cdp_native_vlan}")
-                                vname = f"Vlan{cdp_native_vlan}"
-                                nb.dcim.interfaces.create(name=vname, device=cdp_device_host.id, type=netbox_type, enabled=True)
-                                cdp_vlan_int = nb.dcim.interfaces.get(name=vname, device_id=cdp_device_host.id)
-                                cdp_ipint.assigned_object_id = cdp_vlan_int.id
-                                cdp_ipint.assigned_object_type = "dcim.interface"
-                                cdp_ipint.save()
-
-                                logging.info(f"Setting Primary IP Address {cdp_mgmt_ip}/24 on Device {cdp_device_id}")
-                                cdp_ipset = nb.dcim.devices.get(name=cdp_device_id)
-                                cdp_ipset.primary_ip4 = cdp_ipint.id
-                                cdp_ipset.save()
+                        logging.info(f"Removing cable with ID {cable.id}")
+                        writer.delete("dcim.cables", cable)
+        writer.flush()
+
+# ---- Funktion für die Prozesse im Process Pool und für gecrawlte Geräte ----
+# Genie Geräte lassen sich nicht pickeln, deshalb wird nur (Name, OS, IP) übergeben und das Gerät hier erstellt
+def collectWorker(spec, timeout, parse=True, skip=()):
+        return collectCiscoDevice(makeDevice(*spec), timeout, parse, skip)
+
+# ---- Funktion um (Name, OS, IP) eines Gerätes zu holen ----
+def deviceSpec(dev):
+        return (dev.name, dev.os, str(dev.connections['cli'].ip))
+
+# ---- CDP Crawl ----
+# Nachbarn mit Management IP und IOS/IOS-XE Software werden im selben Lauf entdeckt, nicht erst beim nächsten
+# Doppelte werden über Name und IP erkannt, max_depth zählt die Sprünge ab dem Testbed, max_devices begrenzt den ganzen Lauf
+# Bei verteilten Läufen crawlt jeder Worker nur Nachbarn die auf seinen Shard fallen, sonst würden sie mehrfach gesammelt
+# Der Shard wird wie bei switchSpecs bestimmt, mit shard_by "site" also über die Site und nicht über den Namen
+class Crawler:
+        def __init__(self, max_depth=3, max_devices=500, shard=None, shards=1, shard_by="hash"):
+                self.max_depth = max_depth
+                self.max_devices = max_devices
+                self.shard = shard
+                self.shards = shards
+                self.shard_by = shard_by
+                # Site ID -> Slug, für shard_by "site"
+                self.sites = {}
+                self.depth = {}
+                self.addresses = set()
+                self.specs = {}
+                self.limited = False
+
+        # Geräte aus dem Testbed kommen nach und nach, gibt False zurück wenn das Gerät schon gecrawlt wurde
+        def seed(self, device_name, ip):
+                if device_name in self.depth or ip in self.addresses:
+                        return False
+                self.depth[device_name] = 0
+                self.addresses.add(ip)
+                return True
+
+        # Gecrawlte Geräte aus dem Journal eines abgebrochenen Laufs wieder aufnehmen, gibt ihre Namen zurück
+        def restore(self, entries):
+                for spec, depth in entries:
+                        self.depth[spec[0]] = depth
+                        self.addresses.add(spec[2])
+                        self.specs[spec[0]] = spec
+                return [spec[0] for spec, depth in entries]
+
+        # Schlüssel für den Shard eines Nachbarn, derselbe wie bei switchSpecs
+        # Bei "site" ist es die Site die das Gerät in Netbox hat, bzw. die es wie in reconcileDevice über seinen Prefix bekommen würde
+        def shardKey(self, cache, device_name, ip):
+                if self.shard_by != "site":
+                        return device_name
+                host = cache.get("dcim.devices", name=device_name)
+                site_id = fieldId(host.site) if host else cache.prefixes.site(ip)
+                if site_id not in self.sites:
+                        site = cache.nb.dcim.sites.get(site_id)
+                        self.sites[site_id] = site.slug if site else str(site_id)
+                return self.sites[site_id]
+
+        # Neue Nachbarn eines gesammelten Gerätes, gibt die Namen zurück die noch gesammelt werden müssen
+        def neighbors(self, result, cache=None):
+                depth = self.depth.get(result["device"], 0) + 1
+                found = []
+                if depth > self.max_depth:
+                        return found
+                for device_info in result["parsed"].get("cdp", {}).get("index", {}).values():
+                        device_name = device_info.get("device_id")
+                        addresses = device_info.get("management_addresses") or {}
+                        software = device_info.get("software_version", "")
+                        # Telefone, Access Points und NX-OS können mit diesem Skript nicht entdeckt werden
+                        if not device_name or not addresses or "IOS" not in software or "NX-OS" in software:
+                                continue
+                        ip = next(iter(addresses))
+                        if device_name in self.depth or ip in self.addresses:
+                                continue
+                        if self.shards > 1 and shardOf(self.shardKey(cache, device_name, ip), self.shards) != self.shard:
+                                continue
+                        if len(self.depth) >= self.max_devices:
+                                if not self.limited:
+                                        logging.warning(f"Reached the crawl limit of {self.max_devices} devices, not adding any more neighbors")
+                                        self.limited = True
+                                break
+                        dev_os = "iosxe" if re.search(r"IOS[- ]?XE", software) else "ios"
+                        self.depth[device_name] = depth
+                        self.addresses.add(ip)
+                        self.specs[device_name] = (device_name, dev_os, ip)
+                        found.append(device_name)
+                        logging.info(f"Found {device_name} ({ip}, {dev_os}) in the CDP neighbors of {result['device']}, adding it to the crawl at depth {depth}")
+                return found
+
+# Journal bzw. Work Store des Laufs, wird in main gesetzt
+WORK = None
+
+# ---- Funktionen um das Ergebnis eines Gerätes in der Zusammenfassung und im Work Store festzuhalten ----
+# Mit status "vlans" fehlen noch die VLANs des Gerätes, --resume macht es dann noch einmal bis applyVlans() es abschließt
+def deviceSucceeded(summary, device_name, status="done"):
+        summary["succeeded"].append(device_name)
+        if WORK is not None:
+                WORK.device(device_name, status)
+
+def deviceFailed(summary, device_name, reason):
+        summary["failed"][device_name] = reason
+        if WORK is not None:
+                WORK.device(device_name, "failed", reason)
+
+# ---- Funktion um ein gesammeltes Gerät in Netbox einzutragen und in der Zusammenfassung zu zählen ----
+# Mit Fingerabdrücken werden Abschnitte übersprungen, deren Ausgaben sich seit dem letzten erfolgreichen Lauf nicht geändert haben
+def reconcileResult(nb, result, summary, cache, store=None, full=False):
+        device_name = result["device"]
+        skip = set()
+        if store is not None:
+                hashes = fingerprints(result)
+                if not full:
+                        skip = store.unchangedSections(device_name, hashes)
+        # Die Rohausgaben braucht ab hier niemand mehr, der Snapshot ist schon geschrieben
+        result.pop("raw", None)
+        # Beim Weitermachen nach einem Abbruch sind manche Abschnitte schon in diesem Lauf eingetragen worden
+        resumed = WORK.sectionsDone(device_name) - skip if WORK is not None else set()
+        if resumed:
+                logging.info(f"Resuming {device_name}, sections finished before the interruption: {', '.join(sorted(resumed))}")
+        METRICS.device = device_name
+        try:
+                with METRICS.timer("reconcile"):
+                        failed = reconcileCiscoDevice(nb, result, cache, skip | resumed)
+        except Exception as e:
+                logging.error(f"Error adding {device_name} to Netbox")
+                logging.error(f"Exception: {e}")
+                deviceFailed(summary, device_name, f"reconcile failed: {e}")
+                return
+        finally:
+                METRICS.device = None
+        # Die VLANs stehen erst nach applyVlans() in Netbox, bis dahin wird ihr Fingerabdruck zurückgehalten
+        queued = device_name in cache.vlans.devices
+        if queued and store is not None:
+                cache.vlans.fingerprints[device_name] = hashes.pop("vlan")
+        # Abschnitte mit fehlgeschlagenen Objekten werden beim nächsten Lauf wiederholt, ihre Befehle bekommen keinen Fingerabdruck
+        # Ein schon gespeicherter wird gelöscht, sonst würde der Abschnitt (z.B. mit --full) danach trotzdem übersprungen
+        if failed and store is not None:
+                commands = {command for section in failed for command in SECTION_COMMANDS[section]}
+                hashes = {command: digest for command, digest in hashes.items() if command not in commands}
+                if PLAN is None:
+                        store.forget(device_name, commands)
+        # Im Plan Modus werden die Fingerabdrücke erst von --apply gespeichert, sonst würde der Plan nie eingetragen
+        if PLAN is not None and store is not None:
+                PLAN.fingerprints[device_name] = hashes
+        elif store is not None:
+                store.store(device_name, hashes)
+        if failed:
+                deviceFailed(summary, device_name, f"writes failed in sections: {', '.join(sorted(failed))}")
+        else:
+                deviceSucceeded(summary, device_name, "vlans" if queued else "done")
+        summary["skipped_sections"] = summary.get("skipped_sections", 0) + len(skip)
+
+# ---- Funktion um die VLANs des Laufs zu schreiben und die Geräte danach abzuschließen ----
+# Erst wenn die VLANs eines Gerätes wirklich in Netbox sind, kommt der Abschnitt ins Journal und sein Fingerabdruck in den Store
+# Sonst zählt das Gerät als fehlgeschlagen und der alte Fingerabdruck wird gelöscht, damit der nächste Lauf die VLANs wiederholt
+def applyVlans(cache, summary, store=None):
+        with METRICS.timer("reconcile.vlans"):
+                done, failed = cache.vlans.apply()
+        for device_name in done:
+                digest = cache.vlans.fingerprints.pop(device_name, None)
+                if digest is not None and PLAN is not None:
+                        PLAN.fingerprints.setdefault(device_name, {})["vlan"] = digest
+                elif digest is not None and store is not None:
+                        store.store(device_name, {"vlan": digest})
+                if WORK is not None:
+                        WORK.section(device_name, "vlan")
+                        if device_name in summary["succeeded"]:
+                                WORK.device(device_name, "done")
+        for device_name in failed:
+                cache.vlans.fingerprints.pop(device_name, None)
+                if store is not None and PLAN is None:
+                        store.forget(device_name, ["vlan"])
+                # Geräte die schon vorher fehlgeschlagen sind, behalten ihren ersten Fehler
+                if device_name in summary["succeeded"]:
+                        summary["succeeded"].remove(device_name)
+                        deviceFailed(summary, device_name, "VLANs could not be written to Netbox")
+
+# ---- Funktion um die Rohausgaben eines Gerätes über den ParseCache zu parsen ----
+# Gibt False zurück wenn das Parsen fehlgeschlagen ist, das Gerät zählt dann als fehlgeschlagen
+def parseResult(parser, result, summary):
+        try:
+                result.update(parser.parse(result))
+        except Exception as e:
+                logging.error(f"Error parsing the output of {result['device']}")
+                logging.error(f"Exception: {e}")
+                deviceFailed(summary, result["device"], f"parsing failed: {e}")
+                return False
+        return True
+
+# ---- Funktion um ein Gerät zu überspringen, das beim abgebrochenen Lauf schon fertig geworden ist ----
+def alreadyDone(summary, device_name):
+        if WORK is None or not WORK.isDone(device_name):
+                return False
+        logging.debug(f"Skipping {device_name}, it was already finished before the run was resumed")
+        summary["resumed"] = summary.get("resumed", 0) + 1
+        return True
+
+# ---- Funktion um den höchsten Speicherverbrauch (Peak RSS) des Laufs zu holen ----
+# ru_maxrss ist unter Linux in KB, unter macOS in Bytes. Prozesse im Process Pool zählen extra, dort der größte
+# RUSAGE_CHILDREN kennt nur beendete und eingesammelte Prozesse, deshalb müssen die Pools vorher beendet sein
+def peakMemory():
+        scale = 1 if sys.platform == "darwin" else 1024
+        return {
+                "main_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2**20, 1),
+                "workers_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 2**20, 1),
+        }
 
+# ---- Funktion um die Zusammenfassung eines Laufs auszugeben ----
+def logSummary(summary, phase, cache=None):
+        summary["duration"] = round(time.monotonic() - summary["started"], 2)
+        logging.info(f"Phase '{phase}' finished in {summary['duration']}s: {len(summary['succeeded'])} succeeded, {len(summary['failed'])} failed")
+        if summary.get("resumed"):
+                logging.info(f"Skipped {summary['resumed']} devices that were already finished before the run was resumed")
+        if summary.get("skipped_sections"):
+                logging.info(f"Skipped {summary['skipped_sections']} unchanged sections, use --full to process everything")
+        areas, requests = METRICS.breakdown()
+        if areas:
+                logging.info("Time spent: " + ", ".join(f"{area} {seconds}s" for area, seconds in sorted(areas.items())) + f", {requests} Netbox API requests")
+        if summary.get("crawled"):
+                logging.info(f"Crawled {summary['crawled']} devices that were found through CDP")
+        if summary.get("parse"):
+                logging.info(f"Parsed {summary['parse']['misses']} outputs, {summary['parse']['hits']} came from the parse cache")
+        if cache is not None:
+                summary["cache"] = cache.stats()
+                hits = sum(stat["hits"] for stat in summary["cache"].values())
+                misses = sum(stat["misses"] for stat in summary["cache"].values())
+                logging.info(f"Netbox cache: {hits} lookups answered from memory with {misses} bulk loads, saved about {hits - misses} API calls")
+                summary["writes"] = cache.writer.stats()
+                writes = summary["writes"]
+                logging.info(f"Netbox writes: {writes.get('created', 0)} created, {writes.get('updated', 0)} updated, {writes.get('deleted', 0)} deleted, {writes.get('unchanged', 0)} unchanged, {writes.get('failed', 0)} failed in {writes['requests']} requests")
+                if writes.get("loose"):
+                        logging.info(f"Found {writes['loose']} loose cables, nothing was removed because of --loose-cables report")
+        if METRICS.limiter is not None:
+                summary["limiter"] = METRICS.limiter.stats()
+                limiter = summary["limiter"]
+                if limiter["throttled"] or limiter["slow"] or limiter["waited_seconds"]:
+                        logging.info(f"Netbox rate limiter: {limiter['throttled']} throttled and {limiter['slow']} slow responses, lowered {limiter['lowered']} times, waited {limiter['waited_seconds']}s, now " + (f"{limiter['rate']} requests/s" if limiter["rate"] else "no rate limit") + f" and {limiter['concurrency']} requests at the same time")
+        summary["memory"] = peakMemory()
+        logging.info(f"Peak memory: {summary['memory']['main_mb']} MB" + (f", biggest process worker {summary['memory']['workers_mb']} MB" if summary["memory"]["workers_mb"] else ""))
+        for device_name, reason in summary["failed"].items():
+                logging.info(f"Failed: {device_name} ({reason})")
+        return summary
+
+# ---- Funktion um mehrere Geräte gleichzeitig zu entdecken ----
+# Sammeln läuft parallel im Pool, das Eintragen in Netbox läuft nacheinander im Hauptthread sobald ein Gerät fertig ist
+# Bei phase "collect" wird nur gesammelt und als Snapshot gespeichert, Netbox wird dann gar nicht angefasst
+# Mit parser wird erst im Hauptprozess über den ParseCache geparst, sonst direkt beim Sammeln
+# Mit crawler werden neue CDP Nachbarn direkt mit in den Pool gegeben
+# devices kann auch ein Generator sein, es werden nur so viele Geräte geholt wie gerade Platz im Pool ist
+# Mit capabilities werden Befehle, die die Plattform eines Gerätes nicht kann, gar nicht erst geschickt, außer mit full
+def runDiscovery(nb, devices, workers=1, pool="thread", timeout=300, phase="all", snapshot_dir=None, store=None, full=False, parser=None, crawler=None, capabilities=None):
+        summary = {"succeeded": [], "failed": {}, "started": time.monotonic()}
+        cache = NetboxCache(nb)
+        if pool == "process":
+                executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+        else:
+                executor = ThreadPoolExecutor(max_workers=workers)
+        logging.info(f"Collecting devices with {workers} {pool} worker(s)")
+
+        futures = {}
+        pending = set()
+        devices = iter(devices)
+        crawled = deque()
+        # Beim Weitermachen kommen die gecrawlten Geräte aus dem Journal, die fertigen überspringt refill()
+        if crawler is not None and WORK is not None and WORK.resume:
+                crawled.extend(crawler.restore(WORK.crawledDevices()))
+                if crawled:
+                        logging.info(f"Resuming the crawl with {len(crawled)} devices found before the interruption")
+
+        def submit(dev=None, spec=None):
+                device_name = spec[0] if dev is None else dev.name
+                skip = capabilities.skipped(device_name) if capabilities is not None and not full else set()
+                if pool == "process" or dev is None:
+                        future = executor.submit(collectWorker, spec or deviceSpec(dev), timeout, parser is None, skip)
                 else:
-                        logging.info(f"Interface {cdp_port_id} already in Netbox")
-
-                # Kabel zwischen Interface und Port erstellen, wenn nicht vorhanden
-                # Richtig komisch, dass die filter keys anders sind als die, die ich beim erstellen setze
-                cdp_port_id_int = nb.dcim.interfaces.get(name=cdp_port_id, device_id=cdp_device_host.id)
-                cdp_local_interface_int = nb.dcim.interfaces.get(name=cdp_local_interface, device_id=host.id)
-
-                # Muss beide Richtungen checken, wenn beide Terminierungsobjekte Switche sind
-                existing_cables = nb.dcim.cables.get(termination_a_id=cdp_local_interface_int.id, termination_b_id=cdp_port_id_int.id)
-                existing_cables_b = nb.dcim.cables.get(termination_a_id=cdp_port_id_int.id, termination_b_id=cdp_local_interface_int.id)
-                term = nb.dcim.cables.get(termination_b_id=cdp_port_id_int.id)
-                term_b = nb.dcim.cables.get(termination_b_id=cdp_local_interface_int.id)
-                if not existing_cables and not existing_cables_b:
-                        # Die beiden Ifs sind um zu checken, ob die Terminierungen in Netbox noch die realität abbilden
-                        if term != None:
-                                logging.info(f"Cable exists between {cdp_local_interface} and {cdp_port_id}, updating terminations")
-                                term.a_terminations = [{'object_type':'dcim.interface','object_id':cdp_local_interface_int.id}]
-                                term.b_terminations = [{'object_type':'dcim.interface','object_id':cdp_port_id_int.id}]
-                                term.save()
-                        elif term_b != None:
-                                logging.info(f"Cable exists between {cdp_local_interface} and {cdp_port_id}, updating terminations")
-                                term_b.a_terminations = [{'object_type':'dcim.interface','object_id':cdp_port_id_int.id}]
-                                term_b.b_terminations = [{'object_type':'dcim.interface','object_id':cdp_local_interface_int.id}]
-                                term_b.save()
-                        else:
-                                logging.info(f"Creating Cable between {cdp_local_interface} and {cdp_port_id}")
+                        future = executor.submit(collectCiscoDevice, dev, timeout, parser is None, skip)
+                futures[future] = device_name
+                pending.add(future)
+
+        # Pool auffüllen, gecrawlte Nachbarn zuerst, damit der Crawl nicht auf das ganze Testbed warten muss
+        def refill():
+                while len(pending) < workers * 2:
+                        if crawled:
+                                device_name = crawled.popleft()
+                                if not alreadyDone(summary, device_name):
+                                        submit(spec=crawler.specs[device_name])
+                                continue
+                        dev = next(devices, None)
+                        if dev is None:
+                                return
+                        if crawler is not None and not crawler.seed(dev.name, str(dev.connections['cli'].ip)):
+                                continue
+                        if alreadyDone(summary, dev.name):
+                                continue
+                        submit(dev)
+
+        refill()
+
+        # Startzeit merken sobald ein Gerät wirklich läuft, damit wartende Geräte nicht in den Timeout laufen
+        started = {}
+        try:
+                while pending:
+                        done = wait(pending, timeout=1, return_when=FIRST_COMPLETED).done
+                        pending -= done
+                        for future in done:
+                                # Futures nach dem Abholen vergessen, sonst bleibt das Ergebnis jedes Gerätes bis zum Ende des Laufs im Speicher
+                                device_name = futures.pop(future)
+                                started.pop(future, None)
                                 try:
-                                        nb.dcim.cables.create(a_terminations=[{'object_type':'dcim.interface','object_id':cdp_local_interface_int.id}], b_terminations=[{'object_type':'dcim.interface','object_id':cdp_port_id_int.id}], status='connected')
-                                except pynetbox.core.query.RequestError as e:
-                                        logging.error(f"Error creating cable between {cdp_local_interface} and {cdp_port_id}. This is most likely caused by a new interface type not found in sortInterface() and one of the terminations being set to 'Virtual'. Please add the new type to sortInterface() and try again.")
-                                        logging.debug(f"Exception: {e}")
+                                        result = future.result()
+                                except Exception as e:
+                                        deviceFailed(summary, device_name, f"collection failed: {e}")
+                                        continue
+                                if capabilities is not None:
+                                        capabilities.learn(result)
+                                if parser is not None and not parseResult(parser, result, summary):
+                                        continue
+                                METRICS.observeResult(result)
+                                # Nachbarn schon sammeln während dieses Gerät in Netbox eingetragen wird
+                                if crawler is not None:
+                                        found = crawler.neighbors(result, cache)
+                                        if WORK is not None:
+                                                for name in found:
+                                                        WORK.crawled(crawler.specs[name], crawler.depth[name])
+                                        crawled.extend(found)
+                                        refill()
+                                if snapshot_dir:
+                                        saveSnapshot(result, snapshot_dir)
+                                if phase == "collect":
+                                        deviceSucceeded(summary, device_name)
+                                        continue
+                                reconcileResult(nb, result, summary, cache, store, full)
+
+                        now = time.monotonic()
+                        for future in list(pending):
+                                if future.running():
+                                        started.setdefault(future, now)
+                                if future in started and now - started[future] > timeout:
+                                        # Threads lassen sich nicht abbrechen, das Ergebnis wird einfach ignoriert
+                                        device_name = futures.pop(future)
+                                        started.pop(future)
+                                        logging.error(f"Collecting {device_name} took longer than {timeout} seconds, giving up on it")
+                                        deviceFailed(summary, device_name, f"timed out after {timeout}s")
+                                        future.cancel()
+                                        pending.discard(future)
+                        refill()
+        finally:
+                # Prozesse werden abgewartet, sonst sind sie beim Messen vom Peak RSS noch nicht eingesammelt
+                # Threads nicht, ein hängendes Gerät würde sonst das Ende des Laufs aufhalten
+                executor.shutdown(wait=pool == "process", cancel_futures=True)
+                # VLANs aller eingetragenen Geräte, auch wenn der Lauf abgebrochen wurde
+                applyVlans(cache, summary, store)
+
+        if parser is not None:
+                parser.shutdown()
+                summary["parse"] = parser.stats()
+        if crawler is not None:
+                summary["crawled"] = len(crawler.specs)
+        return logSummary(summary, phase, cache if phase != "collect" else None)
+
+# ---- Funktion um gespeicherte Snapshots in Netbox einzutragen ----
+# Braucht keine Verbindung zu den Switchen, kann also beliebig oft offline wiederholt werden
+def replaySnapshots(nb, snapshot_dir, store=None, full=False):
+        summary = {"succeeded": [], "failed": {}, "started": time.monotonic()}
+        cache = NetboxCache(nb)
+        paths = listSnapshots(snapshot_dir)
+        logging.info(f"Reconciling {len(paths)} snapshots from {snapshot_dir}")
+        for path in paths:
+                try:
+                        result = loadSnapshot(path)
+                        result.pop("timings", None)
+                except Exception as e:
+                        logging.error(f"Error reading snapshot {path}")
+                        logging.error(f"Exception: {e}")
+                        deviceFailed(summary, path, f"unreadable snapshot: {e}")
+                        continue
+                if alreadyDone(summary, result["device"]):
+                        continue
+                reconcileResult(nb, result, summary, cache, store, full)
+        applyVlans(cache, summary, store)
+        return logSummary(summary, "reconcile", cache)
+
+# ---- Funktion um Rohausgaben aus Textdateien ohne Verbindung zu den Switchen zu verarbeiten ----
+# Wie ein normaler Lauf, nur kommen die Ausgaben aus raw_dir statt von den Geräten
+def replayRaw(nb, raw_dir, parser, phase="all", snapshot_dir=None, store=None, full=False):
+        summary = {"succeeded": [], "failed": {}, "started": time.monotonic()}
+        cache = NetboxCache(nb)
+        paths = listRawDevices(raw_dir)
+        logging.info(f"Parsing raw output of {len(paths)} devices from {raw_dir}")
+        for path in paths:
+                try:
+                        result = loadRawDevice(path)
+                except Exception as e:
+                        logging.error(f"Error reading raw output from {path}")
+                        logging.error(f"Exception: {e}")
+                        deviceFailed(summary, path, f"unreadable raw output: {e}")
+                        continue
+                if alreadyDone(summary, result["device"]):
+                        continue
+                if not parseResult(parser, result, summary):
+                        continue
+                METRICS.observeResult(result)
+                if snapshot_dir:
+                        saveSnapshot(result, snapshot_dir)
+                if phase == "collect":
+                        deviceSucceeded(summary, result["device"])
+                        continue
+                reconcileResult(nb, result, summary, cache, store, full)
+        applyVlans(cache, summary, store)
+        parser.shutdown()
+        summary["parse"] = parser.stats()
+        return logSummary(summary, phase, cache if phase != "collect" else None)
+
+# ---- Coordinator für verteilte Läufe ----
+# Wartet bis alle Shards im Work Store als fertig eingetragen sind und macht dann die gemeinsamen Aufräumarbeiten genau einmal
+# Fehlt ein Shard auch nach wait_seconds noch, wird nicht aufgeräumt, weil seine Geräte eventuell noch halb eingetragen sind
+def coordinateRun(nb, work, shards, wait_seconds=0):
+        summary = {"succeeded": [], "failed": {}, "started": time.monotonic()}
+        deadline = time.monotonic() + wait_seconds
+        while True:
+                status = work.shardStatus()
+                finished = [shard for shard in range(shards) if status.get(shard, ("missing",))[0] == "finished"]
+                if len(finished) == shards or time.monotonic() >= deadline:
+                        break
+                logging.info(f"{len(finished)} of {shards} shards of run '{work.run_id}' finished, waiting")
+                time.sleep(10)
+
+        for shard in range(shards):
+                state, worker = status.get(shard, ("missing", None))
+                logging.info(f"Shard {shard}: {state}" + (f" on {worker}" if worker else ""))
+        cache = None
+        if len(finished) == shards:
+                cache = NetboxCache(nb)
+                with METRICS.timer("reconcile.cables"):
+                        sweepLooseCables(cache)
+        else:
+                logging.error(f"Only {len(finished)} of {shards} shards finished, skipping the shared cleanup")
+                summary["failed"]["coordinator"] = "not all shards finished"
 
+        for device_name, shard, state, error in work.devices():
+                if state == "done":
+                        summary["succeeded"].append(device_name)
                 else:
-                        logging.info(f"Cable between {cdp_local_interface} and {cdp_port_id} already exists")
-        # Inventory und Module in Netbox erstellen und ergänzen
-        createInventory(invpar,hostname,host,stacked)
-        logging.info(f"Finished processing {hostname}")
-
-# Testbed erstellen und dann an Genie weitergeben
-tb = MakeTestbed()
-logging.info("Loading testbed into Genie")
-tb = load(tb)
-
-# ---- Parsing und Verarbeitung der Daten ----
-for device_name,device in tb.devices.items():
-        # Nur Cisco Geräte verarbeiten
-        if 'ios' in device.os or 'iosxe' in device.os:
-                discoverCiscoDevice(nb,tb,device_name)
\ No newline at end of file
+                        summary["failed"][device_name] = f"shard {shard}: {error}"
+        return logSummary(summary, "coordinate", cache)
+
+# ---- Funktion um einen gespeicherten Plan in Netbox einzutragen ----
+# Aufeinanderfolgende Änderungen mit gleichem Endpoint und gleicher Aktion gehen als Bulk Request raus, die Reihenfolge bleibt wie im Plan
+# Platzhalter IDs werden durch die IDs der erstellten Objekte ersetzt, schlägt ein Objekt fehl, werden die davon abhängigen Änderungen übersprungen
+# Die Fingerabdrücke aus dem Plan werden nur gespeichert, wenn alles geklappt hat
+def applyPlan(nb, path, store=None):
+        summary = {"succeeded": [], "failed": {}, "started": time.monotonic()}
+        plan = Changeset.load(path)
+        cache = NetboxCache(nb)
+        writer = cache.writer
+        logging.info(f"Applying {len(plan.changes)} changes for {len(plan.devices)} devices from {path}")
+        refs = {}
+        skipped = Counter()
+        for (name, action), group in groupby(plan.changes, key=lambda change: (change["endpoint"], change["action"])):
+                group = list(group)
+                for start in range(0, len(group), BulkWriter.CHUNK_SIZE):
+                        ready = []
+                        items = []
+                        for change in group[start:start + BulkWriter.CHUNK_SIZE]:
+                                try:
+                                        data = resolveRefs(change.get("data", {}), refs)
+                                        record = PlannedRecord({"id": resolveRefs(change.get("id"), refs), "name": change["object"]})
+                                except KeyError:
+                                        logging.debug(f"Skipping {action} of {change['object']} in {name}, an object it depends on could not be created")
+                                        skipped[(name, action)] += 1
+                                        continue
+                                ready.append(change)
+                                items.append(data if action == "create" else (record, data) if action == "update" else record)
+                        if not items:
+                                continue
+                        records = writer.send(name, action, items)
+                        if action == "create":
+                                for change, record in zip(ready, records):
+                                        if record is not None:
+                                                refs[change["ref"]] = record.id
+        for (name, action), count in skipped.items():
+                logging.error(f"Skipped {count} {action}s in {name}, an object they depend on could not be created")
+                summary["failed"][f"{name} {action}"] = f"{count} changes skipped"
+        if writer.failed or skipped:
+                logging.error("Not all changes of the plan could be applied, not storing its fingerprints")
+                for device_name in plan.devices:
+                        summary["failed"][device_name] = "plan only partly applied"
+        else:
+                summary["succeeded"] = plan.devices
+                if store is not None:
+                        for device_name, hashes in plan.fingerprints.items():
+                                store.store(device_name, hashes)
+        return logSummary(summary, "apply", cache)
+
+# ---- Kommandozeilen Argumente ----
+# Defaults kommen aus der .env, damit bestehende Setups ohne Argumente gleich weiterlaufen
+def parseArgs():
+        parser = argparse.ArgumentParser(description="Discover Cisco devices with pyATS and document them in Netbox")
+        parser.add_argument("--workers", type=int, default=int(os.getenv("WORKERS", "1")), help="number of devices collected at the same time")
+        parser.add_argument("--pool", choices=["thread", "process"], default=os.getenv("POOL", "thread"), help="use threads or processes for collecting")
+        parser.add_argument("--timeout", type=int, default=int(os.getenv("DEVICE_TIMEOUT", "300")), help="seconds per device before it counts as failed")
+        parser.add_argument("--phase", choices=["all", "collect", "reconcile"], default="all", help="only collect snapshots, only reconcile snapshots into Netbox, or both")
+        parser.add_argument("--snapshot-dir", default=os.getenv("SNAPSHOT_DIR"), help="directory for the per device snapshots")
+        parser.add_argument("--fingerprint-db", default=os.getenv("FINGERPRINT_DB", "fingerprints.db"), help="SQLite file with the output fingerprints of the last successful run")
+        parser.add_argument("--full", action="store_true", help="process every section even if the device output did not change")
+        parser.add_argument("--parse-cache", default=os.getenv("PARSE_CACHE", "parsed.db"), help="SQLite file with already parsed outputs, empty to parse while collecting like before")
+        parser.add_argument("--parse-workers", type=int, default=int(os.getenv("PARSE_WORKERS")) if os.getenv("PARSE_WORKERS") else None, help="processes used for parsing, 0 parses in the main process (default: --workers with --pool process, else 0)")
+        parser.add_argument("--capability-db", default=os.getenv("CAPABILITY_DB", "capabilities.db"), help="SQLite file that remembers which optional commands (show switch) every platform supports, empty to always try them")
+        parser.add_argument("--capability-max-age", type=int, default=int(os.getenv("CAPABILITY_MAX_AGE", "7")), help="days after which a command that a platform didn't support is tried again")
+        parser.add_argument("--raw-dir", default=os.getenv("RAW_DIR"), help="parse raw outputs from this directory instead of connecting to the switches")
+        parser.add_argument("--metrics-dir", default=os.getenv("METRICS_DIR"), help="write metrics.json and a Prometheus textfile (netbox_discovery.prom) for the run into this directory")
+        parser.add_argument("--site", action="append", default=[site for site in os.getenv("SITES", "").split(",") if site], help="only switches of this site (slug), can be given more than once")
+        parser.add_argument("--tag", action="append", default=[tag for tag in os.getenv("TAGS", "").split(",") if tag], help="only switches with this tag (slug), can be given more than once")
+        parser.add_argument("--prefix", action="append", default=[prefix for prefix in os.getenv("PREFIXES", "").split(",") if prefix], help="only switches whose primary IP is in this prefix, can be given more than once")
+        parser.add_argument("--shard-size", type=int, default=int(os.getenv("SHARD_SIZE", "100")), help="number of devices loaded into Genie at once")
+        parser.add_argument("--crawl", action="store_true", default=os.getenv("CRAWL", "false").lower() == "true", help="also discover IOS/IOS-XE CDP neighbors with a management IP in the same run")
+        parser.add_argument("--max-depth", type=int, default=int(os.getenv("CRAWL_MAX_DEPTH", "3")), help="how many CDP hops away from the testbed the crawl goes")
+        parser.add_argument("--max-devices", type=int, default=int(os.getenv("CRAWL_MAX_DEVICES", "500")), help="maximum number of devices in one crawl, including the testbed")
+        parser.add_argument("--loose-cables", choices=["remove", "report"], default=LOOSE_CABLES, help="remove cables with loose terminations or only report them")
+        parser.add_argument("--vlan-scope", choices=["global", "site", "group"], default=VLAN_SCOPE, help="put the VLANs of a switch globally, at its site or into the VLAN group of its site")
+        parser.add_argument("--device-cache", type=int, default=DEVICE_CACHE_SIZE, help="number of devices whose interfaces, modules and inventory items are kept in memory at once")
+        parser.add_argument("--default-site", type=int, default=DEFAULT_SITE, help="ID of the site for devices whose IP is in no prefix with a site")
+        parser.add_argument("--shards", type=int, default=int(os.getenv("SHARDS", "1")), help="split the switches into this many shards for several workers")
+        parser.add_argument("--shard", type=int, default=int(os.getenv("SHARD")) if os.getenv("SHARD") else None, help="shard handled by this worker, from 0 to --shards - 1")
+        parser.add_argument("--shard-by", choices=["hash", "site"], default=os.getenv("SHARD_BY", "hash"), help="assign switches to shards by a hash of the name or of the site")
+        parser.add_argument("--work-db", default=os.getenv("WORK_DB", "work.db"), help="SQLite journal of every run, shared by all workers and the coordinator of a distributed run")
+        parser.add_argument("--run-id", default=os.getenv("RUN_ID"), help="name of the run, needed for distributed runs: new for every run, the same for all workers and the coordinator")
+        parser.add_argument("--resume", action="store_true", help="continue the last run (or --run-id): skip finished devices and sections, retry failed ones")
+        parser.add_argument("--coordinate", action="store_true", help="don't discover anything, wait for all shards and do the shared cleanup once")
+        parser.add_argument("--plan", metavar="FILE", default=os.getenv("PLAN_FILE"), help="don't write to Netbox, only read and save every change a run would make into this file")
+        parser.add_argument("--apply", metavar="FILE", help="don't discover anything, write the changes of a saved plan to Netbox")
+        parser.add_argument("--wait", type=int, default=int(os.getenv("COORDINATOR_WAIT", "0")), help="seconds the coordinator waits for unfinished shards")
+        return parser.parse_args()
+
+if __name__ == "__main__":
+        args = parseArgs()
+        if args.phase != "all" and not args.snapshot_dir:
+                logging.error(f"Phase '{args.phase}' needs a snapshot directory (--snapshot-dir or SNAPSHOT_DIR)")
+                exit(1)
+        LOOSE_CABLES = args.loose_cables
+        VLAN_SCOPE = args.vlan_scope
+        DEFAULT_SITE = args.default_site
+        DEVICE_CACHE_SIZE = args.device_cache
+        if args.shards > 1 and not args.coordinate and args.shard not in range(args.shards):
+                logging.error(f"With --shards {args.shards} every worker needs --shard between 0 and {args.shards - 1}")
+                exit(1)
+        # Verteilte Läufe brauchen einen Namen für jeden Lauf, den alle Worker und der Coordinator mitbekommen
+        # Ein Standard wie das Datum wäre für Worker auf beiden Seiten von Mitternacht verschieden, und ein Coordinator mit --wait würde die fertigen Shards vom letzten Lauf sehen
+        if (args.shards > 1 or args.coordinate) and not args.run_id:
+                logging.error("Distributed runs (--shards, --coordinate) need --run-id, a new one for every run and the same for all workers and the coordinator")
+                exit(1)
+
+        if args.plan and args.apply:
+                logging.error("--plan and --apply can't be used together, make the plan first and apply it in a second run")
+                exit(1)
+        # Im Plan Modus wird nur gelesen, die Änderungen landen in PLAN und am Ende in der Plan Datei
+        if args.plan:
+                PLAN = Changeset()
+        # Coordinator und --apply entdecken selbst keine Geräte
+        discovering = not args.coordinate and not args.apply
+
+        # Jeder Lauf schreibt ins Journal, bei verteilten Läufen ist es der gemeinsame Work Store von Workern und Coordinator
+        # Ohne --run-id bekommt jeder Lauf einen eigenen Namen nach der Startzeit
+        # Ein Plan kommt nicht ins Journal, sonst würde --resume die geplanten Geräte überspringen, obwohl nichts eingetragen wurde
+        WORK = WorkStore(":memory:" if args.plan else args.work_db)
+        shard = args.shard if args.shards > 1 else 0
+        WORK.run_id = args.run_id or (WORK.lastRun(shard) if args.resume else None)
+        if args.resume and not WORK.run_id:
+                logging.warning(f"Nothing to resume in {args.work_db}, starting a new run")
+        if not WORK.run_id:
+                WORK.run_id = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+        # Ein fertiger Shard wird nicht noch einmal unter dem gleichen Namen gestartet, sonst hält ihn der Coordinator schon für fertig
+        if discovering and args.shards > 1 and not args.resume and WORK.shardStatus().get(shard, (None,))[0] == "finished":
+                logging.error(f"Shard {shard} of run '{WORK.run_id}' is already finished, use a new --run-id for every run")
+                exit(1)
+        if discovering:
+                WORK.startShard(shard, args.shards, args.resume)
+                if args.resume:
+                        logging.info(f"Resuming run '{WORK.run_id}', {len(WORK.completed)} devices are already finished")
+                if args.shards > 1:
+                        logging.info(f"Worker for shard {shard} of {args.shards} (by {args.shard_by}) in run '{WORK.run_id}'")
+
+        store = FingerprintStore(args.fingerprint_db)
+
+        # Ohne Datei wird nur im Speicher gecacht, beim Sammeln wird dann wie früher direkt geparst
+        # Mit --pool process wird sonst alles im Hauptprozess geparst, der auch in Netbox einträgt, deshalb dann so viele Parse Prozesse wie Worker
+        parser = None
+        if args.parse_workers is None:
+                args.parse_workers = args.workers if args.pool == "process" else 0
+        if args.phase != "reconcile" and discovering and (args.parse_cache or args.raw_dir):
+                parser = ParseCache(args.parse_cache or ":memory:", args.parse_workers)
+
+        # Ein gespeicherter Plan braucht weder Testbed noch Switche
+        if args.apply:
+                summary = applyPlan(nb, args.apply, store)
+        # Der Coordinator sammelt nichts selbst
+        elif args.coordinate:
+                summary = coordinateRun(nb, WORK, args.shards, args.wait)
+        # Snapshots brauchen weder Testbed noch Switche
+        elif args.phase == "reconcile":
+                summary = replaySnapshots(nb, args.snapshot_dir, store, args.full)
+        # Rohausgaben aus Textdateien brauchen auch kein Testbed
+        elif args.raw_dir:
+                summary = replayRaw(nb, args.raw_dir, parser, args.phase, args.snapshot_dir, store, args.full)
+        else:
+                # Switche seitenweise aus Netbox holen und in Blöcken an Genie weitergeben
+                devices = streamTestbed(switchSpecs(args.site, args.tag, args.prefix, args.shard, args.shards, args.shard_by), args.shard_size)
+
+                # ---- Parsing und Verarbeitung der Daten ----
+                crawler = Crawler(args.max_depth, args.max_devices, args.shard, args.shards, args.shard_by) if args.crawl else None
+                capabilities = CapabilityStore(args.capability_db, args.capability_max_age) if args.capability_db else None
+                summary = runDiscovery(nb, devices, workers=args.workers, pool=args.pool, timeout=args.timeout, phase=args.phase, snapshot_dir=args.snapshot_dir, store=store, full=args.full, parser=parser, crawler=crawler, capabilities=capabilities)
+
+        if PLAN is not None:
+                for (name, action), count in sorted(PLAN.stats().items()):
+                        logging.info(f"Plan: {count} {name} to {action}")
+                PLAN.devices = summary["succeeded"]
+                PLAN.save(args.plan)
+        if parser is not None:
+                parser.close()
+        if discovering:
+                WORK.finishShard(summary)
+        WORK.close()
+        if args.metrics_dir:
+                METRICS.write(args.metrics_dir, summary)
@@ -0,0 +1,26 @@
+import importlib, os, sys, types
+import pytest
+
+# Das Skript liest beim Import die Umgebung und baut die Netbox Session auf, eine Adresse ohne Server reicht dafür
+os.environ.setdefault("NETBOX_URL", "http://netbox.invalid")
+os.environ.setdefault("NETBOX_TOKEN", "0" * 40)
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Die Tests brauchen keine Switche, ohne pyATS reichen leere Module für die Imports von Genie
+def stubGenie():
+        try:
+                importlib.import_module("genie.testbed")
+                importlib.import_module("genie.conf.base")
+                return
+        except ImportError:
+                pass
+        modules = {name: types.ModuleType(name) for name in ("genie", "genie.testbed", "genie.conf", "genie.conf.base")}
+        modules["genie.testbed"].load = None
+        modules["genie.conf.base"].Device = None
+        sys.modules.update(modules)
+
+@pytest.fixture(scope="session")
+def discovery():
+        stubGenie()
+        return importlib.import_module("netbox_pyats_discovery")
@@ -0,0 +1,49 @@
+import pytest
+
+# ---- Echte Interface Namen und Medientypen mit dem erwarteten Netbox Typ ----
+# (Name, Typ aus "show interfaces status" oder None bei CDP, erwarteter Typ)
+INTERFACE_CORPUS = [
+        ("GigabitEthernet1/0/1", "10/100/1000BaseTX", "1000base-tx"),
+        ("GigabitEthernet1/1/1", "1000BaseSX SFP", "1000base-x-sfp"),
+        ("GigabitEthernet1/1/2", "1000BaseLX SFP", "1000base-x-sfp"),
+        ("GigabitEthernet1/1/3", "1000BaseT SFP", "1000base-x-sfp"),
+        ("FastEthernet0/1", "10/100BaseTX", "100base-tx"),
+        ("TwoGigabitEthernet1/0/1", "100/1000/2.5GBaseTX", "2.5gbase-t"),
+        ("TenGigabitEthernet1/0/37", "100/1000/2.5G/5G/10GBaseTX", "10gbase-t"),
+        ("TenGigabitEthernet1/1/1", "SFP-10GBase-SR", "10gbase-x-sfpp"),
+        ("TenGigabitEthernet1/1/2", "SFP-10GBase-LR", "10gbase-x-sfpp"),
+        ("TenGigabitEthernet1/1/3", "10GBase-SR", "10gbase-x-sfpp"),
+        ("TenGigabitEthernet1/1/4", "SFP-10GBase-AOC3M", "10gbase-x-sfpp"),
+        ("TenGigabitEthernet1/1/5", "Not Present", "other"),
+        ("TenGigabitEthernet1/1/6", "unknown", "other"),
+        ("TwentyFiveGigE1/1/1", "SFP-25GBase-SR", "25gbase-x-sfp28"),
+        ("FortyGigabitEthernet1/1/1", "QSFP-40G-SR4", "40gbase-x-qsfpp"),
+        ("HundredGigE1/0/49", "QSFP-100G-SR4", "100gbase-x-qsfp28"),
+        ("Port-channel1", "--", "lag"),
+        ("AppGigabitEthernet1/0/1", "App-hosting port", "virtual"),
+        ("Vlan10", None, "virtual"),
+        ("Loopback0", None, "virtual"),
+        ("GigabitEthernet1/0/5", None, "1000base-tx"),
+        ("TenGigabitEthernet1/0/1", None, "10gbase-t"),
+        ("Gi1/0/1", None, "1000base-tx"),
+        ("Te1/1/1", None, "10gbase-t"),
+        ("Tw1/0/1", None, "2.5gbase-t"),
+        ("Twe1/0/1", None, "25gbase-x-sfp28"),
+        ("Fo1/1/1", None, "40gbase-x-qsfpp"),
+        ("Hu1/0/49", None, "100gbase-x-qsfp28"),
+        ("Po10", None, "lag"),
+        ("Ethernet1/49", None, "other"),
+        ("Eth101/1/1", None, "other"),
+        ("port-channel20", None, "lag"),
+        ("mgmt0", None, "other"),
+        ("Port 1", None, "1000base-tx"),
+        ("GigabitEthernet0", None, "1000base-tx"),
+        ("Bluetooth0/4", None, "virtual"),
+]
+
+# classify direkt aus der Tabelle und interfaceType mit dem Cache davor müssen dasselbe liefern
+@pytest.mark.parametrize("lookup", ["classify", "interfaceType"])
+@pytest.mark.parametrize("name, media, expected", INTERFACE_CORPUS)
+def test_interface_type(discovery, lookup, name, media, expected):
+        classify = discovery.INTERFACE_TYPES.classify if lookup == "classify" else discovery.interfaceType
+        assert classify(name, media) == expected
@@ -0,0 +1,72 @@
+from types import SimpleNamespace
+
+# ---- Kabel wie sie von Netbox kommen, nur mit den Feldern die planCables braucht ----
+def cable(cable_id, a=(), b=()):
+        return SimpleNamespace(id=cable_id, a_terminations=[{"object_type": "dcim.interface", "object_id": i} for i in a], b_terminations=[{"object_type": "dcim.interface", "object_id": i} for i in b])
+
+def ids(cables):
+        return sorted(c.id for c in cables)
+
+def test_cable_in_both_directions_is_unchanged(discovery):
+        for existing in (cable(10, [1], [2]), cable(10, [2], [1])):
+                plan = discovery.planCables([existing], [(1, 2)])
+                assert plan["unchanged"] == 1
+                assert plan["create"] == plan["update"] == plan["delete"] == []
+
+def test_link_reported_from_both_sides_is_created_once(discovery):
+        plan = discovery.planCables([], [(1, 2), (2, 1)])
+        assert plan["create"] == [(1, 2)]
+
+def test_wrong_cable_is_terminated_again(discovery):
+        existing = cable(10, [1], [3])
+        plan = discovery.planCables([existing], [(1, 2)])
+        assert plan["update"] == [(existing, 1, 2)]
+        assert plan["create"] == plan["delete"] == []
+
+def test_extra_cables_on_the_interfaces_are_deleted(discovery):
+        first, second = cable(10, [1], [3]), cable(11, [4], [2])
+        plan = discovery.planCables([first, second], [(1, 2)])
+        assert plan["update"] == [(first, 1, 2)]
+        assert ids(plan["delete"]) == [11]
+
+def test_cable_with_several_terminations_is_replaced(discovery):
+        existing = cable(10, [1, 5], [2])
+        plan = discovery.planCables([existing], [(1, 2)])
+        assert plan["unchanged"] == 0
+        assert plan["update"] == [(existing, 1, 2)]
+
+def test_two_neighbors_on_one_interface_conflict(discovery):
+        plan = discovery.planCables([], [(1, 2), (1, 3)])
+        assert plan["create"] == [(1, 2)]
+        assert plan["conflicts"] == [(1, 3)]
+
+def test_conflict_keeps_the_matching_cable(discovery):
+        existing = cable(10, [1], [2])
+        plan = discovery.planCables([existing], [(1, 3), (1, 2)])
+        assert plan["unchanged"] == 1
+        assert plan["conflicts"] == [(1, 3)]
+        assert plan["delete"] == plan["update"] == []
+
+def test_loose_cables_are_removed(discovery):
+        loose, empty = cable(10, [7], []), cable(11)
+        plan = discovery.planCables([loose, empty], [], remove_loose=True)
+        assert ids(plan["delete"]) == [10, 11]
+        assert plan["loose"] == []
+
+def test_loose_cables_are_only_reported(discovery):
+        loose = cable(10, [7], [])
+        plan = discovery.planCables([loose], [], remove_loose=False)
+        assert plan["delete"] == []
+        assert ids(plan["loose"]) == [10]
+
+def test_loose_cable_on_a_link_is_reused(discovery):
+        loose = cable(10, [1], [])
+        plan = discovery.planCables([loose], [(1, 2)], remove_loose=False)
+        assert plan["update"] == [(loose, 1, 2)]
+        assert plan["loose"] == []
+
+def test_other_termination_types_are_ignored(discovery):
+        existing = SimpleNamespace(id=10, a_terminations=[{"object_type": "dcim.interface", "object_id": 1}], b_terminations=[{"object_type": "dcim.frontport", "object_id": 2}])
+        plan = discovery.planCables([existing], [(1, 2)])
+        assert plan["unchanged"] == 0
+        assert plan["update"] == [(existing, 1, 2)]